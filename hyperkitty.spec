@@ -37,7 +37,6 @@ BuildRequires:  django-browserid
 BuildRequires:  python-django >= 1.6
 BuildRequires:  python-django-south
 BuildRequires:  python-dateutil
-BuildRequires:  python-networkx
 BuildRequires:  python-enum34
 BuildRequires:  python-django-haystack
 BuildRequires:  python-django-extensions
@@ -65,7 +64,6 @@ Requires:       django-browserid >= 0.10.1
 Requires:       python-django >= 1.6
 Requires:       python-django-south
 Requires:       python-dateutil
-Requires:       python-networkx
 Requires:       python-enum34
 Requires:       python-django-haystack
 Requires:       python-django-extensions
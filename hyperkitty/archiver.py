@@ -26,6 +26,8 @@ This will be imported by Mailman Core and must thus be Python3-compatible.
 
 from __future__ import absolute_import, unicode_literals
 
+from base64 import b32encode
+from hashlib import sha1
 try:
     from urllib.parse import urljoin # PY3  # pylint: disable=no-name-in-module
 except ImportError:
@@ -36,11 +38,31 @@ from mailman.interfaces.archiver import IArchiver
 from mailman.config import config
 from mailman.config.config import external_configuration
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+# Seconds to wait for the connection and for the response
+TIMEOUT = 10
+# Number of retries on connection errors and temporary server errors
+RETRIES = 3
+
+
+def get_message_id_hash(msg_id):
+    """
+    Returns the X-Message-ID-Hash header for the provided Message-ID header,
+    like hyperkitty.lib.utils.get_message_id_hash, which can't be imported
+    here because Mailman does not have Django.
+    """
+    msg_id = msg_id.strip().strip("<>")
+    if not isinstance(msg_id, bytes):
+        msg_id = msg_id.encode("utf-8")
+    return b32encode(sha1(msg_id).digest()).decode("ascii")
+
+
 class Archiver(object):
 
     implements(IArchiver)
@@ -50,6 +72,10 @@ class Archiver(object):
     def __init__(self):
         self._base_url = None
         self._auth = None
+        self._timeout = TIMEOUT
+        self._retries = RETRIES
+        self._session = None
+        self._list_urls = {}
 
     @property
     def base_url(self):
@@ -67,6 +93,23 @@ class Archiver(object):
             self._load_conf()
         return self._auth
 
+    @property
+    def session(self):
+        """
+        The HTTP session, which keeps the connections to HyperKitty open
+        between the messages.
+        """
+        if self._session is None:
+            session = requests.Session()
+            session.auth = self.auth
+            retries = Retry(total=self._retries, backoff_factor=0.5,
+                            status_forcelist=(502, 503, 504))
+            adapter = HTTPAdapter(max_retries=retries)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
     def _load_conf(self):
         """
         Find the location of the Django settings module from Mailman's
@@ -78,6 +121,17 @@ class Archiver(object):
         self._base_url = archiver_config.get("general", "base_url")
         self._auth = (archiver_config.get("general", "api_user"),
                       archiver_config.get("general", "api_pass"))
+        if archiver_config.has_option("general", "timeout"):
+            self._timeout = archiver_config.getfloat("general", "timeout")
+        if archiver_config.has_option("general", "retries"):
+            self._retries = archiver_config.getint("general", "retries")
+
+    def _request(self, method, path, **kwargs):
+        url = urljoin(self.base_url, path)
+        result = self.session.request(method, url, timeout=self._timeout,
+                                      **kwargs)
+        result.raise_for_status()
+        return result.json()
 
     def list_url(self, mlist):
         """Return the url to the top of the list's archive.
@@ -85,10 +139,13 @@ class Archiver(object):
         :param mlist: The IMailingList object.
         :returns: The url string.
         """
-        result = requests.get(urljoin(self.base_url, "api/mailman/urls"),
-            params={"mlist": mlist.fqdn_listname}, auth=self.auth)
-        url = result.json["url"]
-        return urljoin(self.base_url, url)
+        # The URL of a list does not change, only ask HyperKitty once
+        if mlist.fqdn_listname not in self._list_urls:
+            result = self._request("GET", "api/mailman/urls",
+                                   params={"mlist": mlist.fqdn_listname})
+            self._list_urls[mlist.fqdn_listname] = urljoin(
+                self.base_url, result["url"])
+        return self._list_urls[mlist.fqdn_listname]
 
     def permalink(self, mlist, msg):
         """Return the url to the message in the archive.
@@ -101,12 +158,13 @@ class Archiver(object):
         :returns: The url string or None if the message's archive url cannot
             be calculated.
         """
-        msg_id = msg['Message-Id'].strip().strip("<>")
-        result = requests.get(urljoin(self.base_url, "api/mailman/urls"),
-            params={"mlist": mlist.fqdn_listname, "msgid": msg_id},
-            auth=self.auth)
-        url = result.json["url"]
-        return urljoin(self.base_url, url)
+        msg_id = msg['Message-Id']
+        if msg_id is None:
+            return None
+        # The message URL is the list URL followed by the hash, see the
+        # hk_message_index URL in hyperkitty.urls
+        return urljoin(self.list_url(mlist),
+                       "message/%s/" % get_message_id_hash(msg_id))
 
     def archive_message(self, mlist, msg):
         """Send the message to the archiver.
@@ -116,11 +174,39 @@ class Archiver(object):
         :returns: The url string or None if the message's archive url cannot
             be calculated.
         """
-        result = requests.post(urljoin(self.base_url, "api/mailman/archive"),
+        result = self._request("POST", "api/mailman/archive",
             data={"mlist": mlist.fqdn_listname},
-            files={"message": ("message.txt", msg.as_string())},
-            auth=self.auth)
-        url = urljoin(self.base_url, result.json["url"])
+            files={"message": ("message.txt", msg.as_string())})
+        url = urljoin(self.base_url, result["url"])
         logger.info("HyperKitty archived message %s to %s",
                     msg['Message-Id'].strip(), url)
         return url
+
+    def archive_messages(self, messages):
+        """Send several messages to the archiver in a single request.
+
+        This is not part of Mailman's IArchiver interface, it is meant for
+        the scripts which backfill the archives from Mailman.
+
+        :param messages: a list of (IMailingList object, message object)
+            tuples.
+        :returns: the list of the url strings, None for the messages which
+            could not be archived.
+        """
+        if len(messages) == 1:
+            return [self.archive_message(*messages[0])]
+        result = self._request("POST", "api/mailman/archive",
+            data=[ ("mlist", mlist.fqdn_listname)
+                   for mlist, _msg in messages ],
+            files=[ ("message", ("message.txt", msg.as_string()))
+                    for _mlist, msg in messages ])
+        urls = []
+        for msg_result in result["results"]:
+            if "error" in msg_result:
+                logger.error("HyperKitty could not archive message %s: %s",
+                             msg_result["message_id"], msg_result["error"])
+                urls.append(None)
+            else:
+                urls.append(urljoin(self.base_url, msg_result["url"]))
+        logger.info("HyperKitty archived %d messages", len(messages))
+        return urls
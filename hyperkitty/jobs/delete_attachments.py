@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+# USA.
+#
+
+"""
+Remove the attachment contents which are not referenced anymore
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from django_extensions.management.jobs import BaseJob
+from hyperkitty.lib.storage import get_attachment_store, delete_unreferenced
+
+
+class Job(BaseJob):
+    help = "Remove the attachment contents which are not referenced anymore"
+    when = "daily"
+
+    def execute(self):
+        store = get_attachment_store()
+        if store is not None:
+            delete_unreferenced(store)
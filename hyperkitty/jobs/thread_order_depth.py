@@ -27,7 +27,7 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 from django_extensions.management.jobs import BaseJob
 from hyperkitty.models import Thread
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
+from hyperkitty.lib.analysis import compute_threads_order_and_depth
 
 
 class Job(BaseJob):
@@ -35,5 +35,5 @@ class Job(BaseJob):
     when = "yearly"
 
     def execute(self):
-        for thread in Thread.objects.all():
-            compute_thread_order_and_depth(thread)
+        compute_threads_order_and_depth(
+            Thread.objects.values_list("id", flat=True))
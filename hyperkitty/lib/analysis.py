@@ -25,28 +25,164 @@ Author: Aurelien Bompard <abompard@fedoraproject.org>
 
 from __future__ import absolute_import, unicode_literals
 
-import networkx as nx
+from collections import defaultdict
+from itertools import groupby
+
+from django.db import transaction
+from django.db.models import F, Max, Min
+
+
+# Number of threads loaded from the database at once
+THREADS_PER_QUERY = 500
+
+
+class _DisjointSets(object):
+    """Union-find structure, to detect reply loops in linear time."""
+
+    def __init__(self):
+        self.parents = {}
+        self.sizes = {}
+
+    def find(self, item):
+        root = item
+        while self.parents.get(root, root) != root:
+            root = self.parents[root]
+        # path compression
+        while item != root:
+            self.parents[item], item = root, self.parents[item]
+        return root
+
+    def union(self, item1, item2):
+        root1, root2 = self.find(item1), self.find(item2)
+        if self.sizes.get(root1, 1) < self.sizes.get(root2, 1):
+            root1, root2 = root2, root1
+        self.parents[root2] = root1
+        self.sizes[root1] = self.sizes.get(root1, 1) + self.sizes.get(root2, 1)
+
+
+def get_thread_order_and_depth(emails):
+    """
+    Compute the position and the depth of the emails of a thread in the reply
+    tree. The replies to the same email are sorted by date.
+
+    :arg emails: a list of ``(id, parent_id)`` tuples, sorted by date.
+    :returns: a dict mapping the email ids to ``(order, depth)`` tuples.
+    """
+    if not emails:
+        return {}
+    ids = set(email_id for email_id, _parent_id in emails)
+    parents = {}
+    children = defaultdict(list)
+    trees = _DisjointSets()
+    starter_id = None
+    for email_id, parent_id in emails:
+        if parent_id is None:
+            if starter_id is None:
+                starter_id = email_id
+            continue
+        if parent_id not in ids:
+            continue
+        if trees.find(parent_id) == trees.find(email_id):
+            continue # I don't want reply loops in my tree, thank you very much
+        trees.union(parent_id, email_id)
+        parents[email_id] = parent_id
+        children[parent_id].append(email_id)
+    if starter_id is None:
+        # All the emails are replies, start from the top of the first one
+        starter_id = emails[0][0]
+        while starter_id in parents:
+            starter_id = parents[starter_id]
+    # Start with the starting email, and add the unreachable emails afterwards
+    roots = [starter_id] + [ email_id for email_id, _parent_id in emails
+                             if email_id not in parents
+                             and email_id != starter_id ]
+    result = {}
+    for root in roots:
+        stack = [(root, 0)]
+        while stack:
+            email_id, depth = stack.pop()
+            if email_id in result:
+                continue
+            result[email_id] = (len(result), depth)
+            stack.extend((child_id, depth + 1)
+                         for child_id in reversed(children[email_id]))
+    return result
+
+
+def compute_threads_order_and_depth(thread_ids):
+    """
+    Compute the thread order and depth of the emails in several threads. Only
+    the emails which have changed are updated.
+
+    :returns: the number of updated emails.
+    """
+    from hyperkitty.models import Email # circular import
+    thread_ids = list(thread_ids)
+    updated = 0
+    for index in range(0, len(thread_ids), THREADS_PER_QUERY):
+        emails = Email.objects.filter(
+            thread_id__in=thread_ids[index:index+THREADS_PER_QUERY]
+            ).order_by("thread", "date", "id").values_list(
+            "thread_id", "id", "parent_id", "thread_order", "thread_depth")
+        # Group the changed emails by their new values to update them with
+        # as few queries as possible
+        changes = defaultdict(list)
+        for _thread_id, thread_emails in groupby(emails, lambda e: e[0]):
+            thread_emails = list(thread_emails)
+            positions = get_thread_order_and_depth([
+                (email_id, parent_id) for _thread_id, email_id, parent_id,
+                _order, _depth in thread_emails ])
+            for _thread_id, email_id, _parent_id, order, depth \
+                    in thread_emails:
+                if positions[email_id] != (order, depth):
+                    changes[positions[email_id]].append(email_id)
+        with transaction.atomic():
+            for (order, depth), email_ids in changes.items():
+                updated += Email.objects.filter(id__in=email_ids).update(
+                    thread_order=order, thread_depth=depth)
+    return updated
 
 
 def compute_thread_order_and_depth(thread):
-    graph = nx.DiGraph()
-    thread_pos = {"d": 0, "o": 0} # depth, order
-    def walk_successors(msgid):
-        obj = graph.node[msgid]["obj"]
-        obj.thread_depth = thread_pos["d"]
-        obj.thread_order = thread_pos["o"]
-        obj.save()
-        thread_pos["d"] += 1
-        thread_pos["o"] += 1
-        for succ in sorted(graph.successors(msgid),
-                           key=lambda m: graph.node[m]["num"]):
-            walk_successors(succ)
-        thread_pos["d"] -= 1
-    for index, email in enumerate(thread.emails.order_by("date")):
-        graph.add_node(email.id, num=index, obj=email)
-        if email.parent_id is not None:
-            graph.add_edge(email.parent_id, email.id)
-            if not nx.is_directed_acyclic_graph(graph):
-                # I don't want reply loops in my graph, thank you very much
-                graph.remove_edge(email.parent_id, email.id)
-    walk_successors(thread.starting_email.id)
+    return compute_threads_order_and_depth([thread.id])
+
+
+def insert_in_thread_order(email):
+    """
+    Place a new email in the order of its thread without recomputing the
+    whole thread: the email is inserted after the replies to its parent, and
+    the emails which follow are shifted in a single query.
+
+    This is only possible when the email is the latest reply to its parent
+    and has no replies itself, which is the usual case for incoming emails.
+    Otherwise, the order of the whole thread is computed again.
+    """
+    thread = email.thread
+    others = thread.emails.exclude(id=email.id)
+    parent = email.parent
+    if parent is None:
+        if others.exists():
+            return compute_thread_order_and_depth(thread)
+        position, depth = 0, 0
+    else:
+        if (parent.thread_id != email.thread_id
+                or email.children.exists()
+                or others.filter(parent_id=parent.id,
+                                 date__gt=email.date).exists()):
+            return compute_thread_order_and_depth(thread)
+        # The first email after the parent's subtree
+        position = others.filter(
+            thread_order__gt=parent.thread_order,
+            thread_depth__lte=parent.thread_depth,
+            ).aggregate(Min("thread_order"))["thread_order__min"]
+        if position is None:
+            position = others.aggregate(
+                Max("thread_order"))["thread_order__max"] + 1
+        else:
+            others.filter(thread_order__gte=position).update(
+                thread_order=F("thread_order") + 1)
+        depth = parent.thread_depth + 1
+    email.thread_order = position
+    email.thread_depth = depth
+    thread.emails.filter(id=email.id).update(
+        thread_order=position, thread_depth=depth)
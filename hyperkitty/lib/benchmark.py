@@ -0,0 +1,279 @@
+#-*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+"""
+Measure the import performance with generated mailboxes.
+"""
+
+from __future__ import absolute_import, unicode_literals, division
+
+import calendar
+import mailbox
+import platform
+import random
+import time
+from datetime import datetime, timedelta
+from email import message_from_string
+from email.header import Header
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formataddr, formatdate, parseaddr
+
+from django.conf import settings
+from django.db import connection, DatabaseError
+
+from hyperkitty import VERSION
+from hyperkitty.lib.mbox import open_mbox
+from hyperkitty.lib.scrub import Scrubber
+
+
+# Sample text for each charset, the messages are built from these words
+SAMPLE_TEXTS = {
+    "us-ascii": "the quick brown fox jumps over the lazy dog while the "
+                "release manager tags a new version of the package",
+    "utf-8": "le cœur déçu mais l'âme plutôt naïve Ω≈ç√∫ 日本語の文章 "
+             "Zwölf Boxkämpfer jagen Viktor quer über den großen Sylter Deich",
+    "iso-8859-1": "voix ambiguë d'un coeur qui au zéphyr préfère les jattes "
+                  "de kiwis où l'on mange à côté de l'église",
+    "koi8-r": "съешь же ещё этих мягких французских булок да выпей чаю "
+              "в чащах юга жил бы цитрус но фальшивый экземпляр",
+}
+SAMPLE_NAMES = [
+    "Alice Martin", "Bob Smith", "Chloé Dupré", "Dmitri Ivanov",
+    "Eve Müller", "Frank Jones", "Gaëlle Le Goff", "Hiroshi Tanaka",
+    ]
+
+
+class MboxGenerator(object):
+    """
+    Generate realistic mailboxes: messages in threads, replies quoting their
+    parent, text in various charsets and binary attachments.
+
+    The same seed always generates the same mailbox.
+    """
+
+    def __init__(self, thread_depth=5, attachment_ratio=0.1,
+                 charsets=("us-ascii", "utf-8", "iso-8859-1", "koi8-r"),
+                 seed=0):
+        for charset in charsets:
+            if charset not in SAMPLE_TEXTS:
+                raise ValueError("Unsupported charset: %s" % charset)
+        self.thread_depth = thread_depth
+        self.attachment_ratio = attachment_ratio
+        self.charsets = charsets
+        self.random = random.Random(seed)
+        self.senders = [
+            (name, "%s@example.com" % name.split()[0].lower().encode(
+                "ascii", "ignore"))
+            for name in SAMPLE_NAMES ]
+
+    def _text(self, charset, words_count):
+        words = SAMPLE_TEXTS[charset].split()
+        return " ".join(self.random.choice(words)
+                        for _i in range(words_count))
+
+    def _body(self, charset, parent_body):
+        lines = []
+        if parent_body:
+            lines.append("On a previous day, someone wrote:")
+            lines.extend("> %s" % line for line in parent_body.splitlines()
+                         if not line.startswith(">>>"))
+            lines.append("")
+        for _i in range(self.random.randint(1, 4)):
+            lines.append(self._text(charset, self.random.randint(5, 15)))
+            lines.append("")
+        return "\n".join(lines)
+
+    def _message(self, num, date, parent):
+        if parent is None:
+            charset = self.random.choice(self.charsets)
+            subject = self._text(charset, self.random.randint(2, 8))
+            depth = 0
+        else:
+            # the replies use the charset of the thread
+            charset = parent["charset"]
+            subject = "Re: %s" % parent["subject"]
+            depth = parent["depth"] + 1
+        body = self._body(charset, parent and parent["body"])
+        text = MIMEText(body.encode(charset), "plain", charset)
+        if self.random.random() < self.attachment_ratio:
+            msg = MIMEMultipart(boundary="===============%d==" % num)
+            msg.attach(text)
+            attachment = MIMEApplication(bytes(bytearray(
+                self.random.getrandbits(8)
+                for _i in range(self.random.randint(1, 50) * 1024))))
+            attachment.add_header("Content-Disposition", "attachment",
+                                  filename="file-%d.bin" % num)
+            msg.attach(attachment)
+        else:
+            msg = text
+        name, address = self.random.choice(self.senders)
+        msg["From"] = formataddr(
+            (str(Header(name.encode("utf-8"), "utf-8")), address))
+        msg["Subject"] = Header(subject.encode(charset), charset)
+        msg["Message-ID"] = "<msg-%d@example.com>" % num
+        msg["Date"] = formatdate(calendar.timegm(date.timetuple()))
+        if parent is not None:
+            msg["In-Reply-To"] = parent["message_id"]
+            msg["References"] = " ".join(
+                parent["references"] + [parent["message_id"]])
+        return msg, {"subject": subject, "depth": depth, "body": body,
+                     "charset": charset,
+                     "message_id": msg["Message-ID"],
+                     "references": (parent["references"] + [
+                            parent["message_id"]]) if parent else []}
+
+    def generate(self, path, count):
+        """
+        Write ``count`` messages to the mbox file at ``path``.
+        """
+        mbox = mailbox.mbox(path)
+        date = datetime(2015, 1, 1)
+        recent = [] # the messages which can be replied to
+        try:
+            for num in range(count):
+                date += timedelta(seconds=self.random.randint(1, 3600))
+                parent = None
+                if recent and self.random.random() < 0.7:
+                    parent = self.random.choice(recent)
+                    if parent["depth"] >= self.thread_depth:
+                        parent = None
+                msg, info = self._message(num, date, parent)
+                recent.append(info)
+                if len(recent) > 50:
+                    recent.pop(0)
+                msg = mailbox.mboxMessage(msg)
+                msg.set_from(parseaddr(msg["From"])[1], date.timetuple())
+                mbox.add(msg)
+        finally:
+            mbox.close()
+
+
+def get_environment():
+    """Describe the software and the database the benchmark is run with."""
+    cursor = connection.cursor()
+    try:
+        if connection.vendor == "sqlite":
+            cursor.execute("SELECT sqlite_version()")
+        else:
+            cursor.execute("SELECT version()")
+        db_version = cursor.fetchone()[0]
+    except DatabaseError:
+        db_version = None
+    return {
+        "hyperkitty": VERSION,
+        "python": platform.python_version(),
+        "database": {
+            "vendor": connection.vendor,
+            "engine": settings.DATABASES["default"]["ENGINE"],
+            "version": db_version,
+            },
+        }
+
+
+def run_import_benchmark(importer, mbfile):
+    """
+    Import a mailbox with the given importer and report the throughput of
+    each stage.
+
+    :arg importer: a
+        :py:class:`hyperkitty.management.commands.hyperkitty_import.DbImporter`
+        instance
+    :returns: a dict that can be serialized to JSON.
+    """
+    batch_mode = getattr(settings, "HYPERKITTY_BATCH_MODE", False)
+    settings.HYPERKITTY_BATCH_MODE = True
+    try:
+        start = time.time()
+        importer.from_mbox(mbfile)
+        importer.compute_thread_order()
+        duration = time.time() - start
+    finally:
+        settings.HYPERKITTY_BATCH_MODE = batch_mode
+    stats = importer.stats
+    stages = {}
+    for stage in stats.durations:
+        seconds = stats.durations[stage]
+        stages[stage] = {
+            "count": stats.counts[stage],
+            "seconds": round(seconds, 3),
+            "per_second": round(stats.counts[stage] / seconds, 1)
+                          if seconds else None,
+            }
+    imported = stats.counts["write"]
+    return {
+        "environment": get_environment(),
+        "messages": imported,
+        "stages": stages,
+        "total": {
+            "seconds": round(duration, 3),
+            "per_second": round(imported / duration, 1) if duration else None,
+            },
+        }
+
+
+def _time_scrub(messages, method):
+    # The scrubber modifies the messages, parse them again for each run
+    parsed = [ message_from_string(message) for message in messages ]
+    start = time.time()
+    for msg in parsed:
+        getattr(Scrubber(None, msg), method)()
+    return time.time() - start
+
+
+def run_scrub_benchmark(mbfile, repeat=3):
+    """
+    Scrub the messages of a mailbox with and without the fast path for the
+    single-part text messages, and check that both give the same results.
+    Nothing is written to the database.
+
+    :returns: a dict that can be serialized to JSON.
+    """
+    with open_mbox(mbfile) as mbox:
+        messages = [ message for message, _stop in mbox.messages() ]
+    inline, mismatches = 0, 0
+    for message in messages:
+        scrubber = Scrubber(None, message_from_string(message))
+        if scrubber._is_inline_text(): # pylint: disable=protected-access
+            inline += 1
+        if scrubber.scrub() != Scrubber(
+                None, message_from_string(message))._scrub_parts():
+            mismatches += 1
+    report = {
+        "environment": get_environment(),
+        "messages": len(messages),
+        "inline_text": inline,
+        "mismatches": mismatches,
+        }
+    durations = {}
+    for name, method in (("walk", "_scrub_parts"), ("fast_path", "scrub")):
+        # keep the best run, the others were slowed down by something else
+        seconds = min(_time_scrub(messages, method) for _i in range(repeat))
+        durations[name] = seconds
+        report[name] = {
+            "seconds": round(seconds, 3),
+            "per_second": round(len(messages) / seconds, 1)
+                          if seconds else None,
+            }
+    report["speedup"] = round(durations["walk"] / durations["fast_path"], 2) \
+                        if durations["fast_path"] else None
+    return report
@@ -0,0 +1,433 @@
+#-*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+"""
+Store emails in the database by batches, with a limited number of queries.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import struct
+from collections import defaultdict, deque
+from hashlib import sha1
+
+from django.conf import settings
+from django.db import transaction, Error as DatabaseError
+from django.db.models.signals import post_save
+
+from hyperkitty.lib.incoming import (
+    save_email, reconcile_replies, parse_message)
+from hyperkitty.lib.signals import new_email, new_thread
+from hyperkitty.lib.analysis import compute_threads_order_and_depth
+from hyperkitty.models import (MailingList, Sender, Email, Thread, Attachment,
+    ArchivePolicy, update_threads_counts)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# SQLite does not accept more than 999 variables in a query
+QUERY_CHUNK_SIZE = 500
+
+
+def chunked(items, size=QUERY_CHUNK_SIZE):
+    items = list(items)
+    for index in range(0, len(items), size):
+        yield items[index:index+size]
+
+
+class MessageIdIndex(object):
+    """
+    An in-memory map of a mailing-list's message-ids to the ids of the
+    matching email and thread, to avoid querying the database when looking
+    for duplicates or parents.
+
+    To keep the memory usage low, the message-ids are stored as 64-bit
+    integers computed from their SHA1 hash, and the email and thread ids are
+    packed in a single integer (or kept in a tuple if the thread id does not
+    fit in 32 bits). The index holds at most ``max_size`` entries:
+    the most recently archived emails are loaded, and the oldest entries are
+    evicted when new ones are added. If the index does not hold all the
+    emails of the list, a message-id that is not in the index may still be
+    in the database, see the ``complete`` attribute.
+    """
+
+    load_chunk_size = 10000
+
+    def __init__(self, mlist, max_size=1000000):
+        self.mlist = mlist
+        self.max_size = max_size
+        self.complete = True
+        self._ids = {}
+        self._keys = deque() # oldest first, for eviction
+
+    @staticmethod
+    def _key(message_id):
+        return struct.unpack(b"<q", sha1(message_id.encode("utf-8")
+                                         ).digest()[:8])[0]
+
+    @staticmethod
+    def _pack(email_id, thread_id):
+        if 0 <= thread_id < 1 << 32:
+            return (email_id << 32) | thread_id
+        return (email_id, thread_id)
+
+    @staticmethod
+    def _unpack(value):
+        if isinstance(value, tuple):
+            return value
+        return (value >> 32, value & 0xFFFFFFFF)
+
+    def load(self):
+        """Load the most recently archived emails from the database."""
+        query = Email.objects.filter(mailinglist=self.mlist).order_by("-id")
+        last_id = None
+        while len(self._ids) < self.max_size:
+            chunk = query
+            if last_id is not None:
+                chunk = chunk.filter(id__lt=last_id)
+            chunk = list(chunk.values_list("message_id", "id", "thread_id")[
+                :min(self.load_chunk_size, self.max_size - len(self._ids))])
+            if not chunk:
+                break
+            for message_id, email_id, thread_id in chunk:
+                key = self._key(message_id)
+                self._ids[key] = self._pack(email_id, thread_id)
+                self._keys.appendleft(key)
+            last_id = chunk[-1][1]
+        else:
+            # the index is full, check if there are more emails in the list
+            if last_id is not None:
+                query = query.filter(id__lt=last_id)
+            self.complete = not query.exists()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, message_id):
+        return self._key(message_id) in self._ids
+
+    def get(self, message_id):
+        """
+        :returns: a tuple with the email id and the thread id, or None if
+            the message-id is not in the index.
+        """
+        value = self._ids.get(self._key(message_id))
+        if value is None:
+            return None
+        return self._unpack(value)
+
+    def add(self, message_id, email_id, thread_id):
+        key = self._key(message_id)
+        if key not in self._ids:
+            self._keys.append(key)
+        self._ids[key] = self._pack(email_id, thread_id)
+        while len(self._ids) > self.max_size:
+            del self._ids[self._keys.popleft()]
+            self.complete = False
+
+
+class BulkWriter(object):
+    """
+    Buffer the emails built by
+    :py:func:`hyperkitty.lib.incoming.parse_message` and write them to the
+    database by batches, with bulk inserts and one transaction per batch.
+
+    If a batch can't be written (because of a constraint violation for
+    example), the emails of this batch are saved one by one.
+
+    If a :py:class:`MessageIdIndex` is given, it is used to find the
+    duplicates and the parents of the emails, and it is kept up-to-date.
+    """
+
+    def __init__(self, mlist, batch_size=100, index=None):
+        self.mlist = mlist
+        self.batch_size = batch_size
+        self.index = index
+        self.pending = []
+
+    def add(self, email, attachments):
+        """
+        Add an email to the buffer, and write the buffer to the database if
+        it is full.
+
+        :returns: the list of emails that have been written.
+        """
+        self.pending.append((email, attachments))
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Write the buffered emails to the database.
+
+        :returns: the list of emails that have been written.
+        """
+        entries, self.pending = self.pending, []
+        if not entries:
+            return []
+        try:
+            with transaction.atomic():
+                written = self._write(entries)
+        except DatabaseError as e:
+            logger.warning("Could not write a batch of %d emails (%s), "
+                           "saving them one by one", len(entries), e)
+            written = self._write_one_by_one(entries)
+        if self.index is not None:
+            for email in written:
+                self.index.add(email.message_id, email.id, email.thread_id)
+        return written
+
+    def _lookup(self, message_ids):
+        """
+        Find the emails with the given message-ids in the list.
+
+        :returns: a dict mapping the message-ids that were found to a tuple
+            with the email id and the thread id.
+        """
+        found = {}
+        if self.index is not None:
+            for message_id in message_ids:
+                ids = self.index.get(message_id)
+                if ids is not None:
+                    found[message_id] = ids
+            if self.index.complete:
+                return found
+        missing = [ msg_id for msg_id in message_ids if msg_id not in found ]
+        for msg_ids in chunked(missing):
+            for msg_id, email_id, thread_id in Email.objects.filter(
+                    mailinglist=self.mlist, message_id__in=msg_ids
+                    ).values_list("message_id", "id", "thread_id"):
+                found[msg_id] = (email_id, thread_id)
+        return found
+
+    def _write(self, entries):
+        # Find the duplicates and the parents in a single lookup
+        message_ids = set()
+        for email, _attachments in entries:
+            message_ids.add(email.message_id)
+            if email.in_reply_to is not None:
+                message_ids.add(email.in_reply_to)
+        archived = self._lookup(message_ids)
+        known_ids = set(archived)
+        emails = []
+        attachments = {}
+        for email, email_attachments in entries:
+            if email.message_id in known_ids:
+                logger.info("Duplicate email with message-id '%s'",
+                            email.message_id)
+                continue
+            known_ids.add(email.message_id)
+            email.mailinglist = self.mlist
+            emails.append(email)
+            attachments[email.message_id] = email_attachments
+        if not emails:
+            return []
+        self._write_senders(emails)
+        new_threads, waves = self._set_threads(emails, archived)
+        # An email must be inserted after its parent to know its parent_id
+        email_ids = {}
+        for wave in waves:
+            for email in wave:
+                if email.parent_id is None and email.in_reply_to in email_ids:
+                    email.parent_id = email_ids[email.in_reply_to]
+            Email.objects.bulk_create(wave)
+            for msg_ids in chunked(email.message_id for email in wave):
+                email_ids.update(Email.objects.filter(
+                    mailinglist=self.mlist, message_id__in=msg_ids
+                    ).values_list("message_id", "id"))
+            for email in wave:
+                email.id = email_ids[email.message_id]
+        # Attachments
+        new_attachments = []
+        for email in emails:
+            for counter, name, content_type, encoding, content \
+                    in attachments[email.message_id]:
+                attachment = Attachment(email_id=email.id, counter=counter,
+                    name=name, content_type=content_type, encoding=encoding)
+                attachment.set_content(content)
+                new_attachments.append(attachment)
+        Attachment.objects.bulk_create(new_attachments)
+        # The thread counters are computed for the whole batch, they are not
+        # updated by the signals of the bulk-inserted emails. In batch mode,
+        # this is done at the end of the import.
+        if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
+            update_threads_counts(email.thread_id for email in emails)
+        # Bulk inserts don't send signals, send them now to keep the cache and
+        # the search index up-to-date.
+        for thread in new_threads:
+            post_save.send(sender=Thread, instance=thread, created=True)
+            new_thread.send("Mailman", thread=thread)
+        for email in emails:
+            post_save.send(sender=Email, instance=email, created=True,
+                           raw=True)
+            new_email.send("Mailman", email=email)
+        if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
+            for email in emails:
+                reconcile_replies(email)
+            compute_threads_order_and_depth(
+                set(email.thread_id for email in emails))
+        return emails
+
+    def _write_senders(self, emails):
+        names = {}
+        for email in emails:
+            names[email.sender.address] = email.sender.name
+        existing = {}
+        for addresses in chunked(names):
+            existing.update(Sender.objects.filter(
+                address__in=addresses).values_list("address", "name"))
+        Sender.objects.bulk_create([
+            Sender(address=address, name=name)
+            for address, name in names.items() if address not in existing
+            ])
+        for address, name in names.items():
+            # update the name if needed
+            if address in existing and existing[address] != name:
+                Sender.objects.filter(address=address).update(name=name)
+
+    def _set_threads(self, emails, archived):
+        """
+        Find the parent and the thread of each email, and create the new
+        threads.
+
+        :arg archived: a dict mapping the message-ids of the archived parents
+            to a tuple with their email id and thread id.
+        :returns: the list of new threads, and the emails grouped in waves:
+            the parent of an email in a wave is either already in the
+            database or in a previous wave.
+        """
+        threads = {} # message_id -> Thread instance or existing thread id
+        wave_nums = {} # message_id -> wave number
+        new_threads = []
+        thread_dates = {}
+        for email in emails:
+            if email.in_reply_to in wave_nums:
+                # the parent is in the batch, re-use its thread
+                thread = threads[email.in_reply_to]
+                wave_nums[email.message_id] = wave_nums[email.in_reply_to] + 1
+            elif email.in_reply_to in archived:
+                email.parent_id, thread = archived[email.in_reply_to]
+                wave_nums[email.message_id] = 0
+            else:
+                thread = Thread(
+                    mailinglist=self.mlist,
+                    thread_id=email.message_id_hash,
+                    date_active=email.date)
+                new_threads.append(thread)
+                wave_nums[email.message_id] = 0
+            if isinstance(thread, Thread):
+                thread.date_active = email.date
+            else:
+                thread_dates[thread] = email.date
+            threads[email.message_id] = thread
+        # Create the new threads and update the existing ones
+        Thread.objects.bulk_create(new_threads)
+        thread_ids = {}
+        for hashes in chunked(thread.thread_id for thread in new_threads):
+            thread_ids.update(Thread.objects.filter(
+                mailinglist=self.mlist, thread_id__in=hashes
+                ).values_list("thread_id", "id"))
+        for thread in new_threads:
+            thread.id = thread_ids[thread.thread_id]
+        for thread_id, date_active in thread_dates.items():
+            Thread.objects.filter(id=thread_id).update(date_active=date_active)
+        waves = defaultdict(list)
+        for email in emails:
+            thread = threads[email.message_id]
+            if isinstance(thread, Thread):
+                thread = thread.id
+            email.thread_id = thread
+            waves[wave_nums[email.message_id]].append(email)
+        return new_threads, [waves[num] for num in sorted(waves)]
+
+    def _write_one_by_one(self, entries):
+        written = []
+        for email, attachments in entries:
+            # reset what the failed batch may have set
+            email.id = None
+            email.parent = None
+            email.thread_id = None
+            if Email.objects.filter(mailinglist=self.mlist,
+                                    message_id=email.message_id).exists():
+                logger.info("Duplicate email with message-id '%s'",
+                            email.message_id)
+                continue
+            try:
+                with transaction.atomic():
+                    save_email(self.mlist, email, attachments)
+            except DatabaseError as e:
+                logger.warning("Message %s failed to import, skipping: %s",
+                               email.message_id, e)
+                continue
+            written.append(email)
+        return written
+
+
+def add_batch_to_list(list_name, messages):
+    """
+    Archive several messages to a list, like
+    :py:func:`hyperkitty.lib.incoming.add_to_list` but with a
+    :py:class:`BulkWriter` and in a single transaction.
+
+    :returns: a list with, for each message, its Message-ID hash if it is in
+        the archives, None if the list is not archived, or the exception
+        raised when the message was parsed or written.
+    """
+    mlist = MailingList.objects.get_or_create(name=list_name)[0]
+    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
+        mlist.update_from_mailman_if_stale()
+    if mlist.archive_policy == ArchivePolicy.never.value:
+        logger.info("Archiving disabled by list policy for %s", list_name)
+        return [None] * len(messages)
+    results = []
+    parsed = {} # message_id -> index of the first message with this id
+    writer = BulkWriter(mlist, batch_size=len(messages) + 1)
+    for message in messages:
+        try:
+            email, attachments = parse_message(list_name, message)
+        except Exception as e: # pylint: disable=broad-except
+            logger.warning("Could not parse a message for %s: %s",
+                           list_name, e)
+            results.append(e)
+            continue
+        results.append(email)
+        if email.message_id not in parsed:
+            parsed[email.message_id] = len(results) - 1
+            writer.add(email, attachments)
+    with transaction.atomic():
+        writer.flush()
+    # The duplicates are not written again but they are in the archives
+    archived = set()
+    for msg_ids in chunked(parsed):
+        archived.update(Email.objects.filter(
+            mailinglist=mlist, message_id__in=msg_ids
+            ).values_list("message_id", flat=True))
+    for index, result in enumerate(results):
+        if not isinstance(result, Email):
+            continue
+        if result.message_id in archived:
+            results[index] = result.message_id_hash
+        else:
+            results[index] = DatabaseError(
+                "Message %s could not be archived" % result.message_id)
+    return results
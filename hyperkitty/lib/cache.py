@@ -22,7 +22,16 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
 from django.core.cache import cache as django_cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 MISSING = object()
@@ -47,3 +56,68 @@ class CacheProxy:
 
 cache = CacheProxy()
 
+
+class RefreshScheduler(object):
+    """
+    Recompute the cached values some time after they have been invalidated,
+    in a background thread. A value invalidated several times during this
+    delay is only recomputed once.
+
+    The delay is set in seconds by the ``HYPERKITTY_CACHE_REFRESH_DELAY``
+    setting. If it is zero, the values are recomputed immediately.
+    """
+
+    def __init__(self):
+        self._pending = OrderedDict() # key -> function
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def schedule(self, key, fn):
+        """Call ``fn`` to recompute the value of ``key``."""
+        delay = getattr(settings, "HYPERKITTY_CACHE_REFRESH_DELAY", 10)
+        if not delay:
+            self._refresh(key, fn)
+            return
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending[key] = fn
+            if self._timer is None:
+                self._timer = threading.Timer(delay, self._run)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _run(self):
+        try:
+            self.flush()
+        finally:
+            # this thread's database connection won't be used again
+            connection.close()
+
+    def flush(self):
+        """Recompute all the pending values now."""
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for key, fn in pending.items():
+            self._refresh(key, fn)
+
+    def _refresh(self, key, fn):
+        try:
+            fn()
+        except ObjectDoesNotExist:
+            pass # it has been deleted in the meantime
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Could not refresh the cached value %s", key)
+
+    def cancel(self):
+        """Forget the pending values."""
+        with self._lock:
+            self._pending.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+refresh_scheduler = RefreshScheduler()
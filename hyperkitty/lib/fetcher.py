@@ -0,0 +1,258 @@
+#-*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+"""
+Download files concurrently, with an on-disk cache.
+
+This is used to download the attachments that Pipermail scrubbed from the
+archived messages.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import errno
+import httplib
+import os
+import socket
+import threading
+import urllib
+from hashlib import sha1
+from multiprocessing.pool import ThreadPool
+from urlparse import urlsplit, urljoin
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+MAX_REDIRECTS = 5
+# the file is not available on the server, don't try again
+MISSING = b"missing"
+
+
+class FetchCache(object):
+    """
+    A content-addressed on-disk cache. The files are stored under the SHA1
+    hash of their content, and each URL points to a content hash, so the same
+    file served under different URLs is stored only once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for subdir in ("objects", "urls"):
+            try:
+                os.makedirs(os.path.join(path, subdir))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _url_path(self, url):
+        return os.path.join(self.path, "urls",
+                            sha1(url.encode("utf-8")).hexdigest())
+
+    def _object_path(self, content_hash):
+        return os.path.join(self.path, "objects",
+                            content_hash[:2], content_hash[2:])
+
+    def _write(self, path, content):
+        # Write to a temporary file first, the cache may be read by other
+        # threads or processes
+        tmp_path = "%s.%d.%d.tmp" % (
+            path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, "wb") as tmp_file:
+            tmp_file.write(content)
+        os.rename(tmp_path, path)
+
+    def get(self, url):
+        """
+        :returns: a tuple with a boolean telling if the URL is in the cache,
+            and the content or None if the URL is known to be unavailable.
+        """
+        try:
+            with open(self._url_path(url), "rb") as url_file:
+                content_hash = url_file.read()
+        except IOError:
+            return False, None
+        if content_hash == MISSING:
+            return True, None
+        try:
+            with open(self._object_path(content_hash), "rb") as obj_file:
+                return True, obj_file.read()
+        except IOError:
+            return False, None
+
+    def set(self, url, content):
+        if content is None:
+            self._write(self._url_path(url), MISSING)
+            return
+        content_hash = sha1(content).hexdigest()
+        obj_path = self._object_path(content_hash)
+        if not os.path.exists(obj_path):
+            try:
+                os.mkdir(os.path.dirname(obj_path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self._write(obj_path, content)
+        self._write(self._url_path(url), content_hash.encode("ascii"))
+
+
+class Fetcher(object):
+    """
+    Download files in a pool of threads.
+
+    The connections to the HTTP servers are kept open and re-used by each
+    thread, and the number of concurrent downloads from a single host is
+    limited. The downloaded files are stored in a :py:class:`FetchCache`,
+    and a URL which is already being downloaded is not requested again.
+    """
+
+    def __init__(self, cache_dir, workers=8, per_host=2, timeout=30):
+        self.cache = FetchCache(cache_dir)
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._host_limits = {}
+        self._local = threading.local()
+        # all the open connections of the threads, to close them at the end
+        self._connections = set()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        with self._lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+
+    def prefetch(self, urls):
+        """Start downloading the URLs in the background."""
+        for url in urls:
+            self._submit(url)
+
+    def fetch(self, url):
+        """
+        :returns: the content of the URL, or None if it could not be
+            downloaded.
+        """
+        return self._submit(url).get()
+
+    def _submit(self, url):
+        with self._lock:
+            if url in self._in_flight:
+                return self._in_flight[url]
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            result = self._pool.apply_async(self._download, (url, ))
+            self._in_flight[url] = result
+            return result
+
+    def _download(self, url):
+        try:
+            in_cache, content = self.cache.get(url)
+            if in_cache:
+                return content
+            try:
+                content = self._get(url)
+            except (IOError, socket.error, httplib.HTTPException) as e:
+                # Network problem, it may work next time: don't cache it
+                logger.warning("Could not download %s: %s", url, e)
+                return None
+            self.cache.set(url, content)
+            return content
+        finally:
+            with self._lock:
+                self._in_flight.pop(url, None)
+
+    def _get_host_limit(self, host):
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(
+                    self.per_host)
+            return self._host_limits[host]
+
+    def _get_connection(self, scheme, netloc):
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        if (scheme, netloc) not in connections:
+            if scheme == "https":
+                conn_class = httplib.HTTPSConnection
+            else:
+                conn_class = httplib.HTTPConnection
+            conn = conn_class(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = conn
+            with self._lock:
+                self._connections.add(conn)
+        return connections[(scheme, netloc)]
+
+    def _drop_connection(self, scheme, netloc):
+        conn = self._local.connections.pop((scheme, netloc), None)
+        if conn is not None:
+            with self._lock:
+                self._connections.discard(conn)
+            conn.close()
+
+    def _get(self, url, redirects=0):
+        """
+        Download a URL.
+
+        :returns: the content of the URL, or None if it is not available.
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            return urllib.urlopen(url).read()
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        with self._get_host_limit(parts.netloc):
+            for attempt in range(2):
+                conn = self._get_connection(parts.scheme, parts.netloc)
+                try:
+                    conn.request("GET", path)
+                    response = conn.getresponse()
+                    content = response.read()
+                except (socket.error, httplib.HTTPException):
+                    self._drop_connection(parts.scheme, parts.netloc)
+                    # the server may have closed a kept-alive connection
+                    if attempt:
+                        raise
+                    continue
+                if response.will_close:
+                    self._drop_connection(parts.scheme, parts.netloc)
+                break
+        if response.status in (301, 302, 303, 307, 308) \
+                and redirects < MAX_REDIRECTS:
+            location = response.getheader("location")
+            if location:
+                return self._get(urljoin(url, location), redirects + 1)
+        if response.status in (404, 410):
+            logger.info("Could not download %s: HTTP status %d",
+                        url, response.status)
+            return None
+        if response.status != 200:
+            raise IOError("HTTP status %d" % response.status)
+        return content
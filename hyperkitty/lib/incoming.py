@@ -23,18 +23,19 @@ from __future__ import absolute_import, unicode_literals, division
 
 
 import re
+import time
 
 from django.conf import settings
 from django.utils import timezone
-from mailmanclient import MailmanConnectionError
 
 from hyperkitty.lib.signals import new_email, new_thread
 from hyperkitty.lib.utils import (get_message_id_hash, get_ref, parseaddr,
     parsedate, header_to_unicode, get_message_id)
 from hyperkitty.lib.scrub import Scrubber
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
+from hyperkitty.lib.analysis import (
+    compute_thread_order_and_depth, insert_in_thread_order)
 from hyperkitty.models import (MailingList, Sender, Email, Attachment, Thread,
-    ArchivePolicy)
+    ArchivePolicy, UnresolvedReply, update_threads_counts)
 
 import logging
 logger = logging.getLogger(__name__)
@@ -44,8 +45,7 @@ def add_to_list(list_name, message):
     #timeit("1 start")
     mlist = MailingList.objects.get_or_create(name=list_name)[0]
     if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
-        mlist.update_from_mailman()
-    mlist.save()
+        mlist.update_from_mailman_if_stale()
     if mlist.archive_policy == ArchivePolicy.never.value:
         logger.info("Archiving disabled by list policy for %s", list_name)
         return
@@ -56,7 +56,26 @@ def add_to_list(list_name, message):
     if Email.objects.filter(mailinglist=mlist, message_id=msg_id).count() > 0:
         logger.info("Duplicate email with message-id '%s'", msg_id)
         return get_message_id_hash(msg_id)
-    email = Email(mailinglist=mlist, message_id=msg_id)
+    email, attachments = parse_message(list_name, message)
+    save_email(mlist, email, attachments)
+    return email.message_id_hash
+
+
+def parse_message(list_name, message, timings=None):
+    """
+    Build an unsaved Email instance from a message, and extract its
+    attachments.
+
+    This function does not access the database, so it can be run in a
+    separate process. The email's sender is set to an unsaved Sender instance.
+
+    :arg timings: if a dict is given, the time spent scrubbing the message is
+        stored under the ``scrub`` key.
+    :returns: a tuple with the Email instance and the list of attachments.
+    """
+    if not message.has_key("Message-Id"):
+        raise ValueError("No 'Message-Id' header in email", message)
+    email = Email(mailinglist_id=list_name, message_id=get_message_id(message))
     email.in_reply_to = get_ref(message) # Find thread id
 
     # Sender
@@ -74,12 +93,7 @@ def add_to_list(list_name, message):
             sender_address = "{}@example.com".format(sender_address)
         else:
             sender_address = "unknown@example.com"
-    sender = Sender.objects.get_or_create(address=sender_address)[0]
-    sender.name = from_name # update the name if needed
-    sender.save()
-    email.sender = sender
-    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
-        set_sender_mailman_id(sender)
+    email.sender = Sender(address=sender_address, name=from_name)
     #timeit("3 after sender, before email content")
 
     # Headers
@@ -103,15 +117,37 @@ def add_to_list(list_name, message):
             ((utcoffset.days * 24 * 60 * 60) + utcoffset.seconds) / 60 )
 
     # Content
+    start = time.time()
     scrubber = Scrubber(list_name, message)
     # warning: scrubbing modifies the msg in-place
     email.content, attachments = scrubber.scrub()
+    if timings is not None:
+        timings["scrub"] = time.time() - start
+    # Render the content now, it does not need the database either
+    email.render_content()
     #timeit("4 after email content, before signals")
 
     # TODO: detect category?
 
+    return email, attachments
+
+
+def save_email(mlist, email, attachments):
+    """
+    Store an email built by :py:func:`parse_message` in the database, with its
+    sender, its thread and its attachments.
+    """
+    email.mailinglist = mlist
+    sender = Sender.objects.get_or_create(address=email.sender.address)[0]
+    sender.name = email.sender.name # update the name if needed
+    sender.save()
+    email.sender = sender
+
     set_or_create_thread(email)
     email.save()
+    reattached = False
+    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
+        reattached = reconcile_replies(email)
 
     # Signals
     new_email.send("Mailman", email=email)
@@ -128,7 +164,10 @@ def add_to_list(list_name, message):
     # compute thread props here because email must have been saved before
     # (there will be DB queries in this function)
     if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
-        compute_thread_order_and_depth(email.thread)
+        if reattached:
+            compute_thread_order_and_depth(email.thread)
+        else:
+            insert_in_thread_order(email)
 
     # Attachments (email must have been saved before)
     for attachment in attachments:
@@ -146,16 +185,7 @@ def add_to_list(list_name, message):
     #if self.search_index is not None:
     #    self.search_index.add(email)
 
-    return email.message_id_hash
-
-
-def set_sender_mailman_id(sender):
-    if sender.mailman_id is not None:
-        return
-    try:
-        sender.set_mailman_id()
-    except MailmanConnectionError:
-        return
+    return email
 
 
 def set_or_create_thread(email):
@@ -187,4 +217,76 @@ def set_or_create_thread(email):
     #            "Signal 'new_thread' to {} raised an exception: {}".format(
     #            receiver.func_name, result))
     email.thread = thread
-# TODO: check among the emails with an in_reply_to attribute non-empty but pointing to nothing if they should actually be attached to the current email (set their parent_id). This can happen if HK receives the reply before the original message (when a mail server in the chain has an issue, or in case of greylisting for example). To be disabled on bulk imports.
+
+
+def reconcile_replies(email):
+    """
+    Handle the replies received before the message they reply to, which can
+    happen if a mail server in the chain has an issue, or in case of
+    greylisting for example.
+
+    If the parent of the email has not been archived, the email is recorded
+    as an unresolved reply. If earlier replies to this email are waiting for
+    it, they are attached to it and their threads are merged into the email's
+    thread.
+
+    This is disabled on bulk imports.
+
+    :returns: True if earlier replies have been attached to the email.
+    """
+    if email.in_reply_to is not None and email.parent_id is None:
+        UnresolvedReply.objects.get_or_create(email=email, defaults={
+            "mailinglist": email.mailinglist,
+            "in_reply_to": email.in_reply_to})
+    unresolved = UnresolvedReply.objects.filter(
+        mailinglist=email.mailinglist, in_reply_to=email.message_id
+        ).select_related("email")
+    thread = email.thread
+    changed_threads = set()
+    for reply in unresolved:
+        orphan = reply.email
+        old_thread = orphan.thread
+        if old_thread.id == thread.id:
+            continue # they can't both be replies to each other
+        if orphan.parent_id is None:
+            # the orphan is the starting email of its thread, move the
+            # whole thread
+            moved = list(old_thread.emails.exclude(id=orphan.id))
+        else:
+            # the orphan has been attached to another thread since, only
+            # move its replies
+            moved = _get_replies(orphan)
+        orphan.parent = email
+        orphan.thread = thread
+        orphan.save()
+        for old_email in [orphan] + moved:
+            if old_email.thread_id != thread.id:
+                old_email.thread = thread
+                old_email.save()
+            if old_email.date > thread.date_active:
+                thread.date_active = old_email.date
+        thread.save()
+        if old_thread.emails.exists():
+            compute_thread_order_and_depth(old_thread)
+            changed_threads.add(old_thread.id)
+        else:
+            old_thread.delete()
+        changed_threads.add(thread.id)
+    unresolved.delete()
+    if changed_threads:
+        # the moved emails were not counted in their new thread
+        update_threads_counts(changed_threads)
+    return bool(changed_threads)
+
+
+def _get_replies(email):
+    """All the replies below the email in its thread."""
+    replies = []
+    parent_ids = [email.id]
+    while parent_ids:
+        children = list(Email.objects.filter(
+            thread_id=email.thread_id, parent_id__in=parent_ids))
+        replies.extend(children)
+        parent_ids = [ child.id for child in children ]
+    return replies
+
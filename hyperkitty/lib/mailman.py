@@ -21,7 +21,13 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import threading
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from urllib2 import HTTPError
+
 from django.conf import settings
+from django.db.models import Q
 from django.utils.timezone import now
 from mailmanclient import Client, MailmanConnectionError
 
@@ -31,6 +37,11 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# Default number of seconds before looking up again a sender which is not
+# a Mailman user
+SENDER_TTL = 7 * 24 * 3600
+
+
 MailmanClient = Client
 def get_mailman_client():
     # easier to patch during unit tests
@@ -65,34 +76,118 @@ class FakeMMList:
         self.created_at = now().isoformat()
 
 
-def sync_with_mailman():
-    from hyperkitty.models import MailingList, Sender
-    for mlist in MailingList.objects.all():
+class CircuitBreaker(object):
+    """
+    Stop calling Mailman for some time after several consecutive failures,
+    instead of waiting for a timeout on every call. The state is kept in the
+    cache, so it is shared between the processes.
+    """
+
+    def __init__(self, name, threshold=5, cooldown=300):
+        self.key = "CircuitBreaker:%s:open" % name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        return bool(cache.get(self.key))
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                logger.warning("Mailman is not responding, not calling it "
+                               "again for %d seconds", self.cooldown)
+                cache.set(self.key, True, self.cooldown)
+                self.failures = 0
+
+
+def _get_mailman_user_id(address, breaker):
+    """
+    :returns: a tuple with a boolean telling if Mailman answered, and the
+        user id or None if the address is not a Mailman user.
+    """
+    if breaker.is_open():
+        return False, None
+    try:
+        mm_user = get_mailman_client().get_user(address)
+    except HTTPError, e:
+        if e.code == 404:
+            breaker.success()
+            return True, None
+        breaker.failure()
+        return False, None
+    except (MailmanConnectionError, IOError):
+        breaker.failure()
+        return False, None
+    breaker.success()
+    return True, mm_user.user_id
+
+
+def set_senders_mailman_id(batch_size=100, jobs=4):
+    """
+    Get the Mailman user id of the senders which don't have one yet. The
+    senders are processed in batches, with several requests to Mailman at
+    the same time, until Mailman stops responding. The senders which are not
+    Mailman users are looked up again after HYPERKITTY_MAILMAN_SENDER_TTL
+    seconds.
+
+    :returns: the number of senders which have been found in Mailman.
+    """
+    from hyperkitty.models import Sender
+    breaker = CircuitBreaker("mailman_users")
+    checked_before = now() - timedelta(seconds=getattr(
+        settings, "HYPERKITTY_MAILMAN_SENDER_TTL", SENDER_TTL))
+    query = Sender.objects.filter(mailman_id__isnull=True).filter(
+        Q(mailman_checked__isnull=True) |
+        Q(mailman_checked__lt=checked_before)).order_by("address")
+    found = 0
+    last_address = None
+    pool = ThreadPool(jobs)
+    try:
+        while not breaker.is_open():
+            batch = query
+            if last_address is not None:
+                batch = batch.filter(address__gt=last_address)
+            addresses = list(batch.values_list("address", flat=True)[
+                :batch_size])
+            if not addresses:
+                break # all done
+            last_address = addresses[-1]
+            results = pool.map(
+                lambda address: _get_mailman_user_id(address, breaker),
+                addresses)
+            not_users = []
+            for address, (checked, user_id) in zip(addresses, results):
+                if user_id is not None:
+                    Sender.objects.filter(address=address).update(
+                        mailman_id=user_id, mailman_checked=now())
+                    found += 1
+                elif checked:
+                    not_users.append(address)
+            Sender.objects.filter(address__in=not_users).update(
+                mailman_checked=now())
+            logger.info("%d senders found in Mailman", found)
+    finally:
+        pool.close()
+        pool.join()
+    return found
+
+
+def sync_with_mailman(list_addresses=None):
+    from hyperkitty.models import MailingList
+    mlists = MailingList.objects.all()
+    if list_addresses:
+        mlists = mlists.filter(name__in=list_addresses)
+    for mlist in mlists:
+        # If Mailman can't be reached, update the list on the next message
+        # instead of keeping the stale properties
+        mlist.invalidate_mailman_cache()
         mlist.update_from_mailman()
     # Now sync Sender.mailman_id with Mailman's User.user_id
-    # There can be thousands of senders, break into smaller chuncks to avoid
-    # hogging up the memory
-    buffer_size = 1000
-    query = Sender.objects.filter(mailman_id__isnull=True)
-    prev_count = query.count()
-    lower_bound = 0
-    upper_bound = buffer_size
-    while True:
-        try:
-            for sender in query[lower_bound:upper_bound]:
-                sender.set_mailman_id()
-        except MailmanConnectionError:
-            break # Can't refresh at this time
-        count = query.count()
-        if count == 0:
-            break # all done
-        if count == prev_count:
-            # no improvement...
-            if count < upper_bound:
-                break # ...and all users checked
-            else:
-                # there may be some more left
-                lower_bound = upper_bound
-                upper_bound += buffer_size
-        prev_count = count
-        logger.info("%d emails left to refresh", count)
+    set_senders_mailman_id()
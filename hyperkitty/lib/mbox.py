@@ -0,0 +1,215 @@
+#-*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+"""
+Read the messages of large mbox files without loading them in memory.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import mmap
+import os
+import zlib
+
+
+SEPARATOR = b"\nFrom "
+READ_SIZE = 64 * 1024
+
+
+def open_mbox(path):
+    """
+    Open an mbox file with the appropriate reader: gzipped files are
+    decompressed on the fly.
+    """
+    if path.endswith(".gz"):
+        return GzipMboxReader(path)
+    return MboxReader(path)
+
+
+def read_chunks(fileobj, size=READ_SIZE):
+    """Read a file-like object (a file, an HTTP response...) by chunks."""
+    return iter(lambda: fileobj.read(size), b"")
+
+
+def gunzip_chunks(chunks):
+    """Decompress a stream of gzipped data, chunk by chunk."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def _lines(chunks):
+    pending = b""
+    for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if pending:
+        yield pending
+
+
+def split_mbox(chunks):
+    """
+    Split a stream of mbox data into messages. Only one message is kept in
+    memory at a time.
+
+    :arg chunks: an iterator on the mbox data, in chunks of any size.
+    :returns: an iterator on tuples with the message, without its ``From``
+        line, and the offset of its end in the stream, like
+        :py:meth:`MboxReader.messages`.
+    """
+    position = 0
+    message = None # no message before the first From line
+    for line in _lines(chunks):
+        if line.startswith(b"From "):
+            if message is not None:
+                yield _end_message(message), position
+            message = []
+        elif message is not None:
+            message.append(line)
+        position += len(line)
+    if message is not None:
+        yield _end_message(message), position
+
+
+def _end_message(lines):
+    message = b"".join(lines)
+    # the empty line before the next separator is not part of the message
+    if message.endswith(b"\n\n"):
+        message = message[:-1]
+    return message
+
+
+class MboxReader(object):
+    """
+    Read the messages of an mbox file lazily, in a single pass.
+
+    Contrary to :py:class:`mailbox.mbox`, the table of contents is not built
+    beforehand: the file is memory-mapped and the ``From`` separators are
+    searched for while the messages are read, so the memory usage does not
+    depend on the size of the file.
+
+    The messages are returned as strings without the ``From`` line, like
+    :py:meth:`mailbox.mbox.get_string` does.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self._file = open(path, "rb")
+        self._map = None
+        if self.size:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _find_start(self, offset):
+        """Find the first message starting at or after the offset."""
+        if self._map[offset:offset+5] == b"From " and (
+                offset == 0 or self._map[offset-1:offset] == b"\n"):
+            return offset
+        start = self._map.find(SEPARATOR, max(offset - 1, 0))
+        if start == -1:
+            return None
+        return start + 1
+
+    def messages(self, offset=0):
+        """
+        Yield the messages found after the offset.
+
+        :arg offset: the position in the file where the search for the first
+            message starts. It does not need to be the exact start of a
+            message.
+        :returns: an iterator on tuples with the message and the offset of
+            its end, which is the start of the next message.
+        """
+        if self._map is None:
+            return
+        start = self._find_start(offset)
+        if start is None:
+            return
+        while start < self.size:
+            stop = self._map.find(SEPARATOR, start)
+            if stop == -1:
+                stop = self.size
+            else:
+                stop += 1
+            # skip the From line
+            headers_start = self._map.find(b"\n", start, stop) + 1 or stop
+            message = self._map[headers_start:stop]
+            # the empty line before the next separator is not part of the
+            # message
+            if message.endswith(b"\n\n"):
+                message = message[:-1]
+            yield message, stop
+            start = stop
+
+
+class GzipMboxReader(object):
+    """
+    Read the messages of a gzipped mbox file, decompressing it on the fly.
+    The offsets refer to the decompressed data. The decompressed size is not
+    known in advance, so the ``size`` attribute is None.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = None
+        self._file = open(path, "rb")
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def messages(self, offset=0):
+        """
+        Yield the messages found after the offset, see
+        :py:meth:`MboxReader.messages`. The data before the offset still
+        has to be decompressed, but the messages are not returned.
+        """
+        self._file.seek(0)
+        for message, stop in split_mbox(gunzip_chunks(
+                read_chunks(self._file))):
+            if stop <= offset:
+                continue
+            yield message, stop
@@ -0,0 +1,49 @@
+#-*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+"""
+Render the body of the emails to HTML when they are archived, instead of
+running the template filters each time they are displayed.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from django.template.defaultfilters import urlizetrunc, wordwrap
+
+from hyperkitty.templatetags.hk_generic import (
+    escapeemail, snip_quoted, snip_pgp)
+
+
+# Increase this number when the output of render_body() changes, the emails
+# rendered by a previous version will be rendered again.
+RENDERER_VERSION = 1
+
+
+def render_body(content):
+    """
+    Render the body of an email to HTML, like the template filters did:
+    ``snip_quoted|snip_pgp|wordwrap:90|urlizetrunc:76|escapeemail``.
+    """
+    html = snip_quoted(content, autoescape=True)
+    html = snip_pgp(html, autoescape=True)
+    html = wordwrap(html, 90)
+    html = urlizetrunc(html, 76, autoescape=True)
+    return escapeemail(html)
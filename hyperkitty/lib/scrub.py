@@ -22,11 +22,15 @@ from __future__ import absolute_import, unicode_literals
 import os
 import re
 import binascii
+import quopri
+from tempfile import SpooledTemporaryFile
 from types import IntType
 from mimetypes import guess_all_extensions
 from email.header import decode_header, make_header
 from email.errors import HeaderParseError
 
+from django.conf import settings
+
 # Path characters for common platforms
 pre = re.compile(r'[/\\:]')
 # All other characters to strip out of Content-Disposition: filenames
@@ -39,6 +43,17 @@ BR = '<br>\n'
 
 NEXT_PART = re.compile(r'--------------[ ]next[ ]part[ ]--------------\n')
 
+# Default maximum size of an attachment, and of all the attachments of a
+# message. The larger attachments are not archived.
+ATTACHMENT_MAX_SIZE = 20 * 1024 * 1024
+MESSAGE_ATTACHMENTS_MAX_SIZE = 40 * 1024 * 1024
+# The attachments are decoded by chunks of this size into temporary files,
+# which are kept in memory up to SPOOL_SIZE bytes.
+DECODE_CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+
+BASE64_IGNORED = re.compile(r"[^A-Za-z0-9+/=]")
+
 
 def guess_extension(ctype, ext):
     # mimetypes maps multiple extensions to the same type, e.g. .doc, .dot,
@@ -51,6 +66,10 @@ def guess_extension(ctype, ext):
     return all_exts and all_exts[0]
 
 
+# Tried in this order when the charset is not declared
+GUESSED_CHARSETS = ["ascii", "utf-8", "iso-8859-15"]
+
+
 def get_charset(message, default="ascii", guess=False):
     """
     Get the message charset.
@@ -65,7 +84,7 @@ def get_charset(message, default="ascii", guess=False):
         return charset
     # Try to guess the encoding (best effort mode)
     text = message.get_payload(decode=True)
-    for encoding in ["ascii", "utf-8", "iso-8859-15"]:
+    for encoding in GUESSED_CHARSETS:
         try:
             text.decode(encoding)
         except UnicodeDecodeError:
@@ -76,6 +95,165 @@ def get_charset(message, default="ascii", guess=False):
     return charset
 
 
+def decode_text(text, charset=None):
+    """
+    Decode a text payload with its declared charset. If there is none, the
+    text is decoded with the first of the guessed charsets which works, like
+    ``get_charset(message, guess=True)`` would find it.
+    """
+    if charset is None:
+        for encoding in GUESSED_CHARSETS:
+            try:
+                return text.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+        charset = "ascii"
+    try:
+        return text.decode(charset, "replace")
+    except (UnicodeError, LookupError, ValueError, AssertionError):
+        return text.decode('ascii', 'replace')
+
+
+class AttachmentPlaceholder(object):
+    """
+    Stands for the content of an attachment which was too large to be
+    archived.
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def __eq__(self, other):
+        return isinstance(other, AttachmentPlaceholder) and \
+               other.size == self.size
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<AttachmentPlaceholder size=%d>" % self.size
+
+
+def _content_from_bytes(data):
+    content = AttachmentContent()
+    content.write(data)
+    return content
+
+
+class AttachmentContent(object):
+    """
+    The decoded content of an attachment, in a temporary file which is only
+    kept in memory when it is small.
+    """
+
+    def __init__(self):
+        self.file = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def chunks(self, chunk_size=DECODE_CHUNK_SIZE):
+        self.file.seek(0)
+        while True:
+            data = self.file.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return self.size
+
+    def __eq__(self, other):
+        if isinstance(other, AttachmentContent):
+            other = other.read()
+        return isinstance(other, basestring) and self.read() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        # the temporary file can't be sent to another process
+        return (_content_from_bytes, (self.read(), ))
+
+    def __repr__(self):
+        return "<AttachmentContent size=%d>" % self.size
+
+
+def _base64_chunks(payload):
+    pending = b""
+    for start in range(0, len(payload), DECODE_CHUNK_SIZE):
+        data = pending + BASE64_IGNORED.sub(
+            "", payload[start:start+DECODE_CHUNK_SIZE])
+        # decode full quanta only
+        usable = len(data) - len(data) % 4
+        pending = data[usable:]
+        if usable:
+            yield binascii.a2b_base64(data[:usable])
+    if pending:
+        yield binascii.a2b_base64(pending)
+
+
+def _quoted_printable_chunks(payload):
+    start = 0
+    while start < len(payload):
+        # stop at the end of a line
+        stop = payload.find("\n", start + DECODE_CHUNK_SIZE)
+        stop = len(payload) if stop == -1 else stop + 1
+        yield quopri.decodestring(payload[start:stop])
+        start = stop
+
+
+def decode_payload(part, max_size=None):
+    """
+    Decode the payload of a MIME part by chunks into an
+    :py:class:`AttachmentContent`, like ``part.get_payload(decode=True)`` but
+    without holding the decoded content in memory.
+
+    :returns: a tuple with the decoded content, or None if it is larger than
+        ``max_size``, and its size.
+    """
+    payload = part.get_payload()
+    cte = part.get('content-transfer-encoding', '').lower()
+    if cte == 'base64':
+        chunks = _base64_chunks(payload)
+    elif cte == 'quoted-printable':
+        chunks = _quoted_printable_chunks(payload)
+    elif cte in ('x-uuencode', 'uuencode', 'uue', 'x-uue'):
+        # rare enough to be decoded in one go
+        chunks = [part.get_payload(decode=True)]
+    else:
+        chunks = ( payload[start:start+DECODE_CHUNK_SIZE]
+                   for start in range(0, len(payload), DECODE_CHUNK_SIZE) )
+    decoded = AttachmentContent()
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            # keep counting when the content is too large, to record its size
+            if max_size is None or size <= max_size:
+                decoded.write(chunk)
+    except binascii.Error:
+        # Incorrect padding, the payload is returned as-is
+        decoded.close()
+        decoded = AttachmentContent()
+        size = len(payload)
+        if max_size is None or size <= max_size:
+            decoded.write(payload)
+    if max_size is not None and size > max_size:
+        decoded.close()
+        return None, size
+    return decoded, size
+
+
 def oneline(s):
     """Inspired by mailman.utilities.string.oneline"""
     try:
@@ -97,9 +275,45 @@ class Scrubber(object):
     def __init__(self, mlist, msg):
         self.mlist = mlist
         self.msg = msg
+        self.attachment_max_size = getattr(settings,
+            "HYPERKITTY_ATTACHMENT_MAX_SIZE", ATTACHMENT_MAX_SIZE)
+        self.message_attachments_max_size = getattr(settings,
+            "HYPERKITTY_MESSAGE_ATTACHMENTS_MAX_SIZE",
+            MESSAGE_ATTACHMENTS_MAX_SIZE)
+        self.attachments_size = 0
 
 
     def scrub(self):
+        if self._is_inline_text():
+            return (self._scrub_inline_text(), [])
+        return self._scrub_parts()
+
+
+    def _is_inline_text(self):
+        """
+        Most messages are a single text/plain part, which can be scrubbed
+        without walking over the parts.
+        """
+        if self.msg.is_multipart() or \
+                self.msg.get_content_type() != 'text/plain':
+            return False
+        disposition = self.msg.get('content-disposition')
+        return not (disposition and disposition.decode("ascii", "replace"
+                    ).strip().startswith("attachment"))
+
+
+    def _scrub_inline_text(self):
+        # Don't guess the charset beforehand, it would decode the payload
+        # several times
+        charset = get_charset(self.msg, default=None)
+        text = decode_text(self.msg.get_payload(decode=True), charset)
+        next_part_match = NEXT_PART.search(text)
+        if next_part_match:
+            text = text[0:next_part_match.start(0)]
+        return text
+
+
+    def _scrub_parts(self):
         attachments = []
         sanitize = 1 # TODO: implement other options
         #outer = True
@@ -164,19 +378,11 @@ class Scrubber(object):
             # If the message isn't a multipart, then we'll strip it out as an
             # attachment that would have to be separately downloaded.
             elif part.get_payload() and not part.is_multipart():
-                payload = part.get_payload(decode=True)
-                ctype = part.get_content_type()
-                if not isinstance(ctype, unicode):
-                    ctype.decode("ascii")
-                # XXX Under email 2.5, it is possible that payload will be None.
-                # This can happen when you have a Content-Type: multipart/* with
-                # only one part and that part has two blank lines between the
-                # first boundary and the end boundary.  In email 3.0 you end up
-                # with a string in the payload.  I think in this case it's safe to
-                # ignore the part.
-                if payload is None:
-                    continue
+                # The decoded payload of a part which is not a multipart is
+                # never None, don't decode it here.
                 attachments.append(self.parse_attachment(part, part_num))
+                # The content has been decoded, free the encoded payload
+                part.set_payload('')
             #outer = False
         # We still have to sanitize multipart messages to flat text because
         # Pipermail can't handle messages with list payloads.  This is a kludge;
@@ -244,8 +450,7 @@ class Scrubber(object):
     def parse_attachment(self, part, counter, filter_html=True):
         # pylint: disable=unused-argument
         # Store name, content-type and size
-        # Figure out the attachment type and get the decoded data
-        decodedpayload = part.get_payload(decode=True)
+        # Figure out the attachment type
         # BAW: mimetypes ought to handle non-standard, but commonly found types,
         # e.g. image/jpg (should be image/jpeg).  For now we just store such
         # things as application/octet-streams since that seems the safest.
@@ -302,10 +507,28 @@ class Scrubber(object):
             # The extension was removed from the name above.
             filebase = filename
         # TODO: bring back the HTML sanitizer feature
+        max_size = self.attachment_max_size
+        if self.message_attachments_max_size is not None:
+            remaining = max(self.message_attachments_max_size
+                            - self.attachments_size, 0)
+            max_size = remaining if max_size is None \
+                       else min(max_size, remaining)
         if ctype == 'message/rfc822':
             submsg = part.get_payload()
             # Don't HTML-escape it, this is the frontend's job
             ## BAW: I'm sure we can eventually do better than this. :(
             #decodedpayload = websafe(str(submsg))
             decodedpayload = str(submsg)
+            size = len(decodedpayload)
+            if max_size is not None and size > max_size:
+                decodedpayload = None
+            else:
+                decodedpayload = _content_from_bytes(decodedpayload)
+        else:
+            # Get the decoded data
+            decodedpayload, size = decode_payload(part, max_size)
+        if decodedpayload is None:
+            decodedpayload = AttachmentPlaceholder(size)
+        else:
+            self.attachments_size += size
         return (counter, filebase+ext, ctype, charset, decodedpayload)
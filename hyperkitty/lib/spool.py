@@ -0,0 +1,216 @@
+#-*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+"""
+A directory where the messages sent by Mailman wait to be archived.
+
+The messages are written with the usual maildir-like dance: in a temporary
+directory first, then synced to the disk and renamed into the directory of
+their mailing-list. Their names start with their arrival time, so the
+messages of a list are archived in the order they were received. A list is
+processed by a single worker at a time, which holds a lock on its directory.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import errno
+import fcntl
+import os
+import shutil
+import time
+from email import message_from_string
+from urllib import quote, unquote
+from uuid import uuid4
+
+from django.db import connection, DataError, Error, IntegrityError
+
+from hyperkitty.lib.incoming import add_to_list
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+SUFFIX = ".eml"
+LOCK_NAME = ".lock"
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def archive_message(list_name, data):
+    """Archive a message read from the spool."""
+    add_to_list(list_name, message_from_string(data))
+
+
+class Spool(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_dir = os.path.join(path, "tmp")
+        self.new_dir = os.path.join(path, "new")
+        self.failed_dir = os.path.join(path, "failed")
+
+    def _list_dir(self, list_name, base=None):
+        return os.path.join(base or self.new_dir,
+                            quote(list_name.encode("utf-8"), safe=b"@"))
+
+    def put(self, list_name, data):
+        """
+        Store a message for the list, given as a string or as an iterable of
+        chunks. The message is on the disk when this method returns.
+        """
+        list_dir = self._list_dir(list_name)
+        _makedirs(self.tmp_dir)
+        _makedirs(list_dir)
+        # The name sorts in arrival order
+        name = "%017.6f-%d-%s%s" % (time.time(), os.getpid(), uuid4().hex,
+                                    SUFFIX)
+        tmp_path = os.path.join(self.tmp_dir, name)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        if isinstance(data, basestring):
+            data = [data]
+        try:
+            for chunk in data:
+                while chunk:
+                    chunk = chunk[os.write(fd, chunk):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        path = os.path.join(list_dir, name)
+        os.rename(tmp_path, path)
+        _fsync_dir(list_dir)
+        return path
+
+    def lists(self):
+        """The lists which have a directory in the spool."""
+        if not os.path.isdir(self.new_dir):
+            return []
+        return [ unquote(name.encode("utf-8")).decode("utf-8")
+                 for name in sorted(os.listdir(self.new_dir)) ]
+
+    def pending(self, list_name):
+        """The names of the messages waiting for the list, oldest first."""
+        try:
+            names = os.listdir(self._list_dir(list_name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        return sorted(name for name in names if name.endswith(SUFFIX))
+
+    def depth(self):
+        """The number of messages waiting for each list."""
+        return dict( (list_name, len(self.pending(list_name)))
+                     for list_name in self.lists() )
+
+    def _lock(self, list_name):
+        """
+        Lock the list's directory, or return None if another worker already
+        holds the lock.
+        """
+        lock = open(os.path.join(self._list_dir(list_name), LOCK_NAME), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            lock.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return lock
+
+    def _move_to_failed(self, list_name, name):
+        failed_dir = self._list_dir(list_name, self.failed_dir)
+        _makedirs(failed_dir)
+        shutil.move(os.path.join(self._list_dir(list_name), name),
+                    os.path.join(failed_dir, name))
+
+    def process(self, list_name, handler=archive_message):
+        """
+        Give the messages of a list to the handler, in order, unless another
+        worker is already processing this list. The messages which could not
+        be handled are moved to the ``failed`` directory.
+
+        When the database is unavailable, the message stays in the spool, the
+        connection is closed and the database error is raised again: the
+        caller should wait before retrying.
+
+        :returns: the number of messages processed.
+        """
+        lock = self._lock(list_name)
+        if lock is None:
+            return 0
+        count = 0
+        try:
+            while True:
+                names = self.pending(list_name)
+                if not names:
+                    break
+                for name in names:
+                    path = os.path.join(self._list_dir(list_name), name)
+                    with open(path, "rb") as msgfile:
+                        data = msgfile.read()
+                    try:
+                        handler(list_name, data)
+                    except (IntegrityError, DataError):
+                        # The message's data was refused, retrying would
+                        # fail again
+                        logger.exception("Could not archive %s to %s",
+                                         path, list_name)
+                        self._move_to_failed(list_name, name)
+                    except Error:
+                        logger.exception("The database is unavailable, %s "
+                                         "will be archived later", path)
+                        connection.close()
+                        raise
+                    except Exception: # pylint: disable=broad-except
+                        logger.exception("Could not archive %s to %s",
+                                         path, list_name)
+                        self._move_to_failed(list_name, name)
+                    else:
+                        os.remove(path)
+                    count += 1
+        finally:
+            lock.close()
+        return count
+
+    def drain(self, handler=archive_message, lists=None):
+        """
+        Process the messages of all the lists which are not locked by another
+        worker.
+
+        :returns: the number of messages processed.
+        """
+        if lists is None:
+            lists = self.lists()
+        return sum(self.process(list_name, handler) for list_name in lists)
@@ -0,0 +1,225 @@
+#-*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+"""
+Store the content of the attachments outside of the database.
+
+The contents are identified by their hash, so an attachment sent to several
+lists is only stored once. The store does not count the references to a
+content: the attachments in the database are the references, see the
+``Attachment`` model. The contents which are not referenced anymore are
+removed later by ``delete_unreferenced()``, not when the attachments are
+deleted: the deletion could be rolled back, and the content could be stored
+again by a transaction which is not committed yet.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import errno
+import os
+import time
+from hashlib import sha256
+from uuid import uuid4
+
+from django.conf import settings
+from django.utils.module_loading import import_by_path
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# The contents modified more recently than this number of seconds are never
+# removed, they may be referenced by a transaction which is not committed yet.
+GRACE_PERIOD = 24 * 3600
+# The contents are copied to the store by chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def get_content_hash(content):
+    return unicode(sha256(content).hexdigest())
+
+
+def get_attachment_store():
+    """
+    Return the configured attachment store, or None if the attachments are
+    kept in the database.
+    """
+    folder = getattr(settings, "HYPERKITTY_ATTACHMENT_FOLDER", None)
+    if not folder:
+        return None
+    store_class = import_by_path(getattr(settings,
+        "HYPERKITTY_ATTACHMENT_STORE", "hyperkitty.lib.storage.FileSystemStore"))
+    return store_class(folder)
+
+
+class FileSystemStore(object):
+    """
+    Store the contents in files named after their hash, in a two-level tree
+    of directories.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, content_hash):
+        return os.path.join(self.folder, content_hash[:2], content_hash[2:4],
+                            content_hash)
+
+    def exists(self, content_hash):
+        return os.path.exists(self.path(content_hash))
+
+    def _refresh(self, path):
+        """
+        Refresh the modification time of an existing content, so it survives
+        the next garbage collection.
+
+        :returns: False if the content does not exist.
+        """
+        try:
+            os.utime(path, None)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def _write(self, tmp_path, chunks):
+        """Write the chunks to a new file and return their hash."""
+        hasher = sha256()
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        try:
+            for data in chunks:
+                hasher.update(data)
+                while data:
+                    data = data[os.write(fd, data):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return unicode(hasher.hexdigest())
+
+    def put(self, content):
+        """
+        Store a content, unless it is already there. The content is a string
+        or a file, which is read by chunks and hashed while it is copied.
+
+        :returns: the hash of the content.
+        """
+        if not hasattr(content, "read"):
+            content = bytes(content)
+            content_hash = get_content_hash(content)
+            if self._refresh(self.path(content_hash)):
+                return content_hash
+            chunks = [content]
+        else:
+            chunks = iter(lambda: content.read(CHUNK_SIZE), b"")
+        _makedirs(self.folder)
+        # Write to a temporary file first, so the content is never read
+        # partially written
+        tmp_path = os.path.join(self.folder, "%s.tmp" % uuid4().hex)
+        try:
+            content_hash = self._write(tmp_path, chunks)
+            path = self.path(content_hash)
+            if not self._refresh(path):
+                _makedirs(os.path.dirname(path))
+                os.rename(tmp_path, path)
+        finally:
+            # already stored, or interrupted
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return content_hash
+
+    def open(self, content_hash):
+        """Open the content for reading."""
+        return open(self.path(content_hash), "rb")
+
+    def get(self, content_hash):
+        with self.open(content_hash) as content_file:
+            return content_file.read()
+
+    def hashes(self, older_than=0):
+        """
+        Iterate over the hashes of the contents which were not modified in
+        the last ``older_than`` seconds.
+        """
+        limit = time.time() - older_than
+        for dirpath, _dirnames, filenames in os.walk(self.folder):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                try:
+                    mtime = os.path.getmtime(os.path.join(dirpath, filename))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                if mtime <= limit:
+                    yield filename
+
+    def delete(self, content_hash, older_than=0):
+        """
+        Delete a content, unless it was modified in the last ``older_than``
+        seconds.
+        """
+        path = self.path(content_hash)
+        try:
+            if older_than and \
+                    os.path.getmtime(path) > time.time() - older_than:
+                return
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            logger.warning("The attachment content %s was already deleted",
+                           content_hash)
+
+
+def delete_unreferenced(store, grace_period=GRACE_PERIOD, batch_size=500):
+    """
+    Remove the contents which no attachment refers to anymore. The contents
+    modified during the grace period are kept.
+
+    :returns: the number of contents removed.
+    """
+    from hyperkitty.models import Attachment # circular import
+    hashes = store.hashes(older_than=grace_period)
+    deleted = 0
+    while True:
+        batch = [ content_hash for _i, content_hash
+                  in zip(range(batch_size), hashes) ]
+        if not batch:
+            break
+        referenced = set(Attachment.objects.filter(
+            content_hash__in=batch, content__isnull=True
+            ).values_list("content_hash", flat=True))
+        for content_hash in batch:
+            if content_hash in referenced:
+                continue
+            store.delete(content_hash, older_than=grace_period)
+            deleted += 1
+    return deleted
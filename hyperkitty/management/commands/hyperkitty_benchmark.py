@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+
+"""
+Measure the import throughput with a generated mailbox.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from hyperkitty.lib.benchmark import (
+    MboxGenerator, run_import_benchmark, run_scrub_benchmark)
+from hyperkitty.management.commands.hyperkitty_import import DbImporter
+from hyperkitty.models import Email
+
+
+class Command(BaseCommand):
+    help = ("Import a generated mailbox and report the throughput of each "
+            "stage in JSON. Use a scratch database, the imported emails are "
+            "not removed.")
+    option_list = BaseCommand.option_list + (
+        make_option('-l', '--list-address',
+            help="the list the mailbox will be imported to (default: a new "
+                 "list for each run)"),
+        make_option('-n', '--messages', type="int", default=1000,
+            help="number of messages to generate (default: %default)"),
+        make_option('--thread-depth', type="int", default=5,
+            help="maximum depth of the threads (default: %default)"),
+        make_option('--attachment-ratio', type="float", default=0.1,
+            help="proportion of messages with an attachment "
+                 "(default: %default)"),
+        make_option('--charsets', default="us-ascii,utf-8,iso-8859-1,koi8-r",
+            help="comma-separated list of the charsets used in the "
+                 "messages (default: %default)"),
+        make_option('--seed', type="int", default=0,
+            help="seed of the random generator (default: %default)"),
+        make_option('--mbox',
+            help="use this mbox file instead of generating one"),
+        make_option('-j', '--jobs', type="int", default=1,
+            help="number of processes used to parse the messages "
+                 "(default: %default)"),
+        make_option('--batch-size', type="int", default=100,
+            help="number of messages written to the database in a single "
+                 "transaction (default: %default)"),
+        make_option('--scrub', action="store_true", default=False,
+            help="only measure the scrubbing of the messages, with and "
+                 "without the fast path for single-part text messages. "
+                 "Nothing is written to the database."),
+        make_option('-o', '--output',
+            help="write the report to this file instead of the standard "
+                 "output"),
+        )
+
+    def handle(self, *args, **options):
+        options["verbosity"] = int(options.get("verbosity", "1"))
+        logging.basicConfig(format='%(message)s', level=logging.WARNING)
+        if args:
+            raise CommandError("no arguments allowed")
+        list_address = options["list_address"] or \
+            "benchmark-%d@example.com" % time.time()
+        if not options["scrub"] and \
+                Email.objects.filter(mailinglist__name=list_address).exists():
+            raise CommandError("The list %s already has emails, the "
+                               "benchmark needs an empty list" % list_address)
+        tmpdir = tempfile.mkdtemp(prefix="hyperkitty-benchmark-")
+        try:
+            mbfile = options["mbox"]
+            parameters = {"mbox": mbfile}
+            if mbfile is None:
+                mbfile = os.path.join(tmpdir, "benchmark.mbox")
+                parameters = dict(
+                    (name, options[name]) for name in
+                    ("messages", "thread_depth", "attachment_ratio",
+                     "seed"))
+                parameters["charsets"] = options["charsets"].split(",")
+                try:
+                    generator = MboxGenerator(
+                        options["thread_depth"], options["attachment_ratio"],
+                        parameters["charsets"], options["seed"])
+                except ValueError, e:
+                    raise CommandError(e)
+                generator.generate(mbfile, options["messages"])
+            if options["scrub"]:
+                report = run_scrub_benchmark(mbfile)
+            else:
+                parameters.update({
+                    "jobs": options["jobs"],
+                    "batch_size": options["batch_size"],
+                    })
+                importer = DbImporter(list_address, {
+                    "no_download": True,
+                    "verbosity": 0,
+                    "jobs": options["jobs"],
+                    "batch_size": options["batch_size"],
+                    "index_size": 1000000,
+                    })
+                report = run_import_benchmark(importer, mbfile)
+        finally:
+            shutil.rmtree(tmpdir)
+        report["parameters"] = parameters
+        report = json.dumps(report, indent=2, sort_keys=True,
+                            separators=(",", ": "))
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                output.write(report + "\n")
+        else:
+            self.stdout.write(report)
@@ -25,15 +25,20 @@ Import the content of a mbox file into the database.
 
 from __future__ import absolute_import, print_function, unicode_literals, division
 
+import json
 import mailbox
 import os
 import re
-import urllib
 import logging
+import shutil
 import sys
+import tempfile
+import time
+import traceback
+from collections import defaultdict, deque, OrderedDict
+from itertools import imap, islice, starmap
+from multiprocessing import Pool
 from optparse import make_option
-from email.utils import unquote
-from traceback import print_exc
 from math import floor
 
 
@@ -41,14 +46,17 @@ from dateutil.parser import parse as parse_date
 from dateutil import tz
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.db import Error as DatabaseError
-from django.utils.timezone import utc
+from django.db import connection
+from django.utils.timezone import utc, now
 
-from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.lib.incoming import parse_message
+from hyperkitty.lib.bulk import BulkWriter, MessageIdIndex
+from hyperkitty.lib.fetcher import Fetcher
+from hyperkitty.lib.mbox import open_mbox
 from hyperkitty.lib.mailman import sync_with_mailman
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
-from hyperkitty.lib.utils import get_message_id
-from hyperkitty.models import Email, Attachment, Thread
+from hyperkitty.lib.analysis import compute_threads_order_and_depth
+from hyperkitty.models import (Email, MailingList, ArchivePolicy,
+    update_threads_counts)
 
 #from hyperkitty.lib.utils import timeit, showtimes
 
@@ -90,6 +98,13 @@ U(?:rl|RL)[ ]?:[ ]([^\s]+)\s*\n
 
 TEXTWRAP_RE = re.compile(r"\n\s*")
 
+# Number of messages sent to a worker process at once
+CHUNK_SIZE = 20
+# Number of chunks waiting to be written, per worker process
+CHUNKS_IN_FLIGHT = 4
+# Number of messages read in advance to download their attachments
+PREFETCH_DEPTH = 100
+
 
 
 class DownloadError(Exception): pass
@@ -97,26 +112,35 @@ class DownloadError(Exception): pass
 
 class ProgressMarker(object):
 
-    def __init__(self, verbose):
+    def __init__(self, verbose, quiet=False):
         self.verbose = verbose
-        self.total = None
+        self.quiet = quiet
+        self.total = None # in bytes
+        self.position = 0
         self.count = 0
         self.count_imported = 0
         self.spinner_seq = ('|', '/', '-', '\\')
 
-    def tick(self, msgid=None):
+    def tick(self, msgid=None, position=None):
+        if position is not None:
+            self.position = position
+        if self.quiet:
+            self.count += 1
+            return
         if self.total:
-            msg = "%d%%" % floor(100.0 * self.count / self.total)
+            msg = "%d%%" % floor(100.0 * self.position / self.total)
         else:
             msg = self.spinner_seq[self.count % len(self.spinner_seq)]
         if self.verbose:
-            print("%s (%d/%d, %s)" % (msgid, self.count, self.total, msg))
+            print("%s (%d, %s)" % (msgid, self.count, msg))
         else:
             sys.stdout.write("\r%s" % msg)
             sys.stdout.flush()
         self.count += 1
 
     def finish(self):
+        if self.quiet:
+            return
         if self.verbose:
             print('  %s emails read' % self.count)
             print('  %s email added to the database' % self.count_imported)
@@ -124,6 +148,256 @@ class ProgressMarker(object):
             print()
 
 
+class ImportStats(object):
+    """
+    Time spent in each stage of the import, to report the throughput.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def add(self, stage, duration, count=1):
+        self.durations[stage] += duration
+        self.counts[stage] += count
+
+    def merge(self, durations):
+        for stage, duration in durations.items():
+            self.add(stage, duration)
+
+    def merge_stats(self, durations, counts):
+        for stage, duration in durations.items():
+            self.add(stage, duration, counts.get(stage, 0))
+
+    def report(self):
+        lines = []
+        for stage in sorted(self.durations):
+            duration = self.durations[stage]
+            count = self.counts[stage]
+            if duration:
+                rate = "%.1f/s" % (count / duration)
+            else:
+                rate = "n/a"
+            lines.append("  %s: %d in %.2fs (%s)"
+                         % (stage, count, duration, rate))
+        return lines
+
+
+class ParsedMessage(object):
+    """
+    The result of parsing a single message from a mailbox. This object is
+    sent from the parsing processes to the writer.
+    """
+
+    def __init__(self, msgid):
+        self.msgid = msgid
+        self.email = None
+        self.attachments = []
+        # the attachments to download: their index in the attachments list
+        # and their URL
+        self.downloads = []
+        self.error = None
+        self.durations = {}
+
+
+class Checkpoint(object):
+    """
+    A journal of the progress of an import, used to resume it if it was
+    interrupted.
+
+    It records the position after the last message written to the database
+    in each mbox file, and the number of messages read up to there. The
+    threads impacted by the import don't need to be recorded, they are the
+    threads of the emails archived since the import started.
+    """
+
+    def __init__(self, path, list_address):
+        self.path = path
+        self.list_address = list_address
+        self.started_at = now()
+        self.since = None
+        self.files = {}
+        self.resumed = False
+
+    def load(self):
+        with open(self.path) as journal:
+            data = json.load(journal)
+        if data["list_address"] != self.list_address:
+            raise ValueError("the checkpoint file %s is for the list %s"
+                             % (self.path, data["list_address"]))
+        self.started_at = parse_date(data["started_at"])
+        self.since = data["since"] and parse_date(data["since"])
+        self.files = data["files"]
+        self.resumed = True
+
+    def save(self):
+        data = {
+            "list_address": self.list_address,
+            "started_at": self.started_at.isoformat(),
+            "since": self.since and self.since.isoformat(),
+            "files": self.files,
+        }
+        # Write atomically, the journal must never be left half-written
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as journal:
+            json.dump(data, journal)
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.rename(tmp_path, self.path)
+
+    def delete(self):
+        os.remove(self.path)
+
+    def get_position(self, mbfile):
+        """
+        :returns: a tuple with the offset and the number of messages read in
+            the mbox file, and a boolean telling if the file has been fully
+            imported.
+        """
+        position = self.files.get(os.path.abspath(mbfile), {})
+        return (position.get("offset", 0), position.get("count", 0),
+                position.get("done", False))
+
+    def set_position(self, mbfile, offset, count, done=False):
+        self.files[os.path.abspath(mbfile)] = {
+            "offset": offset, "count": count, "done": done}
+        self.save()
+
+    def get_impacted_thread_ids(self):
+        return set(Email.objects.filter(
+                mailinglist__name=self.list_address,
+                archived_date__gte=self.started_at,
+            ).values_list("thread_id", flat=True).distinct())
+
+
+def get_import_since(list_address, since=None):
+    """
+    Only import the emails newer than the latest email in the database.
+
+    :returns: the date after which the emails must be imported
+    """
+    latest_email_date = Email.objects.filter(
+            mailinglist__name=list_address
+        ).values("date").order_by("-date").first()
+    if latest_email_date:
+        if not since or since < latest_email_date["date"]:
+            since = latest_email_date["date"]
+    return since
+
+
+def read_manifest(path):
+    """
+    Read a manifest file: each line contains a list address followed by the
+    mbox files to import into this list, separated by spaces. Empty lines and
+    lines starting with ``#`` are ignored.
+
+    :returns: an ordered dict mapping the list addresses to the mbox files.
+    """
+    lists = OrderedDict()
+    with open(path) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split()
+            lists.setdefault(fields[0], []).extend(fields[1:])
+    if not lists:
+        raise ValueError("no list in %s" % path)
+    return lists
+
+
+def import_list(list_address, mbfiles, options, write=None):
+    """
+    Import mbox files into a mailing-list, and compute the structure of the
+    threads which have been changed.
+
+    :arg write: a function to display the progress, or None
+    :returns: the DbImporter instance, to get the import statistics.
+    """
+    options = options.copy()
+    if write is None:
+        write = lambda msg: None
+    checkpoint = None
+    if options["checkpoint"]:
+        checkpoint_path = options["checkpoint"]
+        if os.path.isdir(checkpoint_path):
+            checkpoint_path = os.path.join(
+                checkpoint_path, "%s.json" % list_address)
+        checkpoint = Checkpoint(checkpoint_path, list_address)
+        if os.path.exists(checkpoint_path):
+            try:
+                checkpoint.load()
+            except ValueError, e:
+                raise CommandError("invalid checkpoint file: %s" % e)
+    if checkpoint is not None and checkpoint.resumed:
+        # The checkpoint knows which messages have been imported
+        options["since"] = checkpoint.since
+        if options["verbosity"] >= 1:
+            write("Resuming the import started on %s" % checkpoint.started_at)
+    else:
+        options["since"] = get_import_since(list_address, options["since"])
+        if checkpoint is not None:
+            checkpoint.since = options["since"]
+            checkpoint.save()
+    if options["since"] and options["verbosity"] >= 2:
+        write("Only emails after %s will be imported" % options["since"])
+    importer = DbImporter(list_address, options)
+    if checkpoint is not None:
+        importer.checkpoint = checkpoint
+        importer.impacted_thread_ids.update(
+            checkpoint.get_impacted_thread_ids())
+    for mbfile in mbfiles:
+        if options["verbosity"] >= 1:
+            write("Importing from mbox file %s to %s" % (mbfile, list_address))
+        importer.from_mbox(mbfile)
+        if options["verbosity"] >= 2:
+            total_in_list = Email.objects.filter(
+                mailinglist__name=list_address).count()
+            write('  %s emails are stored into the database' % total_in_list)
+    if options["verbosity"] >= 1:
+        write("Computing thread structure")
+    importer.compute_thread_order()
+    if checkpoint is not None:
+        checkpoint.delete()
+    return importer
+
+
+# The options needed to import a list in a separate process
+WORKER_OPTIONS = ("no_download", "since", "jobs", "batch_size", "index_size",
+                  "download_jobs", "download_cache", "checkpoint")
+
+def _import_list_in_worker(args):
+    """
+    Import a list from a manifest, and return a picklable summary of the
+    import.
+    """
+    list_address, mbfiles, options = args
+    result = {"list_address": list_address, "error": None}
+    start = time.time()
+    try:
+        importer = import_list(list_address, mbfiles, options)
+    except Exception, e: # pylint: disable=broad-except
+        result["error"] = unicode(e) or e.__class__.__name__
+        result["traceback"] = traceback.format_exc()
+    else:
+        result["durations"] = dict(importer.stats.durations)
+        result["counts"] = dict(importer.stats.counts)
+    result["duration"] = time.time() - start
+    return result
+
+
+# The importer in the worker processes, set by the pool initializer.
+_worker_importer = None
+
+def _init_worker(importer):
+    global _worker_importer # pylint: disable=global-statement
+    _worker_importer = importer
+
+def _parse_in_worker(messages):
+    return [ _worker_importer.parse(raw, scrubbed)
+             for raw, scrubbed in messages ]
+
+
 class DbImporter(object):
     """
     Import email messages into the KittyStore database using its API.
@@ -133,8 +407,18 @@ class DbImporter(object):
         self.list_address = list_address
         self.no_download = options["no_download"]
         self.verbose = options["verbosity"] >= 2
+        self.quiet = options["verbosity"] == 0
         self.since = options.get("since")
+        self.jobs = options.get("jobs") or 1
+        self.batch_size = options.get("batch_size") or 1
+        self.index_size = options.get("index_size", 0)
+        self.download_jobs = options.get("download_jobs") or 1
+        self.download_cache = options.get("download_cache")
+        self.fetcher = None
+        self.index = None
+        self.checkpoint = None
         self.impacted_thread_ids = set()
+        self.stats = ImportStats()
 
     def _is_too_old(self, message):
         if not self.since:
@@ -156,124 +440,310 @@ class DbImporter(object):
     def from_mbox(self, mbfile):
         """
         Insert all the emails contained in an mbox file into the database.
+        The file may be gzipped.
 
         :arg mbfile: a mailbox file
         """
+        mbox = open_mbox(mbfile)
+        try:
+            self.from_reader(mbox, mbfile)
+        finally:
+            mbox.close()
+
+    def from_reader(self, mbox, name):
+        """
+        Insert all the emails returned by an mbox reader into the database.
+
+        The messages are parsed in a pool of worker processes if more than one
+        job was requested, and written to the database by this process, in
+        the order they appear in the mbox, by batches.
+
+        If a checkpoint is set, the import starts after the last message that
+        was written to the database, and the position is recorded after each
+        batch.
+
+        :arg mbox: an object with the same interface as
+            :py:class:`hyperkitty.lib.mbox.MboxReader`
+        :arg name: the name of the mailbox in the checkpoint
+        """
         # TODO: search index
         #self.store.search_index = make_delayed(self.store.search_index)
-        mbox = mailbox.mbox(mbfile)
-        progress_marker = ProgressMarker(self.verbose)
-        if not self.since:
-            progress_marker.total = len(mbox)
-        for message in mbox:
-            if self._is_too_old(message):
-                continue
-            progress_marker.tick(message["Message-Id"])
-            # Un-wrap the subject line if necessary
-            if message["subject"]:
-                message.replace_header("subject",
-                        TEXTWRAP_RE.sub(" ", message["subject"]))
-            # Parse message to search for attachments
-            attachments = self.extract_attachments(message)
-            # Now insert the message
-            try:
-                add_to_list(self.list_address, message)
-            except ValueError, e:
-                if len(e.args) != 2:
-                    raise # Regular ValueError exception
-                try:
-                    print("%s from %s about %s" % (e.args[0],
-                            e.args[1].get("From"), e.args[1].get("Subject")))
-                except UnicodeDecodeError:
-                    print("%s with message-id %s" % (
-                            e.args[0], e.args[1].get("Message-ID")))
-                continue
-            except DatabaseError:
-                print_exc()
-                print("Message %s failed to import, skipping"
-                      % unquote(message["Message-Id"]))
-                #if not transaction.get_autocommit():
-                #    transaction.rollback()
-                continue
-            email = Email.objects.get(
-                mailinglist__name=self.list_address,
-                message_id=get_message_id(message))
-            # And insert the attachments
-            for counter, att in enumerate(attachments):
-                att["counter"] = counter
-                att["email"] = email
-                Attachment.objects.create(**att)
-            ## Commit every time to be able to rollback on error
-            #if not transaction.get_autocommit():
-            #    transaction.commit()
-            # Store the list of impacted threads to be able to compute the
-            # thread_order and thread_depth values
-            self.impacted_thread_ids.add(email.thread_id)
-            progress_marker.count_imported += 1
+        mlist = MailingList.objects.get_or_create(name=self.list_address)[0]
+        if mlist.archive_policy == ArchivePolicy.never.value:
+            print("Archiving disabled by list policy for %s"
+                  % self.list_address)
+            return
+        offset, count, done = 0, 0, False
+        if self.checkpoint is not None:
+            offset, count, done = self.checkpoint.get_position(name)
+        if done:
+            print("%s has already been imported, skipping" % name)
+            return
+        progress_marker = ProgressMarker(self.verbose, self.quiet)
+        progress_marker.total = mbox.size
+        progress_marker.position = offset
+        progress_marker.count = count
+        # The end offsets of the messages being parsed, in order
+        positions = deque()
+        raw_messages = self._read(mbox, offset, positions)
+        cache_dir = None
+        if not self.no_download:
+            cache_dir = self.download_cache or tempfile.mkdtemp(
+                prefix="hyperkitty-import-")
+            self.fetcher = Fetcher(cache_dir, self.download_jobs)
+            messages = self._read_ahead(raw_messages)
+        else:
+            messages = ( (raw, None) for raw in raw_messages )
+        pool = None
+        if self.jobs > 1:
+            # Don't share the database connection with the worker processes
+            connection.close()
+            pool = Pool(self.jobs, _init_worker, (self, ))
+            results = self._parse_in_pool(pool, messages)
+        else:
+            results = starmap(self.parse, messages)
+        if self.index is None and self.index_size:
+            start = time.time()
+            self.index = MessageIdIndex(mlist, self.index_size)
+            self.index.load()
+            self.stats.add("index", time.time() - start, len(self.index))
+        writer = BulkWriter(mlist, self.batch_size, self.index)
+        position = offset
+        try:
+            for result in results:
+                position = positions.popleft()
+                count += 1
+                if result is None:
+                    continue # too old
+                self.stats.merge(result.durations)
+                progress_marker.tick(result.msgid, position)
+                if result.error is not None:
+                    print(result.error)
+                    continue
+                if result.downloads:
+                    start = time.time()
+                    self.download_attachments(result)
+                    self.stats.add("download", time.time() - start,
+                                   len(result.downloads))
+                start = time.time()
+                written = writer.add(result.email, result.attachments)
+                self._written(written, time.time() - start, progress_marker)
+                if self.checkpoint is not None and not writer.pending:
+                    # The batch has been written
+                    self.checkpoint.set_position(name, position, count)
+            start = time.time()
+            written = writer.flush()
+            self._written(written, time.time() - start, progress_marker)
+            if self.checkpoint is not None:
+                self.checkpoint.set_position(
+                    name, position, count, done=True)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if self.fetcher is not None:
+                self.fetcher.close()
+                self.fetcher = None
+            if cache_dir is not None and not self.download_cache:
+                shutil.rmtree(cache_dir)
         #self.store.search_index.flush() # Now commit to the search index
         progress_marker.finish()
 
-    def extract_attachments(self, message):
-        """Parse message to search for attachments"""
+    def _parse_in_pool(self, pool, messages):
+        """
+        Parse the messages in the worker processes and yield the results in
+        order. Only a limited number of messages are sent to the workers in
+        advance, to keep the memory usage bounded.
+        """
+        pending = deque()
+        chunks = iter(lambda: list(islice(messages, CHUNK_SIZE)), [])
+        for chunk in chunks:
+            pending.append(pool.apply_async(_parse_in_worker, (chunk, )))
+            if len(pending) < self.jobs * CHUNKS_IN_FLIGHT:
+                continue
+            for result in pending.popleft().get():
+                yield result
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+
+    def _read(self, mbox, offset, positions):
+        messages = mbox.messages(offset)
+        while True:
+            start = time.time()
+            try:
+                raw_message, stop = next(messages)
+            except StopIteration:
+                return
+            positions.append(stop)
+            self.stats.add("read", time.time() - start)
+            yield raw_message
+
+    def _read_ahead(self, raw_messages):
+        """
+        Read the messages in advance and start downloading their scrubbed
+        attachments, so they are available when the messages are written.
+
+        :returns: an iterator on tuples with the text of each message and the
+            scrubbed attachments found in it, to be given to :py:meth:`parse`.
+        """
+        buffered = deque()
+        for raw_message in raw_messages:
+            scrubbed = self.find_attachments(raw_message)
+            self.fetcher.prefetch(url for _name, _type, url in scrubbed)
+            buffered.append((raw_message, scrubbed))
+            if len(buffered) > PREFETCH_DEPTH:
+                yield buffered.popleft()
+        while buffered:
+            yield buffered.popleft()
+
+    def parse(self, raw_message, scrubbed=None):
+        """
+        Parse a message and extract its attachments. This method does not
+        access the database, it is run in the worker processes.
+
+        :arg scrubbed: the attachments scrubbed by Pipermail, if they have
+            already been found by :py:meth:`find_attachments`
+        :returns: a ParsedMessage instance or None if the message is too old
+        """
+        start = time.time()
+        message = mailbox.mboxMessage(raw_message)
+        if self._is_too_old(message):
+            return None
+        result = ParsedMessage(message["Message-Id"])
+        # Un-wrap the subject line if necessary
+        if message["subject"]:
+            message.replace_header("subject",
+                    TEXTWRAP_RE.sub(" ", message["subject"]))
+        # Search the text of the message for the attachments, only once
+        if scrubbed is None:
+            scrubbed = self.find_attachments(raw_message)
+        archived_attachments = self.extract_attachments(message, scrubbed)
+        try:
+            result.email, result.attachments = parse_message(
+                self.list_address, message, result.durations)
+        except ValueError, e:
+            if len(e.args) != 2:
+                raise # Regular ValueError exception
+            try:
+                result.error = "%s from %s about %s" % (e.args[0],
+                        e.args[1].get("From"), e.args[1].get("Subject"))
+            except UnicodeDecodeError:
+                result.error = "%s with message-id %s" % (
+                        e.args[0], e.args[1].get("Message-ID"))
+        else:
+            # Add the attachments scrubbed by Pipermail, numbered after the
+            # attachments found by our scrubber
+            counter = max([att[0] + 1 for att in result.attachments] or [0])
+            for att in archived_attachments:
+                if att["content"] is None:
+                    result.downloads.append(
+                        (len(result.attachments), att["url"]))
+                result.attachments.append((counter, att["name"],
+                    att["content_type"], None, att["content"]))
+                counter += 1
+        result.durations["parse"] = time.time() - start \
+            - result.durations.get("scrub", 0)
+        return result
+
+    def compute_thread_order(self):
+        """
+        Compute the thread order and depth, and the counters of the threads
+        impacted by the import, this is not done when importing in batch mode.
+        """
+        start = time.time()
+        compute_threads_order_and_depth(self.impacted_thread_ids)
+        update_threads_counts(self.impacted_thread_ids)
+        self.stats.add("thread", time.time() - start,
+                       len(self.impacted_thread_ids))
+
+    def _written(self, emails, duration, progress_marker):
+        if not emails:
+            return
+        self.stats.add("write", duration, len(emails))
+        progress_marker.count_imported += len(emails)
+        # Store the list of impacted threads to be able to compute the
+        # thread_order and thread_depth values
+        self.impacted_thread_ids.update(email.thread_id for email in emails)
+
+    def find_attachments(self, message_text):
+        """
+        Find the attachments scrubbed by Pipermail in the text of a message.
+
+        :returns: a list of tuples with the name, the content type and the
+            URL of each attachment.
+        """
         all_attachments = []
-        message_text = message.as_string()
         #has_attach = False
         #if "-------------- next part --------------" in message_text:
         #    has_attach = True
         # Regular attachments
         attachments = ATTACHMENT_RE.findall(message_text)
         for att in attachments:
-            all_attachments.append(self.get_attachment(
-                att[0], att[1], att[2]))
+            all_attachments.append((att[0], att[1], att[2]))
         # Embedded messages
         embedded = EMBEDDED_MSG_RE.findall(message_text)
         for att in embedded:
-            all_attachments.append(self.get_attachment(
-                att[0], "message/rfc822", att[1]))
+            all_attachments.append((att[0], "message/rfc822", att[1]))
         # HTML attachments
         html_attachments = HTML_ATTACH_RE.findall(message_text)
         for att in html_attachments:
             url = att.strip("<>")
-            all_attachments.append(self.get_attachment(
-                os.path.basename(url), "message/rfc822", url))
+            all_attachments.append(
+                (os.path.basename(url), "message/rfc822", url))
         # Text without charset
         text_no_charset = TEXT_NO_CHARSET_RE.findall(message_text)
         for att in text_no_charset:
-            all_attachments.append(self.get_attachment(
-                att[0], "text/plain", att[1]))
+            all_attachments.append((att[0], "text/plain", att[1]))
         ## Other, probably inline text/plain
         #if has_attach and not (attachments or embedded
         #                       or html_attachments or text_no_charset):
         #    print message_text
-        return all_attachments
+        return [ (name, content_type, url.strip(" <>"))
+                 for name, content_type, url in all_attachments ]
+
+    def extract_attachments(self, message, scrubbed=None):
+        """
+        Parse message to search for attachments, unless they have already
+        been found by :py:meth:`find_attachments`.
+        """
+        if scrubbed is None:
+            scrubbed = self.find_attachments(message.as_string())
+        return [ self.get_attachment(name, content_type, url)
+                 for name, content_type, url in scrubbed ]
 
     def get_attachment(self, name, content_type, url):
-        content = self.download_attachment(url)
-        if not content:
+        content = None
+        if self.no_download:
+            if self.verbose:
+                print("NOT downloading attachment from %s" % url)
             content_type = "text/plain"
             content = b"not available"
+        # otherwise the content is downloaded by the writing process, see
+        # download_attachments()
         return {"name": name, "content_type": content_type,
-                "content": content, }
+                "content": content, "url": url}
+
+    def download_attachments(self, result):
+        """Download the attachments of a parsed message."""
+        for index, url in result.downloads:
+            counter, name, content_type, encoding, _content = \
+                result.attachments[index]
+            content = self.download_attachment(url)
+            if not content:
+                content_type = "text/plain"
+                content = b"not available"
+            result.attachments[index] = (
+                counter, name, content_type, encoding, content)
 
     def download_attachment(self, url):
-        url = url.strip(" <>")
-        if self.no_download:
-            if self.verbose:
-                print("NOT downloading attachment from %s" % url)
-            content = None
-        else:
-            if self.verbose:
-                print("Downloading attachment from %s" % url)
-            try:
-                content = urllib.urlopen(url).read()
-            except IOError:
-                content = None
-        return content
+        if self.verbose:
+            print("Downloading attachment from %s" % url)
+        return self.fetcher.fetch(url)
 
 
 
 class Command(BaseCommand):
-    args = "-l <list_address> <mbox> [mbox ...]"
+    args = "-l <list_address> <mbox> [mbox ...] | --manifest <file>"
     help = "Imports the specified mailbox archive"
     option_list = BaseCommand.option_list + (
         make_option('-l', '--list-address',
@@ -281,27 +751,71 @@ class Command(BaseCommand):
         make_option('--no-download',
             action='store_true', default=False,
             help="do not download attachments"),
+        make_option('--download-jobs', type="int", default=8,
+            help="number of attachments downloaded at the same time "
+                 "(default: %default)"),
+        make_option('--download-cache',
+            help="directory where the downloaded attachments are kept, to "
+                 "avoid downloading them again on the next import"),
         make_option('--no-sync-mailman',
             action='store_true', default=False,
             help="do not sync properties with Mailman (faster, useful "
                  "for batch imports)"),
         make_option('--since',
-            help="only import emails later than this date")
+            help="only import emails later than this date"),
+        make_option('-j', '--jobs', type="int", default=1,
+            help="number of processes used to parse the messages "
+                 "(default: %default)"),
+        make_option('--batch-size', type="int", default=100,
+            help="number of messages written to the database in a single "
+                 "transaction (default: %default)"),
+        make_option('--index-size', type="int", default=1000000,
+            help="maximum number of message-ids kept in memory to find "
+                 "duplicates and parents, 0 to disable (default: %default)"),
+        make_option('--checkpoint',
+            help="file recording the progress of the import. If it exists, "
+                 "the import resumes where it stopped. With --manifest, a "
+                 "directory where a file is kept for each list"),
+        make_option('--manifest',
+            help="import several lists: each line of this file contains a "
+                 "list address followed by the mbox files to import into "
+                 "this list"),
+        make_option('--list-jobs', type="int", default=1,
+            help="with --manifest, number of lists imported at the same "
+                 "time (default: %default)"),
         )
 
-    def _check_options(self, args, options):
-        if not options.get("list_address"):
-            raise CommandError(
-                "The list address must be given on the command-line.")
-        if "@" not in options["list_address"]:
+    def _check_list(self, list_address, mbfiles):
+        if "@" not in list_address:
             raise CommandError(
                 "The list address must be fully-qualified, including "
-                "the '@' symbol and the domain name.")
-        if not args:
+                "the '@' symbol and the domain name: %s" % list_address)
+        if not mbfiles:
             raise CommandError("No mbox file selected.")
-        for mbfile in args:
+        for mbfile in mbfiles:
             if not os.path.exists(mbfile):
                 raise CommandError("No such file: %s" % mbfile)
+
+    def _check_options(self, args, options):
+        if options.get("manifest"):
+            if options.get("list_address") or args:
+                raise CommandError("The list address and the mbox files "
+                                   "must be given in the manifest.")
+            try:
+                options["manifest_lists"] = read_manifest(options["manifest"])
+            except (IOError, ValueError), e:
+                raise CommandError("invalid manifest: %s" % e)
+            for list_address, mbfiles in options["manifest_lists"].items():
+                self._check_list(list_address, mbfiles)
+            if options["checkpoint"] and not os.path.isdir(
+                    options["checkpoint"]):
+                raise CommandError("With a manifest, the checkpoint must be "
+                                   "a directory.")
+        else:
+            if not options.get("list_address"):
+                raise CommandError(
+                    "The list address must be given on the command-line.")
+            self._check_list(options["list_address"], args)
         options["verbosity"] = int(options.get("verbosity", "1"))
         if options["since"]:
             try:
@@ -311,6 +825,13 @@ class Command(BaseCommand):
                         tzinfo=tz.tzlocal())
             except ValueError, e:
                 raise CommandError("invalid value for '--since': %s" % e)
+        if options["index_size"] < 0:
+            raise CommandError("invalid value for '--index-size': %s"
+                               % options["index_size"])
+        for name in ("jobs", "batch_size", "download_jobs", "list_jobs"):
+            if options[name] < 1:
+                raise CommandError("invalid value for '--%s': %s"
+                                   % (name.replace("_", "-"), options[name]))
 
     def handle(self, *args, **options):
         self._check_options(args, options)
@@ -321,47 +842,87 @@ class Command(BaseCommand):
             debuglevel = logging.INFO
         logging.basicConfig(format='%(message)s', level=debuglevel)
         # main
-        list_address = options["list_address"]
         ## Keep autocommit on SQLite:
         ## https://docs.djangoproject.com/en/1.6/topics/db/transactions/#savepoints-in-sqlite
         #if settings.DATABASES["default"]["ENGINE"] != "django.db.backends.sqlite3":
         #    transaction.set_autocommit(False)
         settings.HYPERKITTY_BATCH_MODE = True
-        # Only import emails older than the latest email in the DB
-        latest_email_date = Email.objects.filter(
-                mailinglist__name=list_address
-            ).values("date").order_by("-date").first()
-        if latest_email_date:
-            if not options["since"] or \
-                options["since"] < latest_email_date["date"]:
-                options["since"] = latest_email_date["date"]
-        if options["since"] and options["verbosity"] >= 2:
-            self.stdout.write("Only emails after %s will be imported"
-                             % options["since"])
-        importer = DbImporter(list_address, options)
-        # disable mailman client for now
-        for mbfile in args:
+        if options["manifest"]:
+            failed = self.import_manifest(options)
+        else:
+            importer = import_list(options["list_address"], args, options,
+                                   self.stdout.write)
             if options["verbosity"] >= 1:
-                self.stdout.write("Importing from mbox file %s to %s"
-                                  % (mbfile, list_address))
-            importer.from_mbox(mbfile)
-            if options["verbosity"] >= 2:
-                total_in_list = Email.objects.filter(
-                    mailinglist__name=list_address).count()
-                self.stdout.write('  %s emails are stored into the database'
-                                  % total_in_list)
-        if options["verbosity"] >= 1:
-            self.stdout.write("Computing thread structure")
-        #timeit("start")
-        for thread in Thread.objects.filter(
-            thread_id__in=importer.impacted_thread_ids):
-            #timeit("before")
-            compute_thread_order_and_depth(thread)
-            #timeit("after")
-        #showtimes()
+                self.stdout.write("Throughput per stage:")
+                for line in importer.stats.report():
+                    self.stdout.write(line)
+            failed = 0
+        # Sync once, at the end
         if not options["no_sync_mailman"]:
             if options["verbosity"] >= 1:
                 self.stdout.write("Synchronizing properties with Mailman")
             sync_with_mailman()
             #if not transaction.get_autocommit():
             #    transaction.commit()
+        if failed:
+            raise CommandError("%d list(s) could not be imported" % failed)
+
+    def import_manifest(self, options):
+        """
+        Import the lists of the manifest, several at the same time if
+        requested, and report the progress and the errors.
+
+        :returns: the number of lists that could not be imported
+        """
+        lists = options["manifest_lists"]
+        worker_options = dict(
+            (name, options[name]) for name in WORKER_OPTIONS)
+        worker_options["verbosity"] = 0
+        list_jobs = options["list_jobs"]
+        if list_jobs > 1 and connection.vendor == "sqlite":
+            self.stderr.write("SQLite does not support concurrent writes, "
+                              "the lists will be imported one at a time.")
+            list_jobs = 1
+        if list_jobs > 1:
+            # The lists are imported in daemon processes, which can't have
+            # their own pool of parsing processes
+            worker_options["jobs"] = 1
+            # Don't share the database connection with the worker processes
+            connection.close()
+            pool = Pool(list_jobs, maxtasksperchild=1)
+            results = pool.imap_unordered(_import_list_in_worker, [
+                (list_address, mbfiles, worker_options)
+                for list_address, mbfiles in lists.items() ])
+        else:
+            pool = None
+            results = imap(_import_list_in_worker, [
+                (list_address, mbfiles, worker_options)
+                for list_address, mbfiles in lists.items() ])
+        stats = ImportStats()
+        failures = []
+        try:
+            for num, result in enumerate(results, 1):
+                if result["error"] is None:
+                    stats.merge_stats(result["durations"], result["counts"])
+                    status = "%d emails imported in %.1fs" % (
+                        result["counts"].get("write", 0), result["duration"])
+                else:
+                    failures.append(result)
+                    status = "FAILED: %s" % result["error"]
+                if options["verbosity"] >= 1:
+                    self.stdout.write("[%d/%d] %s: %s" % (
+                        num, len(lists), result["list_address"], status))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if options["verbosity"] >= 1:
+            self.stdout.write("%d list(s) imported, %d failed" % (
+                len(lists) - len(failures), len(failures)))
+            self.stdout.write("Throughput per stage:")
+            for line in stats.report():
+                self.stdout.write(line)
+        for result in failures:
+            self.stderr.write("%s could not be imported:\n%s" % (
+                result["list_address"], result["traceback"]))
+        return len(failures)
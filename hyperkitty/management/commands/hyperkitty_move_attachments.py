@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+
+"""
+Move the content of the attachments from the database to the attachment
+store.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from hyperkitty.lib.storage import get_attachment_store
+from hyperkitty.models import Attachment
+
+
+def move_attachments(store, batch_size=100):
+    """
+    Move the attachments to the store by batches, in one transaction per
+    batch. The contents are written to the store before the database is
+    updated, so an interrupted move can be run again.
+
+    :returns: an iterator on the number of attachments moved in each batch.
+    """
+    query = Attachment.objects.filter(content__isnull=False).order_by("id")
+    last_id = 0
+    while True:
+        batch = list(query.filter(id__gt=last_id).values_list(
+            "id", "content")[:batch_size])
+        if not batch:
+            break
+        with transaction.atomic():
+            for attachment_id, content in batch:
+                content = bytes(content)
+                content_hash = store.put(content)
+                Attachment.objects.filter(id=attachment_id).update(
+                    content=None, content_hash=content_hash,
+                    size=len(content))
+        last_id = batch[-1][0]
+        yield len(batch)
+
+
+class Command(BaseCommand):
+    help = ("Move the content of the attachments from the database to the "
+            "folder set in HYPERKITTY_ATTACHMENT_FOLDER")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type="int", default=100,
+            help="number of attachments moved in a single transaction "
+                 "(default: %default)"),
+        )
+
+    def handle(self, *args, **options):
+        options["verbosity"] = int(options.get("verbosity", "1"))
+        if args:
+            raise CommandError("no arguments allowed")
+        if options["batch_size"] < 1:
+            raise CommandError("invalid value for '--batch-size': %s"
+                               % options["batch_size"])
+        store = get_attachment_store()
+        if store is None:
+            raise CommandError("The HYPERKITTY_ATTACHMENT_FOLDER setting is "
+                               "not set.")
+        total = Attachment.objects.filter(content__isnull=False).count()
+        moved = 0
+        for count in move_attachments(store, options["batch_size"]):
+            moved += count
+            if options["verbosity"] >= 1:
+                self.stdout.write("%d/%d attachments moved" % (moved, total))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+
+"""
+Render the content of the emails which were rendered by a previous version of
+the renderer, or not at all.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from hyperkitty.lib.renderer import RENDERER_VERSION, render_body
+from hyperkitty.models import Email
+
+
+def render_emails(query, batch_size=500):
+    """
+    Render the outdated emails of the query by batches, in one transaction
+    per batch.
+
+    :returns: an iterator on the number of emails rendered in each batch.
+    """
+    query = query.exclude(renderer_version=RENDERER_VERSION).order_by("id")
+    last_id = 0
+    while True:
+        batch = list(query.filter(id__gt=last_id).values_list(
+            "id", "content")[:batch_size])
+        if not batch:
+            break
+        with transaction.atomic():
+            for email_id, content in batch:
+                Email.objects.filter(id=email_id).update(
+                    content_html=render_body(content),
+                    renderer_version=RENDERER_VERSION)
+        last_id = batch[-1][0]
+        yield len(batch)
+
+
+class Command(BaseCommand):
+    help = ("Render the content of the emails again after an upgrade. The "
+            "emails are also rendered when they are displayed, this command "
+            "avoids slowing down the first display.")
+    option_list = BaseCommand.option_list + (
+        make_option('-l', '--list-address',
+            help="only render the emails of this list"),
+        make_option('--batch-size', type="int", default=500,
+            help="number of emails rendered in a single transaction "
+                 "(default: %default)"),
+        )
+
+    def handle(self, *args, **options):
+        options["verbosity"] = int(options.get("verbosity", "1"))
+        if args:
+            raise CommandError("no arguments allowed")
+        if options["batch_size"] < 1:
+            raise CommandError("invalid value for '--batch-size': %s"
+                               % options["batch_size"])
+        query = Email.objects.all()
+        if options["list_address"]:
+            query = query.filter(mailinglist__name=options["list_address"])
+        total = query.exclude(renderer_version=RENDERER_VERSION).count()
+        rendered = 0
+        for count in render_emails(query, options["batch_size"]):
+            rendered += count
+            if options["verbosity"] >= 1:
+                self.stdout.write("%d/%d emails rendered" % (rendered, total))
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+
+"""
+Archive the messages waiting in the spool directory.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+import random
+import time
+from multiprocessing import Process
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, close_old_connections, Error
+
+from hyperkitty.lib.spool import Spool
+
+logger = logging.getLogger(__name__)
+
+
+# Maximum number of seconds to wait for the database to come back
+MAX_BACKOFF = 60
+
+
+def work(spool, once=False, interval=1.0):
+    """
+    Drain the spool, and wait for new messages unless ``once`` is True. When
+    the database is unavailable, wait longer and longer before retrying.
+    """
+    failures = 0
+    while True:
+        lists = spool.lists()
+        # Start with a different list in each worker
+        random.shuffle(lists)
+        try:
+            processed = spool.drain(lists=lists)
+        except Error:
+            failures += 1
+            delay = min(interval * 2 ** failures, MAX_BACKOFF)
+            logger.warning("Retrying in %.1f seconds", delay)
+            time.sleep(delay)
+            continue
+        failures = 0
+        # Don't keep a stale connection between two rounds
+        close_old_connections()
+        if once and not processed:
+            break
+        if not processed:
+            time.sleep(interval)
+
+
+class Command(BaseCommand):
+    help = ("Archive the messages that Mailman sent while the "
+            "HYPERKITTY_ARCHIVE_SPOOL setting was set")
+    option_list = BaseCommand.option_list + (
+        make_option('-j', '--jobs', type="int", default=1,
+            help="number of worker processes (default: %default)"),
+        make_option('--once', action="store_true", default=False,
+            help="exit when the spool is empty instead of waiting for new "
+                 "messages"),
+        make_option('--interval', type="float", default=1.0,
+            help="seconds between two checks of an empty spool "
+                 "(default: %default)"),
+        make_option('--status', action="store_true", default=False,
+            help="display the number of messages waiting for each list and "
+                 "exit"),
+        )
+
+    def handle(self, *args, **options):
+        options["verbosity"] = int(options.get("verbosity", "1"))
+        # logging
+        if options["verbosity"] >= 3:
+            debuglevel = logging.DEBUG
+        else:
+            debuglevel = logging.INFO
+        logging.basicConfig(format='%(message)s', level=debuglevel)
+        if args:
+            raise CommandError("no arguments allowed")
+        spool_path = getattr(settings, "HYPERKITTY_ARCHIVE_SPOOL", None)
+        if not spool_path:
+            raise CommandError("The HYPERKITTY_ARCHIVE_SPOOL setting is "
+                               "not set.")
+        if options["jobs"] < 1:
+            raise CommandError("invalid value for '--jobs': %s"
+                               % options["jobs"])
+        spool = Spool(spool_path)
+        if options["status"]:
+            depth = spool.depth()
+            for list_name in sorted(depth):
+                self.stdout.write("%s: %d" % (list_name, depth[list_name]))
+            self.stdout.write("total: %d" % sum(depth.values()))
+            return
+        if options["jobs"] == 1:
+            work(spool, options["once"], options["interval"])
+            return
+        # Don't share the database connection with the worker processes
+        connection.close()
+        workers = [ Process(target=work, args=(
+                        spool, options["once"], options["interval"]))
+                    for _i in range(options["jobs"]) ]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+            raise
@@ -27,18 +27,34 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 import os
 import urllib2
-import gzip
 import itertools
 import logging
+import threading
+import zlib
 from multiprocessing import Pool
+from Queue import Queue, Full
 from datetime import date
 from optparse import make_option
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
+from hyperkitty.lib.mailman import sync_with_mailman
+from hyperkitty.lib.mbox import read_chunks, gunzip_chunks, split_mbox
+from hyperkitty.management.commands.hyperkitty_import import (
+    DbImporter, get_import_since)
+
 
 MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
           'August', 'September', 'October', 'November', 'December']
+# Number of messages of a month waiting to be imported
+QUEUE_SIZE = 200
+
+
+def _get_archive_url(options, year, month):
+    basename = "{0}-{1}.txt.gz".format(year, month)
+    list_name = options["list_address"].split("@")[0]
+    return "{0}/pipermail/{1}/{2}".format(options["url"], list_name, basename)
 
 
 def _archive_downloader(args):
@@ -51,14 +67,14 @@ def _archive_downloader(args):
         if options["verbosity"] >= 2:
             print("{0} already downloaded, skipping".format(basename))
         return
-    url = "{0}/pipermail/{1}/{2}".format(
-            options["url"], options["list_address"], basename)
+    url = _get_archive_url(options, year, month)
     if options["verbosity"] >= 2:
         print("Downloading from {0}".format(url))
     try:
         request = urllib2.urlopen(url)
         with open(filepath, "w") as f:
-            f.write(request.read())
+            for chunk in read_chunks(request):
+                f.write(chunk)
     except urllib2.URLError, e:
         if isinstance(e, urllib2.HTTPError) and e.code == 404:
             print("This archive hasn't been created on the server yet: %s"
@@ -69,11 +85,98 @@ def _archive_downloader(args):
     pos = str(MONTHS.index(month) + 1).rjust(2, "0")
     newname = '{0}-{1}-{2}-{3}.txt'.format(
         options["list_address"], year, pos, month)
-    with open(os.path.join(options["destination"], newname), "w") as f:
-        f.write(gzip.open(filepath).read())
+    with open(filepath, "rb") as gzfile, \
+            open(os.path.join(options["destination"], newname), "w") as f:
+        for chunk in gunzip_chunks(read_chunks(gzfile)):
+            f.write(chunk)
     print("Downloaded archive for {0} {1} from {2}".format(month, year, url))
 
 
+class MonthlyArchivesReader(object):
+    """
+    Read the messages of the gzipped monthly archives of a Mailman 2.1 list,
+    from URLs or local files, for
+    :py:meth:`hyperkitty.management.commands.hyperkitty_import.DbImporter.from_reader`.
+
+    Several archives are downloaded and decompressed at the same time, in
+    threads, and their messages are returned in the order of the archives.
+    Nothing is written to the disk, and only a limited number of messages
+    are kept in memory for each archive.
+    """
+
+    size = None # unknown
+
+    def __init__(self, sources, jobs=5, verbosity=1):
+        self.sources = sources
+        self.jobs = jobs
+        self.verbosity = verbosity
+        self._closing = False
+
+    def close(self):
+        self._closing = True
+
+    def _put(self, queue, item):
+        while not self._closing:
+            try:
+                queue.put(item, timeout=1)
+            except Full:
+                continue
+            return
+
+    def _open(self, source):
+        if "://" in source:
+            return urllib2.urlopen(source)
+        return open(source, "rb")
+
+    def _stream(self, source, queue):
+        if self.verbosity >= 2:
+            print("Reading from {0}".format(source))
+        try:
+            archive = self._open(source)
+            try:
+                for message, _stop in split_mbox(
+                        gunzip_chunks(read_chunks(archive))):
+                    self._put(queue, message)
+                    if self._closing:
+                        return
+            finally:
+                archive.close()
+        except urllib2.URLError, e:
+            if isinstance(e, urllib2.HTTPError) and e.code == 404:
+                if self.verbosity >= 2:
+                    print("This archive hasn't been created on the server "
+                          "yet: %s" % source)
+            else:
+                print("Error: %s" % e.reason)
+        except (IOError, zlib.error), e:
+            print("Error reading %s: %s" % (source, e))
+        finally:
+            self._put(queue, None)
+
+    def _start(self, source):
+        queue = Queue(QUEUE_SIZE)
+        thread = threading.Thread(target=self._stream, args=(source, queue))
+        thread.daemon = True
+        thread.start()
+        return queue
+
+    def messages(self, offset=0):
+        """
+        Yield the messages of all the archives. The offset is not supported
+        and must be 0.
+        """
+        assert offset == 0
+        sources = iter(self.sources)
+        queues = [ self._start(source)
+                   for source in itertools.islice(sources, self.jobs) ]
+        while queues:
+            queue = queues.pop(0)
+            for message in iter(queue.get, None):
+                yield message, None
+            for source in itertools.islice(sources, 1):
+                queues.append(self._start(source))
+
+
 class Command(BaseCommand):
     args = "-u <url> -l <list_address> [-d destination]"
     help = "Download Mailman 2.1 archives"
@@ -86,7 +189,18 @@ class Command(BaseCommand):
             help="directory to download the archives to. Defaults "
                  "to the current directory (%default)"),
         make_option("-s", "--start", default="2000",
-            help="first year to start looking for archives")
+            help="first year to start looking for archives"),
+        make_option('-j', '--jobs', type="int", default=5,
+            help="number of archives downloaded at the same time "
+                 "(default: %default)"),
+        make_option('--import', action='store_true', default=False,
+            dest="import_archives",
+            help="import the archives into the database while they are "
+                 "downloaded, instead of writing them to the destination "
+                 "directory"),
+        make_option('--no-sync-mailman',
+            action='store_true', default=False,
+            help="when importing, do not sync properties with Mailman"),
         )
 
     def _check_options(self, args, options):
@@ -99,15 +213,16 @@ class Command(BaseCommand):
             raise CommandError(
                 "The list name must be fully-qualified, including "
                 "the '@' symbol and the domain name.")
-        if not args:
-            raise CommandError("No mbox file selected.")
-        for mbfile in args:
-            if not os.path.exists(mbfile):
-                raise CommandError("No such file: %s" % mbfile)
+        if args:
+            raise CommandError("no arguments allowed")
         try:
-            options["start"] = range(1980, int(options["start"]), date.today().year + 1)
+            options["start"] = range(int(options["start"]),
+                                     date.today().year + 1)
         except ValueError, e:
             raise CommandError("invalid value for '--start': %s" % e)
+        if options["jobs"] < 1:
+            raise CommandError("invalid value for '--jobs': %s"
+                               % options["jobs"])
         options["verbosity"] = int(options.get("verbosity", "1"))
 
     def handle(self, *args, **options):
@@ -119,5 +234,37 @@ class Command(BaseCommand):
             debuglevel = logging.INFO
         logging.basicConfig(format='%(message)s', level=debuglevel)
 
-        p = Pool(5)
+        if options["import_archives"]:
+            self.import_archives(options)
+            return
+        p = Pool(options["jobs"])
         p.map(_archive_downloader, itertools.product([options], options["start"], MONTHS))
+
+    def import_archives(self, options):
+        today = date.today()
+        sources = [
+            _get_archive_url(options, year, month)
+            for year, month in itertools.product(options["start"], MONTHS)
+            if date(year, MONTHS.index(month) + 1, 1) <= today ]
+        list_address = options["list_address"]
+        settings.HYPERKITTY_BATCH_MODE = True
+        importer = DbImporter(list_address, {
+            "no_download": False,
+            "verbosity": options["verbosity"],
+            "since": get_import_since(list_address),
+            "batch_size": 100,
+            "index_size": 1000000,
+            })
+        reader = MonthlyArchivesReader(sources, options["jobs"],
+                                       options["verbosity"])
+        try:
+            importer.from_reader(reader, options["url"])
+        finally:
+            reader.close()
+        if options["verbosity"] >= 1:
+            self.stdout.write("Computing thread structure")
+        importer.compute_thread_order()
+        if not options["no_sync_mailman"]:
+            if options["verbosity"] >= 1:
+                self.stdout.write("Synchronizing properties with Mailman")
+            sync_with_mailman()
@@ -26,12 +26,19 @@ Sync properties from Mailman into HyperKitty
 from __future__ import absolute_import, print_function, unicode_literals
 
 import logging
+from optparse import make_option
+
 from django.core.management.base import BaseCommand, CommandError
 from hyperkitty.lib.mailman import sync_with_mailman
 
 
 class Command(BaseCommand):
     help = "Sync properties from Mailman into HyperKitty"
+    option_list = BaseCommand.option_list + (
+        make_option('-l', '--list-address', action="append",
+            help="only sync this list (can be repeated), after its "
+                 "properties were changed in Mailman"),
+        )
 
     def handle(self, *args, **options):
         options["verbosity"] = int(options.get("verbosity", "1"))
@@ -43,4 +50,4 @@ class Command(BaseCommand):
         logging.basicConfig(format='%(message)s', level=debuglevel)
         if args:
             raise CommandError("no arguments allowed")
-        sync_with_mailman()
+        sync_with_mailman(options.get("list_address"))
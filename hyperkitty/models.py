@@ -27,11 +27,14 @@ import datetime
 from urllib2 import HTTPError
 
 from django.conf import settings
-from django.db import models, IntegrityError
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models, IntegrityError, transaction
+from django.db.models import Count, F
 from django.db.models.signals import (
     post_init, pre_save, post_save, pre_delete, post_delete)
 from django.contrib import admin
 from django.dispatch import receiver
+from django.utils.safestring import mark_safe
 from django.utils.timezone import now, utc
 from django.core.cache.utils import make_template_fragment_key
 from django.contrib.auth import get_user_model
@@ -45,7 +48,9 @@ from mailmanclient import MailmanConnectionError
 
 from hyperkitty.lib.mailman import get_mailman_client
 from hyperkitty.lib.analysis import compute_thread_order_and_depth
-from hyperkitty.lib.cache import cache
+from hyperkitty.lib.scrub import AttachmentContent, AttachmentPlaceholder
+from hyperkitty.lib.cache import cache, refresh_scheduler
+from hyperkitty.lib.storage import get_attachment_store, get_content_hash
 
 import logging
 logger = logging.getLogger(__name__)
@@ -79,7 +84,10 @@ def get_votes(instance):
             )
     cache_key = "%s:%s:votes" % (instance.__class__.__name__, instance.id)
     votes = cache.get_or_set(cache_key, _getvalue, None)
-    likes, dislikes = votes
+    return get_votes_status(*votes)
+
+
+def get_votes_status(likes, dislikes):
     # XXX: use an Enum?
     if likes - dislikes >= 10:
         status = "likealot"
@@ -276,6 +284,27 @@ class MailingList(models.Model):
         #return [ Sender.objects.get(address=data["address"]) for data in sender_ids ]
         #return sender_ids
 
+    @property
+    def _mailman_update_key(self):
+        return "MailingList:%s:mailman_updated" % self.name
+
+    def update_from_mailman_if_stale(self):
+        """
+        Update the list properties from Mailman, unless it has been done in
+        the last ``HYPERKITTY_MAILMAN_LIST_TTL`` seconds. Failed updates are
+        not retried before the same delay either.
+        """
+        ttl = getattr(settings, "HYPERKITTY_MAILMAN_LIST_TTL", 3600)
+        if ttl > 0:
+            if cache.get(self._mailman_update_key):
+                return
+            cache.set(self._mailman_update_key, True, ttl)
+        self.update_from_mailman()
+
+    def invalidate_mailman_cache(self):
+        """Get the list properties from Mailman on the next update."""
+        cache.delete(self._mailman_update_key)
+
     def update_from_mailman(self):
         try:
             client = get_mailman_client()
@@ -300,6 +329,9 @@ class MailingList(models.Model):
                 value = converters[propname](value)
             setattr(self, propname, value)
         self.save()
+        ttl = getattr(settings, "HYPERKITTY_MAILMAN_LIST_TTL", 3600)
+        if ttl > 0:
+            cache.set(self._mailman_update_key, True, ttl)
 
 
 
@@ -307,18 +339,8 @@ class Sender(models.Model):
     address = models.EmailField(max_length=255, primary_key=True)
     name = models.CharField(max_length=255)
     mailman_id = models.CharField(max_length=255, null=True, db_index=True)
-
-    def set_mailman_id(self):
-        try:
-            client = get_mailman_client()
-            mm_user = client.get_user(self.address)
-        except HTTPError as e:
-            raise MailmanConnectionError(e) # normalize all possible error types
-        self.mailman_id = mm_user.user_id
-        self.save()
-        ## Go further and associate the user's other addresses?
-        #Sender.objects.filter(address__in=mm_user.addresses
-        #    ).update(mailman_id=mm_user.user_id)
+    # When the sender was last looked up in Mailman
+    mailman_checked = models.DateTimeField(null=True, db_index=True)
 
 
 
@@ -333,6 +355,9 @@ class Email(models.Model):
     sender = models.ForeignKey("Sender", related_name="emails")
     subject = models.CharField(max_length="512", db_index=True)
     content = models.TextField()
+    # The content rendered to HTML, see hyperkitty.lib.renderer
+    content_html = models.TextField(null=True)
+    renderer_version = models.SmallIntegerField(null=True)
     date = models.DateTimeField(db_index=True)
     timezone = models.SmallIntegerField()
     in_reply_to = models.CharField(max_length=255, null=True, blank=True)
@@ -348,9 +373,30 @@ class Email(models.Model):
         unique_together = ("mailinglist", "message_id")
 
 
+    def render_content(self):
+        from hyperkitty.lib.renderer import render_body, RENDERER_VERSION # circular import
+        self.content_html = render_body(self.content)
+        self.renderer_version = RENDERER_VERSION
+
+    def get_content_html(self):
+        """
+        Return the content rendered to HTML. It is rendered again, and
+        stored, if it was rendered by a previous version of the renderer.
+        """
+        from hyperkitty.lib.renderer import RENDERER_VERSION # circular import
+        if self.content_html is None or \
+                self.renderer_version != RENDERER_VERSION:
+            self.render_content()
+            if self.pk is not None:
+                Email.objects.filter(pk=self.pk).update(
+                    content_html=self.content_html,
+                    renderer_version=self.renderer_version)
+        return mark_safe(self.content_html)
+
     def get_votes(self):
         return get_votes(self)
 
+    @transaction.atomic
     def vote(self, value, user):
         # Checks if the user has already voted for this message.
         existing = self.votes.filter(user=user).first()
@@ -379,12 +425,33 @@ def Email_set_message_id_hash(sender, **kwargs):
     if not email.message_id_hash:
         email.message_id_hash = get_message_id_hash(email.message_id)
 
+@receiver(pre_save, sender=Email)
+def Email_render_content(sender, **kwargs):
+    """The emails are usually rendered when they are parsed"""
+    instance = kwargs["instance"]
+    if instance.content_html is None:
+        instance.render_content()
+
+@receiver([post_init, post_save], sender=Email)
+def Email_track_parent_id(sender, **kwargs):
+    """Remember the parent and the thread stored in the database"""
+    instance = kwargs["instance"]
+    if "parent_id" in instance.__dict__ and "thread_id" in instance.__dict__:
+        instance._stored_thread_position = (
+            instance.parent_id, instance.thread_id)
+    else:
+        # deferred fields, don't load them
+        instance._stored_thread_position = None
+
 @receiver(pre_save, sender=Email)
 def Email_check_parent_id(sender, **kwargs):
     """Make sure there is only one email with parent_id == None in a thread"""
     instance = kwargs["instance"]
     if instance.parent_id != None:
         return
+    if not instance._state.adding and getattr(instance,
+            "_stored_thread_position", None) == (None, instance.thread_id):
+        return # it was already the starting email of this thread
     starters = Email.objects.filter(
             thread=instance.thread, parent_id__isnull=True
         ).values_list("id", flat=True)
@@ -430,6 +497,20 @@ def Email_update_or_clean_thread(sender, **kwargs):
 
 
 
+class UnresolvedReply(models.Model):
+    """
+    An archived email replying to a message which has not been archived (yet).
+    This happens when the reply is received before the original message, if
+    the message has been delayed by a mail server for example. When the
+    original message is archived, the reply is attached to it.
+    """
+    mailinglist = models.ForeignKey("MailingList",
+                                    related_name="unresolved_replies")
+    in_reply_to = models.CharField(max_length=255, db_index=True)
+    email = models.OneToOneField("Email", related_name="unresolved_reply")
+
+
+
 class Attachment(models.Model):
     email = models.ForeignKey("Email", related_name="attachments")
     counter = models.SmallIntegerField()
@@ -437,15 +518,63 @@ class Attachment(models.Model):
     content_type = models.CharField(max_length=255)
     encoding = models.CharField(max_length=255, null=True)
     size = models.IntegerField()
-    content = models.BinaryField()
+    # The content is None when it is in the attachment store, the content and
+    # its hash are None when the attachment was too large to be archived
+    content = models.BinaryField(null=True)
+    content_hash = models.CharField(max_length=64, null=True, db_index=True)
 
     class Meta:
         unique_together = ("email", "counter")
 
+    @property
+    def is_placeholder(self):
+        return self.content_hash is None and self.content is None
+
+    def set_content(self, content):
+        """
+        Put the content in the attachment store if there is one, or in the
+        database. An AttachmentPlaceholder only records the size.
+        """
+        if isinstance(content, AttachmentPlaceholder):
+            self.size = content.size
+            self.content = self.content_hash = None
+            return
+        store = get_attachment_store()
+        if isinstance(content, AttachmentContent):
+            if store is not None:
+                # copy the decoded file to the store without reading it in
+                # memory
+                content.file.seek(0)
+                self.content_hash = store.put(content.file)
+                self.size = content.size
+                self.content = None
+                return
+            content = content.read()
+        self.size = len(content)
+        self.content_hash = get_content_hash(content)
+        if store is None:
+            self.content = content
+        else:
+            store.put(content)
+            self.content = None
+
+    def get_content(self):
+        if self.content is not None:
+            return bytes(self.content)
+        if self.content_hash is None:
+            return b""
+        store = get_attachment_store()
+        if store is None:
+            raise ImproperlyConfigured(
+                "The attachment %s is in the attachment store but the "
+                "HYPERKITTY_ATTACHMENT_FOLDER setting is not set" % self.pk)
+        return store.get(self.content_hash)
+
 @receiver(pre_save, sender=Attachment)
-def Attachment_set_size(sender, **kwargs):
+def Attachment_set_content(sender, **kwargs):
     instance = kwargs["instance"]
-    instance.size = len(instance.content)
+    if instance.content is not None:
+        instance.set_content(instance.content)
 
 
 
@@ -458,11 +587,29 @@ class Thread(models.Model):
     thread_id = models.CharField(max_length=255, db_index=True)
     date_active = models.DateTimeField(db_index=True, default=now)
     category = models.ForeignKey("ThreadCategory", related_name="threads", null=True)
+    # Counters, updated in the database when emails and votes are added or
+    # removed
+    emails_count = models.IntegerField(default=0, db_index=True)
+    participants_count = models.IntegerField(default=0)
+    likes = models.IntegerField(default=0)
+    dislikes = models.IntegerField(default=0)
     _starting_email_cache = None
 
+    COUNTERS = ("emails_count", "participants_count", "likes", "dislikes")
+
     class Meta:
         unique_together = ("mailinglist", "thread_id")
 
+    def save(self, *args, **kwargs):
+        # Don't overwrite the counters with the instance's values, they may
+        # have been changed in the database since the instance was loaded.
+        if self.pk is not None and not kwargs.get("force_insert") \
+                and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.local_fields
+                if not field.primary_key and field.name not in self.COUNTERS ]
+        return super(Thread, self).save(*args, **kwargs)
+
     @property
     def starting_email(self):
         # Also cache in the instance because we're going to use it a lot
@@ -483,13 +630,6 @@ class Thread(models.Model):
         """Set of email senders in this thread"""
         return Sender.objects.filter(emails__thread_id=self.id).distinct()
 
-    @property
-    def participants_count(self):
-        return cache.get_or_set(
-            "Thread:%s:participants_count" % self.id,
-            lambda: self.participants.count(),
-            None)
-
     def replies_after(self, date):
         return self.emails.filter(date__gt=date)
 
@@ -510,13 +650,6 @@ class Thread(models.Model):
     #    self.category_id = category.id
     #category = property(_get_category, _set_category)
 
-    @property
-    def emails_count(self):
-        return cache.get_or_set(
-            "Thread:%s:emails_count" % self.id,
-            lambda: self.emails.count(),
-            None)
-
     @property
     def subject(self):
         return cache.get_or_set(
@@ -525,7 +658,7 @@ class Thread(models.Model):
             None)
 
     def get_votes(self):
-        return get_votes(self)
+        return get_votes_status(self.likes, self.dislikes)
 
     @property
     def prev_thread(self): # TODO: Make it a relationship
@@ -563,6 +696,9 @@ class Thread(models.Model):
                              "to a newer thread.")
         current_starter.parent = new_starter
         current_starter.save(update_fields=["parent_id"])
+        # The starter now has a parent, don't reconcile it when the message
+        # it replies to is archived
+        UnresolvedReply.objects.filter(email__thread=self).delete()
         for email in self.emails.all():
             email.thread = thread
             email.save()
@@ -570,14 +706,57 @@ class Thread(models.Model):
                 thread.date_active = email.date
         thread.save()
         compute_thread_order_and_depth(thread)
+        update_threads_counts([thread.id])
         assert self.emails.count() == 0
         self.delete()
 
+def update_threads_counts(thread_ids):
+    """
+    Compute the counters of the threads from their emails and votes.
+    """
+    thread_ids = list(set(thread_ids))
+    for index in range(0, len(thread_ids), 500):
+        ids = thread_ids[index:index+500]
+        emails = Email.objects.filter(thread_id__in=ids).values_list(
+            "thread_id").order_by()
+        emails_counts = dict(emails.annotate(Count("id")))
+        participants_counts = dict(emails.annotate(
+            Count("sender", distinct=True)))
+        votes = {}
+        for thread_id, value, count in Vote.objects.filter(
+                email__thread_id__in=ids).values_list(
+                "email__thread_id", "value").order_by().annotate(Count("id")):
+            votes[(thread_id, value)] = count
+        for thread_id in ids:
+            Thread.objects.filter(id=thread_id).update(
+                emails_count=emails_counts.get(thread_id, 0),
+                participants_count=participants_counts.get(thread_id, 0),
+                likes=votes.get((thread_id, 1), 0),
+                dislikes=votes.get((thread_id, -1), 0))
+
+@receiver(post_save, sender=Email)
+def Thread_count_new_email(sender, **kwargs):
+    """Update the counters of the thread, unless the email was bulk-inserted"""
+    email = kwargs["instance"]
+    if not kwargs["created"] or kwargs.get("raw"):
+        return
+    new_participant = not Email.objects.filter(
+        thread_id=email.thread_id, sender_id=email.sender_id
+        ).exclude(id=email.id).exists()
+    Thread.objects.filter(id=email.thread_id).update(
+        emails_count=F("emails_count") + 1,
+        participants_count=F("participants_count") + int(new_participant))
+
+@receiver(post_delete, sender=Email)
+def Thread_count_deleted_email(sender, **kwargs):
+    # the votes on the email have been deleted too
+    update_threads_counts([kwargs["instance"].thread_id])
+
 @receiver([post_save, post_delete], sender=Email)
 def refresh_email_count_cache(sender, **kwargs):
     email = kwargs["instance"]
-    cache.delete("Thread:%s:emails_count" % email.thread_id)
-    cache.delete("Thread:%s:participants_count" % email.thread_id)
+    # the counters of the cached threads have changed
+    cache.delete("MailingList:%s:recent_threads" % email.mailinglist_id)
     cache.delete("MailingList:%s:recent_participants_count"
                  % email.mailinglist_id)
     cache.delete("MailingList:%s:top_posters" % email.mailinglist_id)
@@ -587,16 +766,24 @@ def refresh_email_count_cache(sender, **kwargs):
                  % (email.mailinglist_id, email.date.year, email.date.month))
     # don't warm up the cache in batch mode (mass import)
     if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
-        # pylint: disable=pointless-statement
-        try:
-            email.thread.emails_count
-            email.thread.participants_count
-            email.mailinglist.recent_participants_count
-            email.mailinglist.top_posters
-            email.mailinglist.get_participants_count_for_month(
-                email.date.year, email.date.month)
-        except (Thread.DoesNotExist, MailingList.DoesNotExist):
-            pass # it's post_delete, those may have been deleted too
+        # Warm it up later, once for a burst of emails. On post_delete, the
+        # thread and the list may have been deleted too.
+        mlist_id = email.mailinglist_id
+        year, month = email.date.year, email.date.month
+        refresh_scheduler.schedule(
+            "MailingList:%s:counts" % mlist_id,
+            lambda: _warm_up_mailinglist(mlist_id))
+        refresh_scheduler.schedule(
+            "MailingList:%s:p_count_for:%s:%s" % (mlist_id, year, month),
+            lambda: MailingList.objects.get(
+                name=mlist_id).get_participants_count_for_month(year, month))
+
+def _warm_up_mailinglist(mlist_id):
+    # pylint: disable=pointless-statement
+    mlist = MailingList.objects.get(name=mlist_id)
+    mlist.recent_participants_count
+    mlist.top_posters
+    mlist.recent_threads
 
 
 @receiver([post_save, post_delete], sender=Thread)
@@ -605,8 +792,10 @@ def refresh_thread_count_cache(sender, **kwargs):
     cache.delete("MailingList:%s:recent_threads" % thread.mailinglist_id)
     # don't warm up the cache in batch mode (mass import)
     if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
-        # pylint: disable=pointless-statement
-        thread.mailinglist.recent_threads
+        mlist_id = thread.mailinglist_id
+        refresh_scheduler.schedule(
+            "MailingList:%s:counts" % mlist_id,
+            lambda: _warm_up_mailinglist(mlist_id))
 
 
 @receiver(pre_delete, sender=Email)
@@ -640,10 +829,22 @@ admin.site.register(Vote)
 def Vote_clean_cache(sender, **kwargs):
     """Delete cached vote values for Email and Thread instance"""
     vote = kwargs["instance"]
-    cache.delete("Thread:%s:votes" % vote.email.thread_id)
+    cache.delete("MailingList:%s:recent_threads" % vote.email.mailinglist_id)
     # re-populate the cache?
     cache.delete("Email:%s:votes" % vote.email_id)
 
+@receiver([post_save, post_delete], sender=Vote)
+def Thread_count_votes(sender, **kwargs):
+    vote = kwargs["instance"]
+    thread_id = Email.objects.filter(id=vote.email_id).values_list(
+        "thread_id", flat=True).first()
+    if thread_id is None:
+        return # the email is being deleted
+    votes = Vote.objects.filter(email__thread_id=thread_id)
+    Thread.objects.filter(id=thread_id).update(
+        likes=votes.filter(value=1).count(),
+        dislikes=votes.filter(value=-1).count())
+
 
 
 class Tagging(models.Model):
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import json
+import mailbox
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+
+from hyperkitty.lib.benchmark import MboxGenerator
+from hyperkitty.models import Email, Attachment
+from hyperkitty.tests.utils import TestCase
+
+
+class MboxGeneratorTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _generate(self, name, count, **kwargs):
+        mbfile = os.path.join(self.tmpdir, name)
+        MboxGenerator(**kwargs).generate(mbfile, count)
+        return mbfile
+
+    def test_generate(self):
+        mbfile = self._generate("test.mbox", 100, thread_depth=2,
+                                attachment_ratio=0.5)
+        messages = dict((msg["Message-ID"], msg)
+                        for msg in mailbox.mbox(mbfile))
+        self.assertEqual(len(messages), 100)
+        with_attachment = [msg for msg in messages.values()
+                           if msg.is_multipart()]
+        self.assertTrue(20 < len(with_attachment) < 80)
+        for msg in messages.values():
+            depth = 0
+            while msg["In-Reply-To"]:
+                msg = messages[msg["In-Reply-To"]]
+                depth += 1
+            self.assertTrue(depth <= 2)
+
+    def test_seed(self):
+        mbfile1 = self._generate("test1.mbox", 20)
+        mbfile2 = self._generate("test2.mbox", 20)
+        mbfile3 = self._generate("test3.mbox", 20, seed=42)
+        with open(mbfile1) as mbox1, open(mbfile2) as mbox2, \
+                open(mbfile3) as mbox3:
+            content = mbox1.read()
+            self.assertEqual(content, mbox2.read())
+            self.assertNotEqual(content, mbox3.read())
+
+    def test_unknown_charset(self):
+        self.assertRaises(ValueError, MboxGenerator, charsets=["unknown"])
+
+
+class BenchmarkCommandTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_report(self):
+        output = os.path.join(self.tmpdir, "report.json")
+        call_command("hyperkitty_benchmark", list_address="list@example.com",
+                     messages=30, attachment_ratio=0.2, output=output,
+                     verbosity=0)
+        with open(output) as report_file:
+            report = json.load(report_file)
+        self.assertEqual(report["messages"], 30)
+        self.assertEqual(Email.objects.count(), 30)
+        self.assertTrue(Attachment.objects.count() > 0)
+        self.assertEqual(report["environment"]["database"]["vendor"],
+                         "sqlite")
+        for stage in ("parse", "scrub", "write", "thread"):
+            self.assertTrue(stage in report["stages"])
+        self.assertEqual(report["stages"]["write"]["count"], 30)
+        self.assertEqual(report["parameters"]["messages"], 30)
+
+    def test_scrub(self):
+        output = os.path.join(self.tmpdir, "report.json")
+        call_command("hyperkitty_benchmark", messages=30, attachment_ratio=0.2,
+                     scrub=True, output=output, verbosity=0)
+        with open(output) as report_file:
+            report = json.load(report_file)
+        self.assertEqual(report["messages"], 30)
+        self.assertTrue(0 < report["inline_text"] < 30)
+        self.assertEqual(report["mismatches"], 0)
+        self.assertTrue(report["speedup"] > 0)
+        self.assertEqual(Email.objects.count(), 0)
@@ -2,10 +2,24 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import gzip
+import mailbox
+import os
+import shutil
+import tempfile
+import threading
 from email.message import Message
 from textwrap import dedent
 
-from hyperkitty.management.commands.hyperkitty_import import DbImporter
+from mock import patch
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from hyperkitty.management.commands.hyperkitty_import import (
+    DbImporter, Checkpoint, read_manifest)
+from hyperkitty.models import Email, Thread, Attachment
+from hyperkitty.tests.test_fetcher import FakeServer, FakeHandler
 from hyperkitty.tests.utils import TestCase
 
 
@@ -16,8 +30,30 @@ class DbImporterTestCase(TestCase):
             "no_download": True,
             "verbosity": 0,
             "since": None,
+            "batch_size": 10,
+            "index_size": 1000,
         }
         self.importer = DbImporter("example-list", options)
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_mbox(self, count):
+        mbfile = os.path.join(self.tmpdir, "test.mbox")
+        mbox = mailbox.mbox(mbfile)
+        for num in range(1, count + 1):
+            msg = mailbox.mboxMessage()
+            msg["From"] = "dummy%d@example.com" % num
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["Subject"] = "Dummy message %d" % num
+            msg["Date"] = "Mon, 02 Feb 2015 13:%02d:00 +0100" % num
+            if num > 1:
+                msg["In-Reply-To"] = "<msg%d>" % (num - 1)
+            msg.set_payload("Dummy message %d" % num)
+            mbox.add(msg)
+        mbox.close()
+        return mbfile
 
     def test_empty_attachment(self):
         # Make sure the content of an attachment is not unicode when it hasn't
@@ -40,3 +76,216 @@ class DbImporterTestCase(TestCase):
         attachments = self.importer.extract_attachments(msg)
         self.assertEqual(len(attachments), 1)
         self.assertFalse(isinstance(attachments[0]["content"], unicode))
+
+    def test_find_attachments_once(self):
+        mbfile = self._make_mbox(3)
+        with patch.object(self.importer, "find_attachments",
+                          wraps=self.importer.find_attachments) as find:
+            self.importer.from_mbox(mbfile)
+        self.assertEqual(Email.objects.count(), 3)
+        self.assertEqual(find.call_count, 3)
+
+    def test_download_attachments(self):
+        server = FakeServer(("127.0.0.1", 0), FakeHandler)
+        server.lock = threading.Lock()
+        server.requests = []
+        server.connections = set()
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        mbfile = os.path.join(self.tmpdir, "test.mbox")
+        mbox = mailbox.mbox(mbfile)
+        for num, path in enumerate(["file1.bin", "file2.bin", "nothere"]):
+            msg = mailbox.mboxMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % num
+            msg.set_payload(dedent("""
+            Dummy message
+            -------------- next part --------------
+            A non-text attachment was scrubbed...
+            Name: %s
+            Type: application/octet-stream
+            Size: 9 bytes
+            Desc: not available
+            Url : http://127.0.0.1:%d/%s
+            """) % (path, server.server_port, path))
+            mbox.add(msg)
+        mbox.close()
+        self.importer.no_download = False
+        self.importer.download_cache = os.path.join(self.tmpdir, "cache")
+        try:
+            # the contents are checked in the database
+            with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=None), \
+                    patch.object(self.importer, "find_attachments",
+                        wraps=self.importer.find_attachments) as find:
+                self.importer.from_mbox(mbfile)
+        finally:
+            server.shutdown()
+            server.server_close()
+        # the messages are scanned once, when they are read ahead
+        self.assertEqual(find.call_count, 3)
+        contents = [ (att.content_type, bytes(att.content)) for att in
+                     Attachment.objects.order_by("email__message_id") ]
+        self.assertEqual(contents, [
+            ("application/octet-stream", b"content 1"),
+            ("application/octet-stream", b"content 2"),
+            ("text/plain", b"not available"),
+            ])
+        self.assertEqual(self.importer.stats.counts["download"], 3)
+        self.assertTrue(os.path.isdir(self.importer.download_cache))
+
+    def test_import(self):
+        self.importer.from_mbox(self._make_mbox(5))
+        self.assertEqual(Email.objects.count(), 5)
+        self.assertEqual(Thread.objects.count(), 1)
+        thread = Thread.objects.get()
+        self.assertEqual(self.importer.impacted_thread_ids, set([thread.id]))
+        for num in range(2, 6):
+            email = Email.objects.get(message_id="msg%d" % num)
+            self.assertEqual(email.parent.message_id, "msg%d" % (num - 1))
+        self.assertEqual(self.importer.stats.counts["parse"], 5)
+        self.assertEqual(self.importer.stats.counts["write"], 5)
+
+    def test_import_gzip(self):
+        mbfile = self._make_mbox(5)
+        with open(mbfile) as mbox:
+            gzmbox = gzip.open(mbfile + ".gz", "wb")
+            gzmbox.write(mbox.read())
+            gzmbox.close()
+        self.importer.from_mbox(mbfile + ".gz")
+        self.assertEqual(Email.objects.count(), 5)
+        self.assertEqual(Thread.objects.count(), 1)
+
+    def test_import_duplicate(self):
+        mbfile = self._make_mbox(3)
+        self.importer.from_mbox(mbfile)
+        self.importer.from_mbox(mbfile)
+        self.assertEqual(Email.objects.count(), 3)
+
+    def test_import_jobs(self):
+        self.importer.jobs = 2
+        self.importer.from_mbox(self._make_mbox(50))
+        self.assertEqual(Email.objects.count(), 50)
+        self.assertEqual(Thread.objects.count(), 1)
+        # The messages must be written in the mbox order
+        self.assertEqual(
+            list(Email.objects.order_by("id").values_list(
+                "message_id", flat=True)),
+            [ "msg%d" % num for num in range(1, 51) ])
+        self.assertEqual(self.importer.stats.counts["parse"], 50)
+
+
+    def test_checkpoint(self):
+        path = os.path.join(self.tmpdir, "checkpoint.json")
+        checkpoint = Checkpoint(path, "example-list")
+        checkpoint.set_position("test.mbox", 1234, 10)
+        loaded = Checkpoint(path, "example-list")
+        loaded.load()
+        self.assertEqual(loaded.started_at, checkpoint.started_at)
+        self.assertTrue(loaded.since is None)
+        self.assertEqual(loaded.get_position("test.mbox"), (1234, 10, False))
+        self.assertEqual(loaded.get_position("other.mbox"), (0, 0, False))
+        self.assertRaises(ValueError, Checkpoint(path, "other-list").load)
+
+    def test_import_resume(self):
+        mbfile = self._make_mbox(30)
+        path = os.path.join(self.tmpdir, "checkpoint.json")
+        self.importer.checkpoint = Checkpoint(path, "example-list")
+        self.importer.checkpoint.save()
+        # Interrupt the import in the third batch
+        orig_parse = self.importer.parse
+        parsed = []
+        def _parse(raw, scrubbed=None):
+            result = orig_parse(raw, scrubbed)
+            if result.msgid == "<msg25>":
+                raise KeyboardInterrupt
+            parsed.append(result.msgid)
+            return result
+        with patch.object(self.importer, "parse", _parse):
+            self.assertRaises(KeyboardInterrupt,
+                              self.importer.from_mbox, mbfile)
+        self.assertEqual(Email.objects.count(), 20)
+        # Resume with a new importer
+        checkpoint = Checkpoint(path, "example-list")
+        checkpoint.load()
+        offset, count, done = checkpoint.get_position(mbfile)
+        self.assertEqual(count, 20)
+        self.assertFalse(done)
+        self.assertEqual(checkpoint.get_impacted_thread_ids(),
+                         set([Thread.objects.get().id]))
+        importer = DbImporter("example-list", {
+            "no_download": True, "verbosity": 0, "since": None,
+            "batch_size": 10, "index_size": 1000})
+        importer.checkpoint = checkpoint
+        parsed = []
+        with patch.object(importer, "parse", lambda raw, scrubbed=None:
+                          parsed.append(raw) or orig_parse(raw, scrubbed)):
+            importer.from_mbox(mbfile)
+        # Only the messages after the checkpoint have been parsed again
+        self.assertEqual(len(parsed), 10)
+        self.assertEqual(Email.objects.count(), 30)
+        self.assertEqual(Thread.objects.count(), 1)
+        self.assertEqual(checkpoint.get_position(mbfile)[1:], (30, True))
+        # A finished file is skipped
+        importer.from_mbox(mbfile)
+        self.assertEqual(len(parsed), 10)
+
+    def _make_manifest(self, lines):
+        path = os.path.join(self.tmpdir, "manifest.txt")
+        with open(path, "w") as manifest:
+            manifest.write("\n".join(lines) + "\n")
+        return path
+
+    def test_read_manifest(self):
+        path = self._make_manifest([
+            "# list address and mbox files",
+            "list1@example.com a.mbox b.mbox",
+            "",
+            "list2@example.com c.mbox",
+            "list1@example.com d.mbox",
+            ])
+        self.assertEqual(read_manifest(path).items(), [
+            ("list1@example.com", ["a.mbox", "b.mbox", "d.mbox"]),
+            ("list2@example.com", ["c.mbox"]),
+            ])
+        self.assertRaises(ValueError, read_manifest,
+                          self._make_manifest(["# nothing"]))
+
+    def test_manifest(self):
+        mbfile = self._make_mbox(5)
+        manifest = self._make_manifest([
+            "list1@example.com %s" % mbfile,
+            "list2@example.com %s" % mbfile,
+            ])
+        call_command("hyperkitty_import", manifest=manifest, list_jobs=1,
+                     no_sync_mailman=True, verbosity=0)
+        for list_name in ("list1@example.com", "list2@example.com"):
+            self.assertEqual(Email.objects.filter(
+                mailinglist__name=list_name).count(), 5)
+            self.assertEqual(Thread.objects.filter(
+                mailinglist__name=list_name).count(), 1)
+
+    def test_manifest_failure(self):
+        # A failed list does not prevent the other lists from being imported
+        mbfile = self._make_mbox(5)
+        manifest = self._make_manifest([
+            "list1@example.com %s" % mbfile,
+            "list2@example.com %s" % mbfile,
+            ])
+        orig_from_mbox = DbImporter.from_mbox
+        def _from_mbox(importer, path):
+            if importer.list_address == "list1@example.com":
+                raise ValueError("broken archive")
+            return orig_from_mbox(importer, path)
+        with patch.object(DbImporter, "from_mbox", _from_mbox):
+            with patch("hyperkitty.management.commands.hyperkitty_import"
+                       ".sync_with_mailman") as sync:
+                self.assertRaises(CommandError, call_command,
+                    "hyperkitty_import", manifest=manifest, list_jobs=1,
+                    verbosity=0, stderr=open(os.devnull, "w"))
+        self.assertEqual(Email.objects.filter(
+            mailinglist__name="list1@example.com").count(), 0)
+        self.assertEqual(Email.objects.filter(
+            mailinglist__name="list2@example.com").count(), 5)
+        # Mailman is synchronized once for all the lists
+        self.assertEqual(sync.call_count, 1)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import gzip
+import os
+import shutil
+import tempfile
+from datetime import date
+
+from django.core.management.base import CommandError
+
+from hyperkitty.management.commands.hyperkitty_import import DbImporter
+from hyperkitty.management.commands.mailman2_download import (
+    Command, MonthlyArchivesReader, _get_archive_url)
+from hyperkitty.models import Email
+from hyperkitty.tests.utils import TestCase
+
+
+class MonthlyArchivesReaderTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+        self.sources = []
+        for month in range(1, 6):
+            path = os.path.join(self.tmpdir, "2015-%02d.txt.gz" % month)
+            archive = gzip.open(path, "wb")
+            for num in range(1, 4):
+                archive.write(
+                    "From dummy at example.com  Mon Jan  5 10:00:00 2015\n"
+                    "From: dummy at example.com (Dummy)\n"
+                    "Date: Mon, 05 %02d 2015 10:%02d:00 +0000\n"
+                    "Subject: Message %d-%d\n"
+                    "Message-ID: <msg%d-%d@example.com>\n"
+                    "\n"
+                    "Dummy message\n"
+                    "\n" % (month, num, month, num, month, num))
+            archive.close()
+            self.sources.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_order(self):
+        reader = MonthlyArchivesReader(self.sources, jobs=2, verbosity=0)
+        try:
+            messages = [ message for message, _stop in reader.messages() ]
+        finally:
+            reader.close()
+        self.assertEqual(len(messages), 15)
+        expected = [ "Message-ID: <msg%d-%d@example.com>" % (month, num)
+                     for month in range(1, 6) for num in range(1, 4) ]
+        self.assertEqual(
+            [ line for message in messages for line in message.splitlines()
+              if line.startswith("Message-ID") ],
+            expected)
+
+    def test_missing_archive(self):
+        self.sources.insert(2, os.path.join(self.tmpdir, "missing.txt.gz"))
+        reader = MonthlyArchivesReader(self.sources, jobs=2, verbosity=0)
+        try:
+            self.assertEqual(len(list(reader.messages())), 15)
+        finally:
+            reader.close()
+
+    def test_import(self):
+        importer = DbImporter("list@example.com", {
+            "no_download": True, "verbosity": 0, "since": None,
+            "batch_size": 10, "index_size": 1000})
+        reader = MonthlyArchivesReader(self.sources, jobs=3, verbosity=0)
+        try:
+            importer.from_reader(reader, "test")
+        finally:
+            reader.close()
+        self.assertEqual(Email.objects.count(), 15)
+        self.assertEqual(
+            list(Email.objects.order_by("id").values_list(
+                "message_id", flat=True)),
+            [ "msg%d-%d@example.com" % (month, num)
+              for month in range(1, 6) for num in range(1, 4) ])
+
+
+class CommandOptionsTestCase(TestCase):
+
+    def _options(self, **kw):
+        options = {"url": "http://lists.example.com",
+                   "list_address": "list@example.com", "start": "2013",
+                   "jobs": 5, "verbosity": 0}
+        options.update(kw)
+        return options
+
+    def test_archive_url(self):
+        # Pipermail names the archive directories after the list name only
+        self.assertEqual(
+            _get_archive_url(self._options(), 2015, "May"),
+            "http://lists.example.com/pipermail/list/2015-May.txt.gz")
+
+    def test_start(self):
+        options = self._options()
+        Command()._check_options([], options)
+        self.assertEqual(options["start"],
+                         range(2013, date.today().year + 1))
+        self.assertRaises(CommandError, Command()._check_options, [],
+                          self._options(start="next year"))
+
+    def test_no_arguments(self):
+        # The archives are downloaded, there are no files to give
+        self.assertRaises(CommandError, Command()._check_options,
+                          ["archive.txt"], self._options())
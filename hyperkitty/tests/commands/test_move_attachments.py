@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.lib.storage import FileSystemStore
+from hyperkitty.models import Attachment
+from hyperkitty.tests.test_storage import _make_message
+from hyperkitty.tests.utils import TestCase
+
+
+class MoveAttachmentsTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_move(self):
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=None):
+            for num in range(5):
+                add_to_list("list@example.com", _make_message(
+                    num, content=b"content %d" % (num % 3)))
+        self.assertEqual(
+            Attachment.objects.filter(content__isnull=False).count(), 5)
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir):
+            call_command("hyperkitty_move_attachments", batch_size=2,
+                         verbosity=0)
+            self.assertEqual(
+                Attachment.objects.filter(content__isnull=False).count(), 0)
+            store = FileSystemStore(self.tmpdir)
+            for attachment in Attachment.objects.all():
+                self.assertTrue(store.exists(attachment.content_hash))
+                self.assertEqual(attachment.get_content(),
+                    b"content %d" % (int(attachment.email.message_id[3:]) % 3))
+        self.assertEqual(
+            len(set(Attachment.objects.values_list("content_hash",
+                                                   flat=True))), 3)
+
+    def test_no_folder(self):
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=None):
+            self.assertRaises(CommandError, call_command,
+                              "hyperkitty_move_attachments", verbosity=0)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from email.message import Message
+
+from django.core.management import call_command
+
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.lib.renderer import RENDERER_VERSION
+from hyperkitty.models import Email
+from hyperkitty.tests.utils import TestCase
+
+
+class RenderCommandTestCase(TestCase):
+
+    def _add(self, list_name, num):
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg%d>" % num
+        msg.set_payload("> quoted\nmessage %d" % num)
+        add_to_list(list_name, msg)
+
+    def test_render(self):
+        for num in range(5):
+            self._add("list1@example.com", num)
+        self._add("list2@example.com", 5)
+        Email.objects.update(content_html=None, renderer_version=None)
+        call_command("hyperkitty_render", list_address="list1@example.com",
+                     batch_size=2, verbosity=0)
+        self.assertEqual(Email.objects.filter(
+            renderer_version=RENDERER_VERSION).count(), 5)
+        for email in Email.objects.filter(
+                mailinglist__name="list1@example.com"):
+            self.assertTrue('class="quoted-text"' in email.content_html)
+        call_command("hyperkitty_render", verbosity=0)
+        self.assertFalse(Email.objects.exclude(
+            renderer_version=RENDERER_VERSION).exists())
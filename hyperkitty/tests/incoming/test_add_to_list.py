@@ -9,7 +9,8 @@ from email import message_from_file
 from django.utils import timezone
 from django.db import IntegrityError
 
-from hyperkitty.models import MailingList, Email, Thread, Attachment
+from hyperkitty.models import (MailingList, Email, Thread, Attachment,
+    UnresolvedReply)
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.lib.utils import get_message_id_hash
 from hyperkitty.tests.utils import TestCase, get_test_file
@@ -327,6 +328,96 @@ class TestAddToList(TestCase):
         stored_msg = Email.objects.all()[0]
         self.assertEqual(len(stored_msg.subject), 512)
 
+    def test_reply_before_parent(self):
+        # The replies arrive before the original message
+        for msg_id, parent_id in (("id3", "id2"), ("id2", "id1"),
+                                  ("id4", "id1")):
+            msg = Message()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<%s>" % msg_id
+            msg["In-Reply-To"] = "<%s>" % parent_id
+            msg.set_payload("Dummy message")
+            add_to_list("example-list", msg)
+        self.assertEqual(Thread.objects.count(), 2)
+        self.assertEqual(
+            sorted(UnresolvedReply.objects.values_list(
+                "in_reply_to", flat=True)), ["id1", "id1"])
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<id1>"
+        msg.set_payload("Dummy message")
+        add_to_list("example-list", msg)
+        self.assertEqual(UnresolvedReply.objects.count(), 0)
+        self.assertEqual(Thread.objects.count(), 1)
+        thread = Thread.objects.get()
+        self.assertEqual(thread.thread_id, get_message_id_hash("<id1>"))
+        self.assertEqual(thread.emails.count(), 4)
+        self.assertEqual(thread.starting_email.message_id, "id1")
+        for msg_id, parent_id in (("id2", "id1"), ("id3", "id2"),
+                                  ("id4", "id1")):
+            email = Email.objects.get(message_id=msg_id)
+            self.assertEqual(email.parent.message_id, parent_id)
+        self.assertEqual(
+            list(thread.emails.order_by("thread_order").values_list(
+                "message_id", "thread_depth")),
+            [("id1", 0), ("id2", 1), ("id3", 2), ("id4", 1)])
+        # The moved emails are counted in their new thread
+        self.assertEqual(thread.emails_count, 4)
+        self.assertEqual(thread.participants_count, 1)
+
+    def _add_message(self, msg_id, parent_id=None, date=None):
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<%s>" % msg_id
+        if date is not None:
+            msg["Date"] = date
+        if parent_id is not None:
+            msg["In-Reply-To"] = "<%s>" % parent_id
+        msg.set_payload("Dummy message")
+        add_to_list("example-list", msg)
+        return Email.objects.get(message_id=msg_id)
+
+    def test_reply_before_parent_attached(self):
+        # An orphan reply was manually attached to another thread before the
+        # original message was archived
+        orphan = self._add_message("id2", "id1",
+                                   "Fri, 02 Nov 2012 16:10:00 +0000")
+        starter = self._add_message("id3", None,
+                                    "Fri, 02 Nov 2012 16:05:00 +0000")
+        orphan.thread.attach_to(starter.thread)
+        self.assertEqual(UnresolvedReply.objects.count(), 0)
+        self._add_message("id1")
+        self.assertEqual(Thread.objects.count(), 2)
+        self.assertEqual(Email.objects.get(message_id="id2").parent.message_id,
+                         "id3")
+        self.assertEqual(Email.objects.get(message_id="id3").parent, None)
+
+    def test_reply_before_parent_moved(self):
+        # Only the subtree of an orphan which is not the starter of its
+        # thread is moved to the original message's thread
+        self._add_message("id3")
+        self._add_message("id2", "id3")
+        self._add_message("id4", "id2")
+        self._add_message("id5", "id3")
+        orphan = Email.objects.get(message_id="id2")
+        orphan.in_reply_to = "id1"
+        orphan.save()
+        UnresolvedReply.objects.create(email=orphan,
+            mailinglist=orphan.mailinglist, in_reply_to="id1")
+        parent = self._add_message("id1")
+        self.assertEqual(
+            list(parent.thread.emails.order_by("thread_order").values_list(
+                "message_id", "thread_depth")),
+            [("id1", 0), ("id2", 1), ("id4", 2)])
+        old_thread = Email.objects.get(message_id="id3").thread
+        self.assertEqual(
+            list(old_thread.emails.order_by("thread_order").values_list(
+                "message_id", "thread_depth")),
+            [("id3", 0), ("id5", 1)])
+        self.assertEqual(
+            Thread.objects.get(id=parent.thread_id).emails_count, 3)
+        self.assertEqual(Thread.objects.get(id=old_thread.id).emails_count, 2)
+
 
 
 #class TestStormStoreWithSearch(unittest.TestCase):
@@ -25,9 +25,12 @@ from __future__ import absolute_import, print_function, unicode_literals
 from email.message import Message
 
 from django.utils.timezone import now
+from mock import patch
 
 from hyperkitty.models import MailingList, Email, Thread, Sender
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
+from hyperkitty.lib.analysis import (
+    compute_thread_order_and_depth, compute_threads_order_and_depth,
+    get_thread_order_and_depth)
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.tests.utils import TestCase
 
@@ -177,3 +180,71 @@ class TestThreadOrderDepth(TestCase):
         msg1.save()
         compute_thread_order_and_depth(thread)
         # Don't traceback with a "maximum recursion depth exceeded" error
+
+    def _add_replies(self, replies):
+        # replies: list of (num, parent num or None, minute)
+        for num, parent, minute in replies:
+            msg = Message()
+            msg["From"] = "sender%d@example.com" % num
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["Date"] = "Fri, 02 Nov 2012 16:%02d:00 +0000" % minute
+            if parent is not None:
+                msg["In-Reply-To"] = "<msg%d>" % parent
+            msg.set_payload("message %d" % num)
+            add_to_list("example-list", msg)
+
+    def _get_order(self):
+        return list(Email.objects.order_by("thread_order").values_list(
+            "message_id", "thread_depth"))
+
+    def test_insert_incremental(self):
+        # msg1
+        # |-msg2
+        # | |-msg4
+        # | `-msg5 (new)
+        # `-msg3
+        self._add_replies([(1, None, 1), (2, 1, 2), (3, 1, 3), (4, 2, 4)])
+        with patch("hyperkitty.lib.incoming.compute_thread_order_and_depth") \
+                as full_compute:
+            self._add_replies([(5, 2, 5)])
+        self.assertFalse(full_compute.called)
+        expected = [("msg1", 0), ("msg2", 1), ("msg4", 2), ("msg5", 2),
+                    ("msg3", 1)]
+        self.assertEqual(self._get_order(), expected)
+        # Same result as a full computation
+        compute_thread_order_and_depth(Thread.objects.get())
+        self.assertEqual(self._get_order(), expected)
+
+    def test_insert_older_reply(self):
+        # A reply older than its siblings is not the last one in the order
+        self._add_replies([(1, None, 1), (2, 1, 5), (3, 1, 2)])
+        self.assertEqual(self._get_order(),
+                         [("msg1", 0), ("msg3", 1), ("msg2", 1)])
+
+    def test_deep_thread(self):
+        # Very long reply chains don't hit the recursion limit
+        emails = [(1, None)] + [ (num, num - 1) for num in range(2, 10001) ]
+        positions = get_thread_order_and_depth(emails)
+        self.assertEqual(positions[10000], (9999, 9999))
+
+    def test_loop_detection(self):
+        # 1 <- 2 <- 3 <- 1: the last reply closes a loop and is ignored
+        positions = get_thread_order_and_depth([(1, 3), (2, 1), (3, 2)])
+        self.assertEqual(positions, {3: (0, 0), 1: (1, 1), 2: (2, 2)})
+
+    def test_multiple_threads(self):
+        self._add_replies([(1, None, 1), (2, 1, 2), (3, None, 3), (4, 3, 4),
+                           (5, 3, 5)])
+        Email.objects.update(thread_order=42, thread_depth=42)
+        updated = compute_threads_order_and_depth(
+            Thread.objects.values_list("id", flat=True))
+        self.assertEqual(updated, 5)
+        self.assertEqual(
+            sorted(Email.objects.values_list(
+                "message_id", "thread_order", "thread_depth")),
+            [("msg1", 0, 0), ("msg2", 1, 1), ("msg3", 0, 0), ("msg4", 1, 1),
+             ("msg5", 2, 1)])
+        # Only the emails which have changed are updated
+        Email.objects.filter(message_id="msg5").update(thread_order=42)
+        self.assertEqual(compute_threads_order_and_depth(
+            Thread.objects.values_list("id", flat=True)), 1)
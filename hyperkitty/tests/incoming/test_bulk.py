@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from email.message import Message
+
+from hyperkitty.models import (MailingList, Email, Thread, Sender, Attachment,
+    UnresolvedReply)
+from hyperkitty.lib.bulk import BulkWriter, MessageIdIndex
+from hyperkitty.lib.incoming import add_to_list, parse_message
+from hyperkitty.lib.signals import new_email, new_thread
+from hyperkitty.tests.utils import TestCase
+
+
+class BulkWriterTestCase(TestCase):
+
+    def setUp(self):
+        self.mlist = MailingList.objects.create(name="example-list")
+        self.writer = BulkWriter(self.mlist, batch_size=10)
+
+    def _make_message(self, num, in_reply_to=None):
+        msg = Message()
+        msg["From"] = "sender%d@example.com" % (num % 3)
+        msg["Subject"] = "Subject %d" % num
+        msg["Message-ID"] = "<msg%d>" % num
+        msg["Date"] = "Mon, 02 Feb 2015 13:%02d:00 +0100" % num
+        if in_reply_to is not None:
+            msg["In-Reply-To"] = "<msg%d>" % in_reply_to
+        msg.set_payload("Message %d" % num)
+        return msg
+
+    def _add(self, num, in_reply_to=None, attachments=None):
+        email, email_attachments = parse_message(
+            "example-list", self._make_message(num, in_reply_to))
+        return self.writer.add(email, attachments or email_attachments)
+
+    def test_threads(self):
+        add_to_list("example-list", self._make_message(1))
+        self._add(2, in_reply_to=1)
+        self._add(3)
+        self._add(4, in_reply_to=3)
+        self._add(5, in_reply_to=4)
+        self._add(6, in_reply_to=3)
+        written = self.writer.flush()
+        self.assertEqual(len(written), 5)
+        self.assertEqual(Email.objects.count(), 6)
+        self.assertEqual(Thread.objects.count(), 2)
+        self.assertEqual(Sender.objects.count(), 3)
+        msg1 = Email.objects.get(message_id="msg1")
+        msg3 = Email.objects.get(message_id="msg3")
+        self.assertEqual(Email.objects.get(message_id="msg2").parent, msg1)
+        self.assertEqual(Email.objects.get(message_id="msg2").thread,
+                         msg1.thread)
+        self.assertTrue(msg3.parent is None)
+        self.assertEqual(msg3.thread.thread_id, msg3.message_id_hash)
+        for num, parent in ((4, "msg3"), (5, "msg4"), (6, "msg3")):
+            email = Email.objects.get(message_id="msg%d" % num)
+            self.assertEqual(email.parent.message_id, parent)
+            self.assertEqual(email.thread_id, msg3.thread_id)
+        self.assertEqual(Thread.objects.get(id=msg1.thread_id).date_active,
+                         Email.objects.get(message_id="msg2").date)
+        self.assertEqual(Thread.objects.get(id=msg3.thread_id).date_active,
+                         Email.objects.get(message_id="msg6").date)
+        # The thread counters are updated for the whole batch
+        thread1 = Thread.objects.get(id=msg1.thread_id)
+        thread3 = Thread.objects.get(id=msg3.thread_id)
+        self.assertEqual((thread1.emails_count, thread1.participants_count),
+                         (2, 2))
+        self.assertEqual((thread3.emails_count, thread3.participants_count),
+                         (4, 3))
+
+    def test_batch_size(self):
+        for num in range(1, 10):
+            self.assertEqual(self._add(num), [])
+        self.assertEqual(Email.objects.count(), 0)
+        self.assertEqual(len(self._add(10)), 10)
+        self.assertEqual(Email.objects.count(), 10)
+
+    def test_duplicates(self):
+        add_to_list("example-list", self._make_message(1))
+        self._add(1)
+        self._add(2)
+        self._add(2)
+        written = self.writer.flush()
+        self.assertEqual([email.message_id for email in written], ["msg2"])
+        self.assertEqual(Email.objects.count(), 2)
+
+    def test_attachments(self):
+        self._add(1, attachments=[
+            (0, "file.txt", "text/plain", "utf-8", b"content"),
+            (1, "file.bin", "application/octet-stream", None, b"\x00\x01")])
+        self.writer.flush()
+        email = Email.objects.get(message_id="msg1")
+        self.assertEqual(email.attachments.count(), 2)
+        attachment = Attachment.objects.get(email=email, counter=1)
+        self.assertEqual(attachment.name, "file.bin")
+        self.assertEqual(attachment.size, 2)
+        self.assertEqual(bytes(attachment.content), b"\x00\x01")
+
+    def test_signals(self):
+        events = []
+        def _store_event(sender, **kwargs):
+            events.append(sorted(kwargs))
+        new_email.connect(_store_event)
+        new_thread.connect(_store_event)
+        try:
+            self._add(1)
+            self._add(2, in_reply_to=1)
+            self.writer.flush()
+        finally:
+            new_email.disconnect(_store_event)
+            new_thread.disconnect(_store_event)
+        self.assertEqual(sorted(events), [
+            ["email", "signal"], ["email", "signal"], ["signal", "thread"]])
+
+    def test_fallback(self):
+        # A thread with the same thread_id as msg2 will make the batch fail,
+        # the other messages must still be written.
+        self._add(1)
+        email, attachments = parse_message(
+            "example-list", self._make_message(2))
+        Thread.objects.create(
+            mailinglist=self.mlist, thread_id=email.message_id_hash)
+        self.writer.add(email, attachments)
+        self._add(3, in_reply_to=1)
+        written = self.writer.flush()
+        self.assertEqual([email.message_id for email in written],
+                         ["msg1", "msg3"])
+        self.assertEqual(
+            sorted(Email.objects.values_list("message_id", flat=True)),
+            ["msg1", "msg3"])
+        msg3 = Email.objects.get(message_id="msg3")
+        self.assertEqual(msg3.parent.message_id, "msg1")
+
+    def test_reply_before_parent(self):
+        self._add(2, in_reply_to=1)
+        self._add(1)
+        self.writer.flush()
+        self.assertEqual(Thread.objects.count(), 1)
+        self.assertEqual(UnresolvedReply.objects.count(), 0)
+        msg2 = Email.objects.get(message_id="msg2")
+        self.assertEqual(msg2.parent.message_id, "msg1")
+        self.assertEqual(msg2.thread_depth, 1)
+
+
+class MessageIdIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.mlist = MailingList.objects.create(name="example-list")
+        for num in range(1, 6):
+            msg = Message()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % num
+            msg.set_payload("Dummy message")
+            add_to_list("example-list", msg)
+
+    def test_load(self):
+        index = MessageIdIndex(self.mlist)
+        index.load()
+        self.assertEqual(len(index), 5)
+        self.assertTrue(index.complete)
+        for email in Email.objects.all():
+            self.assertTrue(email.message_id in index)
+            self.assertEqual(index.get(email.message_id),
+                             (email.id, email.thread_id))
+        self.assertFalse("msg6" in index)
+        self.assertTrue(index.get("msg6") is None)
+
+    def test_load_bounded(self):
+        index = MessageIdIndex(self.mlist, max_size=3)
+        index.load_chunk_size = 2
+        index.load()
+        self.assertEqual(len(index), 3)
+        self.assertFalse(index.complete)
+        # the most recent emails are loaded
+        self.assertFalse("msg1" in index)
+        self.assertFalse("msg2" in index)
+        self.assertTrue("msg5" in index)
+
+    def test_add_evicts_oldest(self):
+        index = MessageIdIndex(self.mlist, max_size=5)
+        index.load()
+        self.assertTrue(index.complete)
+        index.add("msg6", 100, 42)
+        self.assertEqual(len(index), 5)
+        self.assertFalse(index.complete)
+        self.assertFalse("msg1" in index)
+        self.assertEqual(index.get("msg6"), (100, 42))
+
+    def test_large_ids(self):
+        index = MessageIdIndex(self.mlist)
+        index.add("msg6", 2**40, 2**32 - 1)
+        index.add("msg7", 100, 2**32)
+        index.add("msg8", 2**40, 2**40 + 1)
+        self.assertEqual(index.get("msg6"), (2**40, 2**32 - 1))
+        self.assertEqual(index.get("msg7"), (100, 2**32))
+        self.assertEqual(index.get("msg8"), (2**40, 2**40 + 1))
+
+    def test_writer_uses_index(self):
+        index = MessageIdIndex(self.mlist)
+        index.load()
+        writer = BulkWriter(self.mlist, index=index)
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg3>"
+        msg.set_payload("Dummy message")
+        writer.add(*parse_message("example-list", msg))
+        # a duplicate found in the index does not need any query
+        with self.assertNumQueries(0):
+            self.assertEqual(writer._write(writer.pending), [])
+        msg.replace_header("Message-ID", "<msg6>")
+        msg["In-Reply-To"] = "<msg3>"
+        writer.pending = []
+        writer.add(*parse_message("example-list", msg))
+        written = writer.flush()
+        self.assertEqual(len(written), 1)
+        email = Email.objects.get(message_id="msg6")
+        self.assertEqual(email.parent.message_id, "msg3")
+        self.assertEqual(index.get("msg6"), (email.id, email.thread_id))
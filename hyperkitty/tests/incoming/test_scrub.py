@@ -2,12 +2,22 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import os
+import pickle
+import quopri
 import unittest
 from email.message import Message
-from email import message_from_file
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email import message_from_file, message_from_string
 from traceback import format_exc
 
-from hyperkitty.lib.scrub import Scrubber
+from django.test.utils import override_settings
+
+from hyperkitty.lib.scrub import (
+    Scrubber, AttachmentContent, AttachmentPlaceholder, decode_payload,
+    SPOOL_SIZE)
 from hyperkitty.tests.utils import get_test_file
 
 
@@ -191,3 +201,96 @@ class TestScrubber(unittest.TestCase):
                 name = attachment[1]
                 self.assertTrue(isinstance(name, unicode),
                                 "attachment %r must be unicode" % name)
+
+    def test_inline_text_fast_path(self):
+        # The single-part text messages are scrubbed without walking over
+        # the parts, the result must be the same.
+        for name in ["payload-utf8.txt", "payload-iso8859.txt",
+                     "payload-unknown.txt", "pipermail_nextpart.txt",
+                     "html-email-1.txt", "attachment-1.txt"]:
+            with open(get_test_file(name)) as email_file:
+                content = email_file.read()
+            scrubber = Scrubber("testlist@example.com",
+                                message_from_string(content))
+            walked = Scrubber("testlist@example.com",
+                              message_from_string(content))._scrub_parts()
+            self.assertEqual(scrubber.scrub(), walked)
+
+    def test_inline_text_guessed_charset(self):
+        for payload, expected in [
+                (b"ascii only", u"ascii only"),
+                (u"d\xe9j\xe0 vu".encode("utf-8"), u"d\xe9j\xe0 vu"),
+                (u"d\xe9j\xe0 vu €".encode("iso-8859-15"),
+                 u"d\xe9j\xe0 vu €"),
+                ]:
+            msg = Message()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<dummy>"
+            msg.set_payload(payload)
+            scrubber = Scrubber("testlist@example.com", msg)
+            self.assertTrue(scrubber._is_inline_text())
+            self.assertEqual(scrubber.scrub(), (expected, []))
+
+    def test_decode_payload(self):
+        # The decoding by chunks must give the same result as the email
+        # module
+        content = os.urandom(300 * 1024)
+        quoted = Message()
+        quoted["Content-Transfer-Encoding"] = "quoted-printable"
+        quoted.set_payload(quopri.encodestring(
+            b"caf\xc3\xa9 = %s\n" % (b"x" * 100) * 5000))
+        parts = [ MIMEApplication(content), quoted,
+                  MIMEText(b"plain text\n" * 20000) ]
+        for part in parts:
+            part = message_from_string(part.as_string())
+            expected = part.get_payload(decode=True)
+            self.assertEqual(decode_payload(part),
+                             (expected, len(expected)))
+            self.assertEqual(decode_payload(part, len(expected) - 1),
+                             (None, len(expected)))
+
+    def test_decode_payload_bad_padding(self):
+        part = MIMEApplication(b"content")
+        part.set_payload(part.get_payload().rstrip("=\n"))
+        self.assertEqual(decode_payload(part)[0],
+                         part.get_payload(decode=True))
+
+    def test_attachment_too_large(self):
+        msg = MIMEMultipart()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<dummy>"
+        msg.attach(MIMEText("Dummy message"))
+        for content in (b"a" * 10, b"b" * 20, b"c" * 10, b"d" * 10):
+            attachment = MIMEApplication(content)
+            attachment.add_header("Content-Disposition", "attachment",
+                                  filename="file.bin")
+            msg.attach(attachment)
+        msg = msg.as_string()
+        with override_settings(HYPERKITTY_ATTACHMENT_MAX_SIZE=15,
+                               HYPERKITTY_MESSAGE_ATTACHMENTS_MAX_SIZE=25):
+            contents, attachments = Scrubber("testlist@example.com",
+                message_from_string(msg)).scrub()
+        self.assertEqual(contents, "Dummy message\n")
+        # The second attachment is too large, the fourth would exceed the
+        # total size of the message's attachments.
+        self.assertEqual([ att[4] for att in attachments ], [
+            b"a" * 10, AttachmentPlaceholder(20), b"c" * 10,
+            AttachmentPlaceholder(10)])
+        # No limit
+        with override_settings(HYPERKITTY_ATTACHMENT_MAX_SIZE=None,
+                               HYPERKITTY_MESSAGE_ATTACHMENTS_MAX_SIZE=None):
+            contents, attachments = Scrubber("testlist@example.com",
+                message_from_string(msg)).scrub()
+        self.assertEqual(len([ att for att in attachments
+                               if isinstance(att[4], AttachmentContent) ]), 4)
+
+    def test_decode_payload_to_file(self):
+        # The large contents are decoded to a file on the disk
+        part = MIMEApplication(b"x" * (SPOOL_SIZE + 1))
+        content, size = decode_payload(part)
+        self.assertEqual(size, SPOOL_SIZE + 1)
+        self.assertTrue(content.file._rolled)
+        self.assertEqual(b"".join(content.chunks()), b"x" * (SPOOL_SIZE + 1))
+        # It is sent to the import processes as a string
+        self.assertEqual(pickle.loads(pickle.dumps(content)),
+                         b"x" * (SPOOL_SIZE + 1))
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from hyperkitty.lib.fetcher import Fetcher
+
+from hyperkitty.tests.utils import TestCase
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    files = {
+        "/file1.bin": b"content 1",
+        "/file2.bin": b"content 2",
+        "/copy-of-file1.bin": b"content 1",
+        }
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.connections.add(self.client_address)
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/file2.bin")
+            content = b""
+        elif self.path == "/error":
+            self.send_response(500)
+            content = b"error"
+        elif self.path in self.files:
+            self.send_response(200)
+            content = self.files[self.path]
+        else:
+            self.send_response(404)
+            content = b"not found"
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass # keep the test output clean
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    # the connections are kept alive, each one needs a thread
+    daemon_threads = True
+
+
+class FetcherTestCase(TestCase):
+
+    def setUp(self):
+        self.server = FakeServer(("127.0.0.1", 0), FakeHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.connections = set()
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_port
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+        self.fetcher = Fetcher(self.tmpdir, workers=4, per_host=1)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_fetch(self):
+        self.assertEqual(self.fetcher.fetch(self.base_url + "/file1.bin"),
+                         b"content 1")
+        self.assertTrue(self.fetcher.fetch(self.base_url + "/nothere") is None)
+        self.assertEqual(self.fetcher.fetch(self.base_url + "/redirect"),
+                         b"content 2")
+
+    def test_cache(self):
+        urls = [ self.base_url + path for path in
+                 ("/file1.bin", "/copy-of-file1.bin", "/nothere") ]
+        for url in urls:
+            self.fetcher.fetch(url)
+        self.assertEqual(len(self.server.requests), 3)
+        # the same content is stored once
+        self.assertEqual(len(os.listdir(os.path.join(self.tmpdir, "objects"))),
+                         1)
+        # a new fetcher with the same cache does not download anything
+        fetcher = Fetcher(self.tmpdir)
+        try:
+            self.assertEqual(fetcher.fetch(urls[0]), b"content 1")
+            self.assertEqual(fetcher.fetch(urls[1]), b"content 1")
+            self.assertTrue(fetcher.fetch(urls[2]) is None)
+        finally:
+            fetcher.close()
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_errors_not_cached(self):
+        url = self.base_url + "/error"
+        self.assertTrue(self.fetcher.fetch(url) is None)
+        self.assertTrue(self.fetcher.fetch(url) is None)
+        self.assertEqual(self.server.requests, ["/error", "/error"])
+
+    def test_prefetch(self):
+        urls = [ "%s/file%d.bin" % (self.base_url, num) for num in (1, 2) ]
+        self.fetcher.prefetch(urls * 3)
+        self.assertEqual(self.fetcher.fetch(urls[0]), b"content 1")
+        self.assertEqual(self.fetcher.fetch(urls[1]), b"content 2")
+        self.assertEqual(sorted(self.server.requests),
+                         ["/file1.bin", "/file2.bin"])
+
+    def test_connection_reuse(self):
+        fetcher = Fetcher(self.tmpdir, workers=1)
+        try:
+            for path in ("/file1.bin", "/file2.bin", "/copy-of-file1.bin"):
+                fetcher.fetch(self.base_url + path)
+        finally:
+            fetcher.close()
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_close_connections(self):
+        for path in ("/file1.bin", "/file2.bin"):
+            self.fetcher.fetch(self.base_url + path)
+        connections = list(self.fetcher._connections)
+        self.assertTrue(len(connections) > 0)
+        self.assertTrue(all(conn.sock is not None for conn in connections))
+        self.fetcher.close()
+        self.assertEqual(self.fetcher._connections, set())
+        self.assertTrue(all(conn.sock is None for conn in connections))
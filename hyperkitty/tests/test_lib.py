@@ -22,13 +22,24 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import datetime
+import gzip
+import mailbox
+import os
+import shutil
+import tempfile
+from urllib2 import HTTPError
 
+import mailmanclient
+from mock import Mock
 from django.http import HttpRequest
 from django.utils.timezone import utc
 
 from hyperkitty.lib.view_helpers import get_display_dates, show_mlist
 from hyperkitty.lib.paginator import paginate
-from hyperkitty.models import MailingList
+from hyperkitty.lib.mbox import (MboxReader, GzipMboxReader, open_mbox,
+    split_mbox)
+from hyperkitty.lib.mailman import set_senders_mailman_id
+from hyperkitty.models import MailingList, Sender
 
 from hyperkitty.tests.utils import TestCase
 
@@ -139,3 +150,114 @@ class ShowMlistTestCase(TestCase):
 
     def test_different_single_component_domain(self):
         self._do_test("intranet", "extranet", False)
+
+
+class MboxReaderTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+        self.mbfile = os.path.join(self.tmpdir, "test.mbox")
+        mbox = mailbox.mbox(self.mbfile)
+        for num in range(1, 6):
+            msg = mailbox.mboxMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % num
+            msg.set_payload("Dummy message %d\n>From the body\n" % num)
+            mbox.add(msg)
+        mbox.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_same_as_mailbox(self):
+        mbox = mailbox.mbox(self.mbfile)
+        expected = [mbox.get_string(key) for key in mbox.iterkeys()]
+        with MboxReader(self.mbfile) as reader:
+            messages = list(reader.messages())
+        self.assertEqual([msg for msg, _stop in messages], expected)
+        self.assertEqual(messages[-1][1], os.path.getsize(self.mbfile))
+
+    def test_offset(self):
+        with MboxReader(self.mbfile) as reader:
+            stops = [stop for _msg, stop in reader.messages()]
+            # the offset can be the start of a message or anywhere before it
+            for offset in (stops[1], stops[1] - 3):
+                messages = list(reader.messages(offset))
+                self.assertEqual(len(messages), 3)
+                self.assertTrue("<msg3>" in messages[0][0])
+            self.assertEqual(list(reader.messages(stops[-1])), [])
+
+    def test_empty(self):
+        open(self.mbfile, "w").close()
+        with MboxReader(self.mbfile) as reader:
+            self.assertEqual(reader.size, 0)
+            self.assertEqual(list(reader.messages()), [])
+
+    def test_split_stream(self):
+        with MboxReader(self.mbfile) as reader:
+            expected = list(reader.messages())
+        with open(self.mbfile) as mbox:
+            content = mbox.read()
+        # use small chunks to split the lines and the separators
+        chunks = [ content[index:index+7]
+                   for index in range(0, len(content), 7) ]
+        self.assertEqual(list(split_mbox(chunks)), expected)
+
+    def test_gzip(self):
+        with MboxReader(self.mbfile) as reader:
+            expected = list(reader.messages())
+        gzfile = self.mbfile + ".gz"
+        with open(self.mbfile) as mbox:
+            gzmbox = gzip.open(gzfile, "wb")
+            gzmbox.write(mbox.read())
+            gzmbox.close()
+        reader = open_mbox(gzfile)
+        self.assertTrue(isinstance(reader, GzipMboxReader))
+        with reader:
+            self.assertTrue(reader.size is None)
+            self.assertEqual(list(reader.messages()), expected)
+            self.assertEqual(list(reader.messages(expected[1][1])),
+                             expected[2:])
+
+
+class SendersMailmanIdTestCase(TestCase):
+
+    def setUp(self):
+        for num in range(10):
+            Sender.objects.create(address="user%d@example.com" % num)
+
+    def test_resolve(self):
+        def _get_user(address):
+            if address == "user3@example.com":
+                raise HTTPError(None, 404, "Not Found", None, None)
+            return Mock(user_id="id-%s" % address.partition("@")[0])
+        self.mailman_client.get_user.side_effect = _get_user
+        self.assertEqual(set_senders_mailman_id(batch_size=3, jobs=2), 9)
+        self.assertEqual(
+            Sender.objects.get(address="user5@example.com").mailman_id,
+            "id-user5")
+        self.assertEqual(list(Sender.objects.filter(
+            mailman_id__isnull=True).values_list("address", flat=True)),
+            ["user3@example.com"])
+        # The senders which are not Mailman users are not looked up again
+        # until the delay expires
+        self.mailman_client.get_user.reset_mock()
+        self.assertEqual(set_senders_mailman_id(), 0)
+        self.assertFalse(self.mailman_client.get_user.called)
+        with self.settings(HYPERKITTY_MAILMAN_SENDER_TTL=-1):
+            self.assertEqual(set_senders_mailman_id(), 0)
+        self.assertEqual(self.mailman_client.get_user.call_count, 1)
+
+    def test_circuit_breaker(self):
+        # Mailman is not called any more after a few failures
+        self.mailman_client.get_user.side_effect = \
+            mailmanclient.MailmanConnectionError()
+        self.assertEqual(set_senders_mailman_id(batch_size=5, jobs=1), 0)
+        self.assertEqual(self.mailman_client.get_user.call_count, 5)
+        # The failures don't count as lookups
+        self.assertEqual(
+            Sender.objects.filter(mailman_checked__isnull=False).count(), 0)
+        self.mailman_client.get_user.side_effect = \
+            lambda address: Mock(user_id="dummy")
+        self.assertEqual(set_senders_mailman_id(), 0)
+        self.assertEqual(self.mailman_client.get_user.call_count, 5)
@@ -29,12 +29,19 @@ import uuid
 from email.message import Message
 from traceback import format_exc
 
-from mock import Mock
+from mock import Mock, PropertyMock, patch
+from mailmanclient import MailmanConnectionError
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, IntegrityError
+from django.test.utils import CaptureQueriesContext
 
+from hyperkitty.lib.cache import cache, refresh_scheduler
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.lib.mailman import FakeMMList
-from hyperkitty.models import MailingList, Email, Thread, Tag
+from hyperkitty.lib.renderer import RENDERER_VERSION
+from hyperkitty.models import (MailingList, Email, Thread, Tag,
+    update_threads_counts)
 from hyperkitty.tests.utils import TestCase
 
 
@@ -46,6 +53,76 @@ class TagTestCase(TestCase):
         self.tag_1 = Tag.objects.get(pk=1)
 
 
+class MailingListTestCase(TestCase):
+
+    def setUp(self):
+        self.mailman_client.get_list.side_effect = \
+            lambda name: FakeMMList(name)
+
+    def _add_message(self, num):
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg%d>" % num
+        msg.set_payload("Dummy message")
+        add_to_list("list@example.com", msg)
+
+    def test_update_from_mailman_cached(self):
+        self._add_message(1)
+        self._add_message(2)
+        self.assertEqual(self.mailman_client.get_list.call_count, 1)
+        self.assertEqual(MailingList.objects.get().display_name, "list")
+        MailingList.objects.get().invalidate_mailman_cache()
+        self._add_message(3)
+        self.assertEqual(self.mailman_client.get_list.call_count, 2)
+
+    def test_mailman_sync(self):
+        # Syncing a list updates it even if it was updated recently
+        self._add_message(1)
+        def _get_list(name):
+            mm_list = FakeMMList(name)
+            mm_list.display_name = "Renamed"
+            return mm_list
+        self.mailman_client.get_list.side_effect = _get_list
+        call_command("mailman_sync", list_address=["list@example.com"],
+                     verbosity=0)
+        self.assertEqual(MailingList.objects.get().display_name, "Renamed")
+        # When Mailman can't be reached, the list is updated with the next
+        # message
+        self.mailman_client.get_list.side_effect = MailmanConnectionError
+        call_command("mailman_sync", verbosity=0)
+        self.mailman_client.get_list.side_effect = FakeMMList
+        self._add_message(2)
+        self.assertEqual(MailingList.objects.get().display_name, "list")
+
+    def test_update_from_mailman_no_ttl(self):
+        with self.settings(HYPERKITTY_MAILMAN_LIST_TTL=0):
+            self._add_message(1)
+            self._add_message(2)
+        self.assertEqual(self.mailman_client.get_list.call_count, 2)
+
+
+class CacheRefreshTestCase(TestCase):
+
+    def test_deferred_refresh(self):
+        # The cached values are recomputed once for a burst of emails
+        with self.settings(HYPERKITTY_CACHE_REFRESH_DELAY=60):
+            for num in range(1, 4):
+                msg = Message()
+                msg["From"] = "sender%d@example.com" % num
+                msg["Message-ID"] = "<msg%d>" % num
+                if num > 1:
+                    msg["In-Reply-To"] = "<msg1>"
+                msg.set_payload("message %d" % num)
+                add_to_list("example-list", msg)
+            key = "MailingList:example-list:recent_participants_count"
+            self.assertTrue(cache.get(key) is None)
+            with patch.object(MailingList, "recent_participants_count",
+                              new_callable=PropertyMock) as participants:
+                refresh_scheduler.flush()
+                refresh_scheduler.flush()
+            self.assertEqual(participants.call_count, 1)
+
+
 class ThreadTestCase(TestCase):
 
     def test_starting_message_1(self):
@@ -140,6 +217,45 @@ class ThreadTestCase(TestCase):
         self.assertTrue(len(msg_db.subject) < 2712,
                 "Very long subjects are not trimmed")
 
+    def test_only_one_starter(self):
+        _create_email(1)
+        _create_email(2, reply_to=1)
+        msg2 = Email.objects.get(message_id="msg2")
+        msg2.parent = None
+        self.assertRaises(IntegrityError, msg2.save)
+        # Same thing when the email is moved to another thread
+        _create_email(3)
+        msg3 = Email.objects.get(message_id="msg3")
+        msg3.thread = Email.objects.get(message_id="msg1").thread
+        self.assertRaises(IntegrityError, msg3.save)
+
+    def test_content_html(self):
+        _create_email(1)
+        email = Email.objects.get()
+        self.assertEqual(email.content_html, "message 1")
+        self.assertEqual(email.renderer_version, RENDERER_VERSION)
+        # Rendered again after an upgrade of the renderer
+        Email.objects.update(content_html="outdated", renderer_version=0)
+        email = Email.objects.get()
+        self.assertEqual(email.get_content_html(), "message 1")
+        self.assertEqual(Email.objects.values_list(
+            "content_html", "renderer_version").get(),
+            ("message 1", RENDERER_VERSION))
+
+    def test_starter_check_on_change_only(self):
+        # The starting email can be saved without looking for the other
+        # starting emails in the thread
+        _create_email(1)
+        _create_email(2, reply_to=1)
+        msg1 = Email.objects.get(message_id="msg1")
+        msg1.content = "changed"
+        with CaptureQueriesContext(connection) as queries:
+            msg1.save()
+        self.assertFalse([ q for q in queries.captured_queries
+                           if "IS NULL" in q["sql"] ])
+        self.assertEqual(Email.objects.get(message_id="msg1").content,
+                         "changed")
+
 
 def _create_email(num, reply_to=None):
     msg = Message()
@@ -150,6 +266,57 @@ def _create_email(num, reply_to=None):
         msg["In-Reply-To"] = "<msg%d>" % reply_to
     return add_to_list("example-list", msg)
 
+class ThreadCountersTestCase(TestCase):
+
+    def test_counters(self):
+        _create_email(1)
+        _create_email(2, reply_to=1)
+        _create_email(3, reply_to=2)
+        Email.objects.filter(message_id="msg3").update(
+            sender=Email.objects.get(message_id="msg1").sender)
+        thread = Thread.objects.get()
+        update_threads_counts([thread.id])
+        thread = Thread.objects.get()
+        self.assertEqual(thread.emails_count, 3)
+        self.assertEqual(thread.participants_count, 2)
+        Email.objects.get(message_id="msg2").delete()
+        thread = Thread.objects.get()
+        self.assertEqual(thread.emails_count, 2)
+        self.assertEqual(thread.participants_count, 1)
+
+    def test_new_participant(self):
+        _create_email(1)
+        _create_email(2, reply_to=1)
+        thread = Thread.objects.get()
+        self.assertEqual(thread.emails_count, 2)
+        self.assertEqual(thread.participants_count, 2)
+
+    def test_votes(self):
+        user = User.objects.create(username="dummy")
+        _create_email(1)
+        _create_email(2, reply_to=1)
+        Email.objects.get(message_id="msg1").vote(1, user)
+        Email.objects.get(message_id="msg2").vote(-1, user)
+        thread = Thread.objects.get()
+        self.assertEqual((thread.likes, thread.dislikes), (1, 1))
+        Email.objects.get(message_id="msg2").vote(0, user)
+        thread = Thread.objects.get()
+        self.assertEqual((thread.likes, thread.dislikes), (1, 0))
+        # Deleting an email removes its votes
+        Email.objects.get(message_id="msg1").delete()
+        thread = Thread.objects.get()
+        self.assertEqual((thread.likes, thread.dislikes), (0, 0))
+
+    def test_save_keeps_counters(self):
+        # A thread instance loaded before a new email doesn't overwrite the
+        # counters when it is saved
+        _create_email(1)
+        thread = Thread.objects.get()
+        _create_email(2, reply_to=1)
+        thread.save()
+        self.assertEqual(Thread.objects.get().emails_count, 2)
+
+
 class VoteTestCase(TestCase):
 
     def setUp(self):
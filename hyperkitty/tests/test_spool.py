@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+from email.message import Message
+
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError
+from mock import patch
+
+from hyperkitty.lib.spool import Spool
+from hyperkitty.management.commands.hyperkitty_spool import work
+from hyperkitty.models import Email
+
+from hyperkitty.tests.utils import TestCase
+
+
+class SpoolTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+        self.spool = Spool(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_put(self):
+        path = self.spool.put("list@example.com", b"message 1")
+        with open(path) as msgfile:
+            self.assertEqual(msgfile.read(), b"message 1")
+        self.assertEqual(os.listdir(self.spool.tmp_dir), [])
+        self.spool.put("list@example.com", b"message 2")
+        self.spool.put("other@example.com", b"message 3")
+        self.assertEqual(self.spool.depth(),
+            {"list@example.com": 2, "other@example.com": 1})
+
+    def test_process_in_order(self):
+        for num in range(5):
+            self.spool.put("list@example.com", b"message %d" % num)
+        handled = []
+        count = self.spool.drain(
+            lambda list_name, data: handled.append((list_name, data)))
+        self.assertEqual(count, 5)
+        self.assertEqual(handled, [ ("list@example.com", b"message %d" % num)
+                                    for num in range(5) ])
+        self.assertEqual(self.spool.depth(), {"list@example.com": 0})
+
+    def test_process_failure(self):
+        self.spool.put("list@example.com", b"message 1")
+        self.spool.put("list@example.com", b"message 2")
+        handled = []
+        def _handler(list_name, data):
+            if data == b"message 1":
+                raise ValueError("broken message")
+            handled.append(data)
+        self.assertEqual(self.spool.drain(_handler), 2)
+        # The failed message doesn't block the next ones
+        self.assertEqual(handled, [b"message 2"])
+        self.assertEqual(len(os.listdir(os.path.join(
+            self.spool.failed_dir, "list@example.com"))), 1)
+
+    def test_process_database_error(self):
+        # The messages stay in the spool while the database is unavailable
+        self.spool.put("list@example.com", b"message 1")
+        def _handler(list_name, data):
+            raise OperationalError("database is down")
+        with patch("hyperkitty.lib.spool.connection") as connection:
+            self.assertRaises(OperationalError, self.spool.drain, _handler)
+        self.assertTrue(connection.close.called)
+        self.assertEqual(self.spool.depth(), {"list@example.com": 1})
+        self.assertFalse(os.path.exists(self.spool.failed_dir))
+        # But the messages refused by the database are moved away
+        def _handler(list_name, data):
+            raise IntegrityError("duplicate")
+        self.assertEqual(self.spool.drain(_handler), 1)
+        self.assertEqual(self.spool.depth(), {"list@example.com": 0})
+        self.assertEqual(len(os.listdir(os.path.join(
+            self.spool.failed_dir, "list@example.com"))), 1)
+
+    def test_work_backoff(self):
+        self.spool.put("list@example.com", b"message 1")
+        handled = []
+        drain = self.spool.drain
+        def _drain(lists):
+            if len(handled) < 3:
+                handled.append(None)
+                raise OperationalError("database is down")
+            return drain(lambda *a: handled.append(a), lists)
+        with patch.object(self.spool, "drain", _drain), \
+                patch("hyperkitty.management.commands.hyperkitty_spool.time"
+                      ) as time_mock:
+            work(self.spool, once=True)
+        self.assertEqual([ call[0][0] for call in
+                           time_mock.sleep.call_args_list ], [2, 4, 8])
+        self.assertEqual(handled[3:], [("list@example.com", b"message 1")])
+
+    def test_list_locked(self):
+        # A list is processed by a single worker at a time
+        self.spool.put("list@example.com", b"message 1")
+        lock = self.spool._lock("list@example.com")
+        try:
+            self.assertEqual(self.spool.drain(lambda *a: None), 0)
+        finally:
+            lock.close()
+        self.assertEqual(self.spool.drain(lambda *a: None), 1)
+
+    def test_command(self):
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<dummy>"
+        msg["Subject"] = "Dummy message"
+        msg.set_payload("Dummy message")
+        self.spool.put("list@example.com", msg.as_string())
+        with self.settings(HYPERKITTY_ARCHIVE_SPOOL=self.tmpdir):
+            call_command("hyperkitty_spool", once=True)
+        self.assertEqual(Email.objects.filter(
+            mailinglist__name="list@example.com").count(), 1)
+        self.assertEqual(self.spool.depth(), {"list@example.com": 0})
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from django.core.urlresolvers import reverse
+from django.db import transaction
+
+from hyperkitty.lib.bulk import BulkWriter
+from hyperkitty.lib.incoming import add_to_list, parse_message
+from hyperkitty.lib.storage import (
+    FileSystemStore, get_content_hash, delete_unreferenced)
+from hyperkitty.models import MailingList, Email, Attachment
+
+from hyperkitty.tests.utils import TestCase
+
+
+def _make_message(num, content=b"\x00\x01\x02"):
+    msg = MIMEMultipart()
+    msg["From"] = "dummy@example.com"
+    msg["Message-ID"] = "<msg%d>" % num
+    msg.attach(MIMEText("Dummy message"))
+    attachment = MIMEApplication(content)
+    attachment.add_header("Content-Disposition", "attachment",
+                          filename="file.bin")
+    msg.attach(attachment)
+    return msg
+
+
+class FileSystemStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+        self.store = FileSystemStore(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_put(self):
+        content_hash = self.store.put(b"content")
+        self.assertEqual(content_hash, get_content_hash(b"content"))
+        self.assertTrue(self.store.exists(content_hash))
+        self.assertEqual(self.store.get(content_hash), b"content")
+        # No temporary file left
+        self.assertEqual(os.listdir(os.path.dirname(
+            self.store.path(content_hash))), [content_hash])
+
+    def test_put_file(self):
+        # A file is hashed while it is copied
+        content = BytesIO(b"x" * 200000)
+        content_hash = self.store.put(content)
+        self.assertEqual(content_hash, get_content_hash(b"x" * 200000))
+        self.assertEqual(self.store.get(content_hash), b"x" * 200000)
+        # Already stored
+        self.assertEqual(self.store.put(BytesIO(b"x" * 200000)), content_hash)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         [content_hash[:2]])
+
+    def test_delete(self):
+        content_hash = self.store.put(b"content")
+        self.store.delete(content_hash)
+        self.assertFalse(self.store.exists(content_hash))
+        # Already deleted
+        self.store.delete(content_hash)
+
+    def test_put_refreshes(self):
+        # Storing an existing content again protects it from the garbage
+        # collection
+        content_hash = self.store.put(b"content")
+        os.utime(self.store.path(content_hash), (0, 0))
+        self.assertEqual(list(self.store.hashes(older_than=3600)),
+                         [content_hash])
+        self.store.put(b"content")
+        self.assertEqual(list(self.store.hashes(older_than=3600)), [])
+        self.store.delete(content_hash, older_than=3600)
+        self.assertTrue(self.store.exists(content_hash))
+
+
+class AttachmentStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+        self.store = FileSystemStore(self.tmpdir)
+        self.content_hash = get_content_hash(b"\x00\x01\x02")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_database(self):
+        # Without the setting, the content stays in the database
+        add_to_list("list@example.com", _make_message(1))
+        attachment = Attachment.objects.get()
+        self.assertEqual(bytes(attachment.content), b"\x00\x01\x02")
+        self.assertEqual(attachment.content_hash, self.content_hash)
+        self.assertEqual(attachment.get_content(), b"\x00\x01\x02")
+        self.assertFalse(self.store.exists(self.content_hash))
+
+    def test_deduplicate(self):
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir):
+            add_to_list("list1@example.com", _make_message(1))
+            add_to_list("list2@example.com", _make_message(1))
+            self.assertEqual(Attachment.objects.count(), 2)
+            for attachment in Attachment.objects.all():
+                self.assertEqual(attachment.content, None)
+                self.assertEqual(attachment.size, 3)
+                self.assertEqual(attachment.get_content(), b"\x00\x01\x02")
+        self.assertTrue(self.store.exists(self.content_hash))
+
+    def test_delete(self):
+        # The content is removed from the store after the last attachment
+        # referring to it
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir):
+            add_to_list("list1@example.com", _make_message(1))
+            add_to_list("list2@example.com", _make_message(1))
+            Email.objects.filter(mailinglist__name="list1@example.com"
+                                 ).delete()
+            self.assertEqual(delete_unreferenced(self.store, 0), 0)
+            self.assertTrue(self.store.exists(self.content_hash))
+            Email.objects.get().delete()
+            self.assertTrue(self.store.exists(self.content_hash))
+            self.assertEqual(delete_unreferenced(self.store, 0), 1)
+            self.assertFalse(self.store.exists(self.content_hash))
+
+    def test_delete_grace_period(self):
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir):
+            add_to_list("list@example.com", _make_message(1))
+            Email.objects.get().delete()
+        # Recently stored, may be referenced by an uncommitted transaction
+        self.assertEqual(delete_unreferenced(self.store), 0)
+        self.assertTrue(self.store.exists(self.content_hash))
+
+    def test_delete_rollback(self):
+        # The content stays when the deletion is rolled back
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir):
+            add_to_list("list@example.com", _make_message(1))
+            try:
+                with transaction.atomic():
+                    Email.objects.get().delete()
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(delete_unreferenced(self.store, 0), 0)
+            self.assertEqual(Attachment.objects.get().get_content(),
+                             b"\x00\x01\x02")
+
+    def test_delete_in_database(self):
+        # A copy in the database is not a reference to the stored content
+        add_to_list("list1@example.com", _make_message(1))
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir):
+            add_to_list("list2@example.com", _make_message(1))
+            Email.objects.get(mailinglist__name="list2@example.com").delete()
+        self.assertEqual(delete_unreferenced(self.store, 0), 1)
+        self.assertFalse(self.store.exists(self.content_hash))
+        self.assertEqual(Attachment.objects.get().get_content(),
+                         b"\x00\x01\x02")
+
+    def test_bulk(self):
+        mlist = MailingList.objects.create(name="list@example.com")
+        writer = BulkWriter(mlist)
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir):
+            writer.add(*parse_message("list@example.com", _make_message(1)))
+            writer.flush()
+            attachment = Attachment.objects.get()
+            self.assertEqual(attachment.content, None)
+            self.assertEqual(attachment.size, 3)
+            self.assertEqual(attachment.get_content(), b"\x00\x01\x02")
+
+    def test_download(self):
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir):
+            add_to_list("list@example.com", _make_message(1))
+            attachment = Attachment.objects.get()
+            response = self.client.get(reverse("hk_message_attachment",
+                kwargs={"mlist_fqdn": "list@example.com",
+                        "message_id_hash": attachment.email.message_id_hash,
+                        "counter": attachment.counter,
+                        "filename": "file.bin"}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content),
+                         b"\x00\x01\x02")
+
+    def test_placeholder(self):
+        # The attachments which are too large are not stored
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir,
+                           HYPERKITTY_ATTACHMENT_MAX_SIZE=2):
+            add_to_list("list@example.com", _make_message(1))
+            attachment = Attachment.objects.get()
+            self.assertTrue(attachment.is_placeholder)
+            self.assertEqual(attachment.size, 3)
+            self.assertEqual(attachment.get_content(), b"")
+            response = self.client.get(reverse("hk_message_attachment",
+                kwargs={"mlist_fqdn": "list@example.com",
+                        "message_id_hash": attachment.email.message_id_hash,
+                        "counter": attachment.counter,
+                        "filename": "file.bin"}))
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        attachment.delete()
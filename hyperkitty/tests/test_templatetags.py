@@ -21,8 +21,11 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+from django.template import Context, Template
+
 from hyperkitty.tests.utils import TestCase
 
+from hyperkitty.lib.renderer import render_body
 from hyperkitty.templatetags.hk_generic import snip_quoted
 
 class SnipQuotedTestCase(TestCase):
@@ -43,3 +46,26 @@ On Fri, 09.11.12 11:27, Someone wrote:
 """ % self.quotemsg
         result = snip_quoted(contents, self.quotemsg)
         self.assertEqual(result, expected)
+
+
+class RenderBodyTestCase(TestCase):
+
+    def test_same_as_filters(self):
+        # The body rendered when archiving must be the same as the one the
+        # templates rendered before
+        template = Template("{% load hk_generic %}{{ content|snip_quoted|"
+            "snip_pgp|wordwrap:90|urlizetrunc:76|escapeemail }}")
+        content = """Someone <someone@example.com> wrote:
+> This is a quoted line, with <b>HTML</b> & an URL: http://example.com/%s
+> Second quoted line
+
+This is the response, see https://example.com or mail me at me@example.com.
+%s
+-----BEGIN PGP SIGNATURE-----
+Version: GnuPG v1
+
+iEYEARECAAYFAlCr3Q4ACgkQzQkFwUoSU5V0UQCfVYTzzxMI
+-----END PGP SIGNATURE-----
+""" % ("x" * 100, "word " * 40)
+        self.assertEqual(render_body(content),
+                         template.render(Context({"content": content})))
@@ -34,7 +34,7 @@ from django.test import TestCase as DjangoTestCase
 from django.conf import settings
 #from django.core.cache import get_cache
 
-from hyperkitty.lib.cache import cache
+from hyperkitty.lib.cache import cache, refresh_scheduler
 
 
 class TestCase(DjangoTestCase):
@@ -51,6 +51,8 @@ class TestCase(DjangoTestCase):
         "LOGIN_ERROR_URL": '/accounts/login/',
         "COMPRESS_ENABLED": False,
         "COMPRESS_PRECOMPILERS": (),
+        # the refresh thread would not see the test database
+        "HYPERKITTY_CACHE_REFRESH_DELAY": 0,
         #"CACHES": {
         #    'default': {
         #        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
@@ -80,6 +82,7 @@ class TestCase(DjangoTestCase):
 
     def _post_teardown(self):
         self._mm_client_patcher.stop()
+        refresh_scheduler.cancel()
         cache.clear()
         for key, value in self._old_settings.items():
             if value is None:
@@ -31,8 +31,9 @@ from mock import Mock
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 
-from hyperkitty.models import MailingList, ArchivePolicy
+from hyperkitty.models import MailingList, ArchivePolicy, Email
 from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.lib.renderer import RENDERER_VERSION
 from hyperkitty.lib.mailman import FakeMMList
 from hyperkitty.tests.utils import TestCase
 
@@ -58,6 +59,20 @@ class ListArchivesTestCase(TestCase):
                 })
         self.assertRedirects(response, final_url)
 
+    def test_rendered_content(self):
+        # the stored HTML is displayed, it is not rendered again
+        Email.objects.update(content_html="<p>Stored HTML</p>",
+                             renderer_version=RENDERER_VERSION)
+        today = datetime.date.today()
+        response = self.client.get(reverse(
+                'hk_archives_with_month', kwargs={
+                    'mlist_fqdn': 'list@example.com',
+                    'year': today.year,
+                    'month': today.month,
+                }))
+        self.assertContains(response, "<p>Stored HTML</p>")
+        self.assertNotContains(response, "Dummy message")
+
     def test_wrong_date(self):
         response = self.client.get(reverse(
                 'hk_archives_with_month', kwargs={
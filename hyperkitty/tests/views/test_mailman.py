@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+from base64 import b64encode
+from email.message import Message
+from StringIO import StringIO
+
+from django.core.urlresolvers import reverse
+from django.utils.http import urlunquote
+
+from hyperkitty.lib.spool import Spool
+from hyperkitty.lib.utils import get_message_id_hash
+from hyperkitty.models import Email, Thread
+
+from hyperkitty.tests.utils import TestCase
+
+
+class ArchiveTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<dummy>"
+        msg["Subject"] = "Dummy message"
+        msg.set_payload("Dummy message")
+        self.message = msg.as_string()
+        self.api_settings = {
+            "MAILMAN_ARCHIVER_API_USER": "archiver",
+            "MAILMAN_ARCHIVER_API_PASS": "secret",
+            "MAILMAN_REST_SERVER": "http://localhost:8001",
+        }
+        self.headers = {
+            "HTTP_AUTHORIZATION": "Basic %s" % b64encode(b"archiver:secret"),
+            "REMOTE_HOST": "localhost",
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _archive(self):
+        message = StringIO(self.message)
+        message.name = "message.txt"
+        return self.client.post(reverse("hk_mailman_archive"), {
+            "mlist": "list@example.com", "message": message}, **self.headers)
+
+    def test_archive(self):
+        with self.settings(**self.api_settings):
+            response = self._archive()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Email.objects.count(), 1)
+
+    def test_archive_spool(self):
+        with self.settings(HYPERKITTY_ARCHIVE_SPOOL=self.tmpdir,
+                           **self.api_settings):
+            response = self._archive()
+            status = self.client.get(reverse("hk_mailman_spool"),
+                                     **self.headers)
+        self.assertEqual(response.status_code, 200)
+        # The message is not archived yet, but the URL is already known
+        self.assertEqual(Email.objects.count(), 0)
+        self.assertEqual(json.loads(response.content)["url"],
+            urlunquote(reverse("hk_message_index", kwargs={
+                "mlist_fqdn": "list@example.com",
+                "message_id_hash": get_message_id_hash("dummy")})))
+        self.assertEqual(Spool(self.tmpdir).depth(), {"list@example.com": 1})
+        # The upload is copied to the spool by chunks
+        spool = Spool(self.tmpdir)
+        with open(os.path.join(spool._list_dir("list@example.com"),
+                  spool.pending("list@example.com")[0])) as spooled:
+            self.assertEqual(spooled.read(), self.message)
+        self.assertEqual(json.loads(status.content), {
+            "enabled": True, "lists": {"list@example.com": 1}, "total": 1})
+
+    def test_archive_too_large(self):
+        # Only the headers of the messages which are too large are archived
+        with self.settings(HYPERKITTY_MESSAGE_MAX_SIZE=10,
+                           **self.api_settings):
+            response = self._archive()
+        self.assertEqual(response.status_code, 200)
+        email = Email.objects.get()
+        self.assertEqual(email.message_id, "dummy")
+        self.assertEqual(email.subject, "Dummy message")
+        self.assertEqual(email.content,
+            "This message was too large to be archived (%d bytes)."
+            % len(self.message))
+
+    def test_forbidden_host(self):
+        # The archiving and the spool endpoints only answer to Mailman
+        headers = self.headers.copy()
+        headers["REMOTE_HOST"] = "other.example.com"
+        headers["REMOTE_ADDR"] = "192.0.2.1"
+        with self.settings(HYPERKITTY_ARCHIVE_SPOOL=self.tmpdir,
+                           **self.api_settings):
+            message = StringIO(self.message)
+            message.name = "message.txt"
+            archive = self.client.post(reverse("hk_mailman_archive"), {
+                "mlist": "list@example.com", "message": message}, **headers)
+            status = self.client.get(reverse("hk_mailman_spool"), **headers)
+        self.assertEqual(archive.status_code, 403)
+        self.assertEqual(status.status_code, 403)
+        self.assertEqual(Spool(self.tmpdir).depth(), {})
+
+    def test_urls(self):
+        # Mailman's archiver builds the permalinks from the list URL, the
+        # message URL must stay under it.
+        with self.settings(**self.api_settings):
+            list_url = self.client.get(reverse("hk_mailman_urls"),
+                {"mlist": "list@example.com"}, **self.headers)
+            msg_url = self.client.get(reverse("hk_mailman_urls"),
+                {"mlist": "list@example.com", "msgid": "<dummy>"},
+                **self.headers)
+        self.assertEqual(json.loads(msg_url.content)["url"],
+            "%smessage/%s/" % (json.loads(list_url.content)["url"],
+                               get_message_id_hash("dummy")))
+
+    def _archive_batch(self, messages):
+        files = []
+        for message in messages:
+            message = StringIO(message)
+            message.name = "message.txt"
+            files.append(message)
+        return self.client.post(reverse("hk_mailman_archive"), {
+            "mlist": ["list1@example.com", "list2@example.com",
+                      "list1@example.com"][:len(messages)],
+            "message": files}, **self.headers)
+
+    def test_archive_batch(self):
+        msg2 = self.message.replace("<dummy>", "<dummy2>")
+        broken = self.message.replace("Message-ID: <dummy>\n", "")
+        with self.settings(**self.api_settings):
+            response = self._archive_batch([self.message, msg2, broken])
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)["results"]
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]["url"],
+            urlunquote(reverse("hk_message_index", kwargs={
+                "mlist_fqdn": "list1@example.com",
+                "message_id_hash": get_message_id_hash("dummy")})))
+        self.assertEqual(results[1]["mlist"], "list2@example.com")
+        self.assertTrue(results[1]["url"].startswith(
+            "/list/list2@example.com/"))
+        self.assertTrue("error" in results[2])
+        self.assertEqual(
+            sorted(Email.objects.values_list("mailinglist_id", "message_id")),
+            [("list1@example.com", "dummy"), ("list2@example.com", "dummy2")])
+        # The threads are complete
+        self.assertEqual(
+            list(Thread.objects.values_list("emails_count", flat=True)), [1, 1])
+
+    def test_archive_batch_duplicate(self):
+        messages = [self.message, self.message, self.message]
+        with self.settings(**self.api_settings):
+            self._archive_batch(messages)
+            response = self._archive_batch(messages)
+        results = json.loads(response.content)["results"]
+        self.assertTrue(all("url" in result for result in results))
+        self.assertEqual(Email.objects.count(), 2)
+
+    def test_archive_batch_mismatch(self):
+        message = StringIO(self.message)
+        message.name = "message.txt"
+        message2 = StringIO(self.message)
+        message2.name = "message.txt"
+        with self.settings(**self.api_settings):
+            response = self.client.post(reverse("hk_mailman_archive"), {
+                "mlist": "list@example.com", "message": [message, message2]},
+                **self.headers)
+        self.assertEqual(response.status_code, 400)
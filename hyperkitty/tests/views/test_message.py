@@ -23,7 +23,12 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import json
+import shutil
+import tempfile
 from email.message import Message
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 
 from mock import patch
 from django.contrib.auth.models import User
@@ -34,7 +39,8 @@ from django_gravatar.helpers import get_gravatar_url
 
 from hyperkitty.lib.utils import get_message_id_hash
 from hyperkitty.lib.incoming import add_to_list
-from hyperkitty.models import Email
+from hyperkitty.lib.storage import FileSystemStore, get_content_hash
+from hyperkitty.models import Email, Attachment
 from hyperkitty.tests.utils import TestCase
 
 
@@ -126,6 +132,17 @@ class MessageViewsTestCase(TestCase):
         sender_time = '<span title="Sender\'s time: 2015-02-02 13:00:00">10:00:00</span>'
         self.assertIn(sender_time, response.content.decode("utf-8"))
 
+    def test_reply_rendered(self):
+        url = reverse('hk_message_reply', args=("list@example.com",
+                      get_message_id_hash("msg")))
+        with patch("hyperkitty.lib.posting.mailman.subscribe"):
+            response = self.client.post(url, {
+                "message": "> quoted text\ndummy reply content"})
+        result = json.loads(response.content)
+        # the temporary message is rendered like the archived ones
+        self.assertIn('class="quoted-text"', result["message_html"])
+        self.assertIn("dummy reply content", result["message_html"])
+
     def test_reply(self):
         self.user.first_name = "Django"
         self.user.last_name = "User"
@@ -169,3 +186,104 @@ class MessageViewsTestCase(TestCase):
         self.assertEqual(mail.outbox[0].body, "dummy reply content")
         self.assertNotIn("references", mail.outbox[0].message())
         self.assertNotIn("in-reply-to", mail.outbox[0].message())
+
+
+class AttachmentViewTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+        # Larger than a chunk
+        self.content = b"".join(chr(num % 256) for num in range(200000))
+        msg = MIMEMultipart()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg>"
+        msg.attach(MIMEText("Dummy message"))
+        attachment = MIMEApplication(self.content)
+        attachment.add_header("Content-Disposition", "attachment",
+                              filename="file.bin")
+        msg.attach(attachment)
+        self.msg = msg
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _get(self, **headers):
+        attachment = Attachment.objects.get()
+        return self.client.get(reverse("hk_message_attachment", kwargs={
+            "mlist_fqdn": "list@example.com",
+            "message_id_hash": attachment.email.message_id_hash,
+            "counter": attachment.counter, "filename": "file.bin"}),
+            **headers)
+
+    def _check_download(self):
+        response = self._get()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+        self.assertEqual(response["Content-Length"], str(len(self.content)))
+        self.assertEqual(response["ETag"],
+                         '"%s"' % get_content_hash(self.content))
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+    def test_download(self):
+        add_to_list("list@example.com", self.msg)
+        self._check_download()
+
+    def test_download_from_store(self):
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir):
+            add_to_list("list@example.com", self.msg)
+            self._check_download()
+
+    def test_not_modified(self):
+        add_to_list("list@example.com", self.msg)
+        etag = '"%s"' % get_content_hash(self.content)
+        response = self._get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        response = self._get(HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_range(self):
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir):
+            add_to_list("list@example.com", self.msg)
+            size = len(self.content)
+            for header, start, stop in [
+                    ("bytes=100-199", 100, 200),
+                    ("bytes=150000-", 150000, size),
+                    ("bytes=-10", size - 10, size),
+                    ("bytes=199990-300000", 199990, size),
+                    ]:
+                response = self._get(HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(b"".join(response.streaming_content),
+                                 self.content[start:stop])
+                self.assertEqual(response["Content-Range"],
+                                 "bytes %d-%d/%d" % (start, stop - 1, size))
+                self.assertEqual(response["Content-Length"],
+                                 str(stop - start))
+            response = self._get(HTTP_RANGE="bytes=300000-")
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response["Content-Range"], "bytes */%d" % size)
+            # Multiple ranges are not supported
+            response = self._get(HTTP_RANGE="bytes=0-1,5-6")
+            self.assertEqual(response.status_code, 200)
+            # The content has changed
+            response = self._get(HTTP_RANGE="bytes=100-199",
+                                 HTTP_IF_RANGE='"other"')
+            self.assertEqual(response.status_code, 200)
+
+    def test_sendfile(self):
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir,
+                           HYPERKITTY_ATTACHMENT_SENDFILE="X-Sendfile"):
+            add_to_list("list@example.com", self.msg)
+            response = self._get()
+        content_hash = get_content_hash(self.content)
+        self.assertEqual(response["X-Sendfile"],
+                         FileSystemStore(self.tmpdir).path(content_hash))
+        self.assertEqual(response.content, b"")
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.tmpdir,
+                           HYPERKITTY_ATTACHMENT_SENDFILE="X-Accel-Redirect",
+                           HYPERKITTY_ATTACHMENT_SENDFILE_PREFIX="/internal/"):
+            response = self._get()
+        self.assertEqual(response["X-Accel-Redirect"], "/internal/%s/%s/%s"
+                         % (content_hash[:2], content_hash[2:4], content_hash))
@@ -107,6 +107,7 @@ urlpatterns = patterns('hyperkitty.views',
     # Mailman archiver API
     url(r'^api/mailman/urls$', 'mailman.urls', name='hk_mailman_urls'),
     url(r'^api/mailman/archive$', 'mailman.archive', name='hk_mailman_archive'),
+    url(r'^api/mailman/spool$', 'mailman.spool', name='hk_mailman_spool'),
 
     # REST API
     url(r'^api/$', TemplateView.as_view(template_name="hyperkitty/api.html")),
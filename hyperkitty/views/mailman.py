@@ -22,8 +22,9 @@
 from __future__ import absolute_import, unicode_literals
 
 import json
+from collections import OrderedDict
 from urlparse import urlparse
-from email import message_from_file
+from email.parser import FeedParser, HeaderParser
 from functools import wraps
 
 from django.conf import settings
@@ -32,12 +33,20 @@ from django.core.urlresolvers import reverse
 from django.http import HttpResponse
 from django.utils.http import urlunquote
 
+from hyperkitty.lib.bulk import add_batch_to_list
 from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.lib.spool import Spool
 from hyperkitty.lib.utils import get_message_id_hash
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Default maximum size of an uploaded message. The body of the larger messages
+# is not archived, only their headers.
+MESSAGE_MAX_SIZE = 60 * 1024 * 1024
+# Maximum length of a header line read from a message which is too large
+HEADER_LINE_MAX_SIZE = 64 * 1024
+
 
 def basic_auth(func):
     # Inspired by:
@@ -82,6 +91,54 @@ def _get_url(mlist_fqdn, msg_id=None):
     return urlunquote(url)
 
 
+def _is_too_large(upload):
+    max_size = getattr(settings, "HYPERKITTY_MESSAGE_MAX_SIZE",
+                       MESSAGE_MAX_SIZE)
+    return max_size is not None and upload.size > max_size
+
+
+def _read_upload(upload, headers_only=False):
+    """
+    Parse an uploaded message by chunks, without reading it in a string. Only
+    the headers are parsed if ``headers_only`` is True, or if the message is
+    larger than the HYPERKITTY_MESSAGE_MAX_SIZE setting: its body is then
+    replaced with a notice.
+    """
+    too_large = _is_too_large(upload)
+    if not headers_only and not too_large:
+        parser = FeedParser()
+        for chunk in upload.chunks():
+            parser.feed(chunk)
+        return parser.close()
+    upload.seek(0)
+    headers = []
+    while True:
+        line = upload.readline(HEADER_LINE_MAX_SIZE)
+        if not line.strip():
+            break # end of the headers
+        headers.append(line)
+    msg = HeaderParser().parsestr(b"".join(headers))
+    if not too_large:
+        return msg
+    for header in ("Content-Type", "Content-Transfer-Encoding"):
+        del msg[header]
+    msg.set_payload("This message was too large to be archived (%d bytes)."
+                    % upload.size)
+    logger.warning("Message %s is too large to be archived (%d bytes), only "
+                   "its headers were kept", msg["Message-Id"], upload.size)
+    return msg
+
+
+def _spool_data(upload, msg):
+    """
+    The data to write to the spool: the chunks of the upload, or the headers
+    and the notice if the message is too large.
+    """
+    if _is_too_large(upload):
+        return msg.as_string()
+    return upload.chunks()
+
+
 @basic_auth
 def urls(request):
     result = _get_url(request.GET["mlist"], request.GET.get("msgid"))
@@ -89,30 +146,108 @@ def urls(request):
                         content_type='application/javascript')
 
 
+def mailman_host_only(func):
+    """Only allow the requests from the host of MAILMAN_REST_SERVER"""
+    @wraps(func)
+    def _decorator(request, *args, **kwargs):
+        allowed_from = urlparse(settings.MAILMAN_REST_SERVER).netloc
+        allowed_from = allowed_from.partition(":")[0]
+        if request.META["REMOTE_ADDR"] != allowed_from and \
+            request.META.get("REMOTE_HOST") != allowed_from:
+            # pylint: disable=logging-format-interpolation
+            logger.info("Access to the {} API endpoint was forbidden from "
+                        "IP {}, your MAILMAN_REST_SERVER setting may be "
+                        "misconfigured".format(func.__name__,
+                                               request.META["REMOTE_ADDR"]))
+            response = HttpResponse("""
+                <html><title>Forbidden</title><body>
+                <h1>Access is forbidden</h1></body></html>""",
+                content_type="text/html")
+            response.status_code = 403
+            return response
+        return func(request, *args, **kwargs)
+    return _decorator
+
+
 @basic_auth
+@mailman_host_only
 def archive(request):
-    allowed_from = urlparse(settings.MAILMAN_REST_SERVER).netloc
-    allowed_from = allowed_from.partition(":")[0]
-    if request.META["REMOTE_ADDR"] != allowed_from and \
-        request.META["REMOTE_HOST"] != allowed_from:
-        # pylint: disable=logging-format-interpolation
-        logger.info("Access to the archiving API endpoint was forbidden from "
-                    "IP {}, your MAILMAN_REST_SERVER setting may be "
-                    "misconfigured".format(request.META["REMOTE_ADDR"]))
-        response = HttpResponse("""
-            <html><title>Forbidden</title><body>
-            <h1>Access is forbidden</h1></body></html>""",
-            content_type="text/html")
-        response.status_code = 403
-        return response
     if request.method != 'POST':
         raise SuspiciousOperation
-    mlist_fqdn = request.POST["mlist"]
     if "message" not in request.FILES:
         raise SuspiciousOperation
-    msg = message_from_file(request.FILES['message'])
-    add_to_list(mlist_fqdn, msg)
-    url = _get_url(mlist_fqdn, msg['Message-Id'])
-    logger.info("Archived message %s to %s", msg['Message-Id'], url)
+    if len(request.FILES.getlist("message")) > 1:
+        return _archive_batch(request)
+    mlist_fqdn = request.POST["mlist"]
+    upload = request.FILES['message']
+    spool_path = getattr(settings, "HYPERKITTY_ARCHIVE_SPOOL", None)
+    if spool_path:
+        # The permalink only depends on the Message-ID, the message will be
+        # archived by the hyperkitty_spool command
+        msg = _read_upload(upload, headers_only=True)
+        if not msg.has_key("Message-Id"):
+            raise SuspiciousOperation
+        Spool(spool_path).put(mlist_fqdn, _spool_data(upload, msg))
+        url = _get_url(mlist_fqdn, msg['Message-Id'])
+        logger.info("Spooled message %s to %s", msg['Message-Id'], url)
+    else:
+        msg = _read_upload(upload)
+        add_to_list(mlist_fqdn, msg)
+        url = _get_url(mlist_fqdn, msg['Message-Id'])
+        logger.info("Archived message %s to %s", msg['Message-Id'], url)
     return HttpResponse(json.dumps({"url": url}),
                         content_type='application/javascript')
+
+
+def _archive_batch(request):
+    """
+    Archive several messages, possibly to several lists. The n-th message is
+    archived to the n-th list.
+    """
+    mlists = request.POST.getlist("mlist")
+    files = request.FILES.getlist("message")
+    if len(mlists) != len(files):
+        raise SuspiciousOperation
+    results = [None] * len(files)
+    batches = OrderedDict() # list name -> indexes of its messages
+    for index, mlist_fqdn in enumerate(mlists):
+        batches.setdefault(mlist_fqdn, []).append(index)
+    spool_path = getattr(settings, "HYPERKITTY_ARCHIVE_SPOOL", None)
+    for mlist_fqdn, indexes in batches.items():
+        uploads = [ files[index] for index in indexes ]
+        messages = [ _read_upload(upload, headers_only=bool(spool_path))
+                     for upload in uploads ]
+        if spool_path:
+            archived = []
+            for upload, msg in zip(uploads, messages):
+                if not msg.has_key("Message-Id"):
+                    archived.append(ValueError(
+                        "No 'Message-Id' header in email"))
+                    continue
+                Spool(spool_path).put(mlist_fqdn, _spool_data(upload, msg))
+                archived.append(get_message_id_hash(
+                    msg["Message-Id"].strip().strip("<>")))
+        else:
+            archived = add_batch_to_list(mlist_fqdn, messages)
+        for index, msg, msg_hash in zip(indexes, messages, archived):
+            result = {"mlist": mlist_fqdn, "message_id": msg["Message-Id"]}
+            if isinstance(msg_hash, Exception):
+                result["error"] = unicode(msg_hash)
+            else:
+                result["url"] = _get_url(mlist_fqdn, msg["Message-Id"])
+            results[index] = result
+    logger.info("Archived a batch of %d messages to %s", len(files),
+                ", ".join(batches))
+    return HttpResponse(json.dumps({"results": results}),
+                        content_type='application/javascript')
+
+
+@basic_auth
+@mailman_host_only
+def spool(request):
+    spool_path = getattr(settings, "HYPERKITTY_ARCHIVE_SPOOL", None)
+    depth = Spool(spool_path).depth() if spool_path else {}
+    result = {"enabled": bool(spool_path), "lists": depth,
+              "total": sum(depth.values())}
+    return HttpResponse(json.dumps(result),
+                        content_type='application/javascript')
@@ -21,23 +21,37 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import os
+import re
 import urllib
 import datetime
 import json
+from io import BytesIO
 
-from django.http import HttpResponse, Http404
+from django.conf import settings
+from django.http import (HttpResponse, Http404, HttpResponseNotModified,
+    StreamingHttpResponse)
+from django.utils.http import parse_etags, quote_etag
 from django.shortcuts import redirect, render, get_object_or_404
 from django.core.urlresolvers import reverse
 from django.core.exceptions import SuspiciousOperation
 from django.template import RequestContext, loader
 from django.contrib.auth.decorators import login_required
+from django.utils.safestring import mark_safe
 
 from hyperkitty.lib.view_helpers import get_months, check_mlist_private
 from hyperkitty.lib.posting import post_to_list, PostingFailed, reply_subject
+from hyperkitty.lib.renderer import render_body
+from hyperkitty.lib.storage import get_attachment_store, get_content_hash
 from hyperkitty.models import MailingList, Email, Attachment
 from .forms import ReplyForm, PostForm
 
 
+# Size of the chunks the attachments are sent by
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r"^\s*bytes=(\d*)-(\d*)\s*$")
+
+
 @check_mlist_private
 def index(request, mlist_fqdn, message_id_hash):
     '''
@@ -63,6 +77,50 @@ def index(request, mlist_fqdn, message_id_hash):
     return render(request, "hyperkitty/message.html", context)
 
 
+def _parse_range(header, size):
+    """
+    Parse the value of a Range header. Only single byte ranges are supported,
+    the other ranges are ignored (the whole content is sent).
+
+    :returns: the start and the end (excluded) of the range, or None if the
+        header must be ignored.
+    :raises ValueError: if the range does not overlap the content.
+    """
+    match = RANGE_RE.match(header)
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        # the last bytes
+        if int(end) == 0:
+            raise ValueError("empty range")
+        return max(size - int(end), 0), size
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        raise ValueError("range after the end of the content")
+    stop = min(int(end) + 1, size) if end else size
+    return start, stop
+
+
+def _read_chunks(fileobj, start, stop):
+    """Read a part of a file by chunks, and close it."""
+    try:
+        fileobj.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = fileobj.read(min(ATTACHMENT_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        fileobj.close()
+
+
 @check_mlist_private
 def attachment(request, mlist_fqdn, message_id_hash, counter, filename):
     """
@@ -73,14 +131,70 @@ def attachment(request, mlist_fqdn, message_id_hash, counter, filename):
     mlist = get_object_or_404(MailingList, name=mlist_fqdn)
     message = get_object_or_404(Email,
         mailinglist=mlist, message_id_hash=message_id_hash)
-    att = get_object_or_404(Attachment,
+    # Don't load the content if it is in the attachment store
+    att = get_object_or_404(Attachment.objects.defer("content"),
         email=message, counter=int(counter))
     if att.name != filename:
         raise Http404
-    # http://djangosnippets.org/snippets/1710/
-    response = HttpResponse(att.content)
+    store = get_attachment_store()
+    # The contents are identified by their hash, the stored copy can be
+    # sent even if this attachment is still in the database
+    in_store = att.content_hash is not None and store is not None \
+               and store.exists(att.content_hash)
+    if in_store:
+        etag, size = att.content_hash, att.size
+    elif att.is_placeholder:
+        return HttpResponse("This attachment was too large to be archived "
+                            "(%s bytes)." % att.size,
+                            content_type="text/plain", status=410)
+    else:
+        content = att.get_content()
+        etag, size = att.content_hash or get_content_hash(content), len(content)
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match and (if_none_match.strip() == "*"
+                          or etag in parse_etags(if_none_match)):
+        response = HttpResponseNotModified()
+        response["ETag"] = quote_etag(etag)
+        return response
+    sendfile = getattr(settings, "HYPERKITTY_ATTACHMENT_SENDFILE", None)
+    if in_store and sendfile:
+        # Let the web server send the file
+        path = store.path(etag)
+        if sendfile == "X-Accel-Redirect":
+            path = "%s/%s" % (getattr(settings,
+                "HYPERKITTY_ATTACHMENT_SENDFILE_PREFIX", "/attachments"
+                ).rstrip("/"), os.path.relpath(path, store.folder))
+        response = HttpResponse()
+        response[sendfile] = path
+    else:
+        start, stop = 0, size
+        range_header = request.META.get("HTTP_RANGE")
+        if_range = request.META.get("HTTP_IF_RANGE")
+        byte_range = None
+        if range_header and (not if_range or etag in parse_etags(if_range)):
+            try:
+                byte_range = _parse_range(range_header, size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = "bytes */%d" % size
+                return response
+        if in_store:
+            fileobj = store.open(etag)
+        else:
+            fileobj = BytesIO(content)
+        if byte_range is None:
+            response = StreamingHttpResponse(
+                _read_chunks(fileobj, start, stop))
+        else:
+            start, stop = byte_range
+            response = StreamingHttpResponse(
+                _read_chunks(fileobj, start, stop), status=206)
+            response["Content-Range"] = "bytes %d-%d/%d" % (
+                start, stop - 1, size)
+        response['Content-Length'] = stop - start
+        response['Accept-Ranges'] = "bytes"
     response['Content-Type'] = att.content_type
-    response['Content-Length'] = att.size
+    response['ETag'] = quote_etag(etag)
     if att.encoding is not None:
         response['Content-Encoding'] = att.encoding
     # Follow RFC2231, browser support is sufficient nowadays (2012-09)
@@ -155,6 +269,8 @@ def reply(request, mlist_fqdn, message_id_hash):
             "sender_name": "%s %s" % (request.user.first_name,
                                       request.user.last_name),
             "content": form.cleaned_data["message"],
+            "content_html": mark_safe(render_body(
+                form.cleaned_data["message"])),
             "level": message.thread_depth, # no need to increment, level = thread_depth - 1
         }
         t = loader.get_template('hyperkitty/ajax/temp_message.html')
@@ -127,7 +127,12 @@ def overview(request, mlist_fqdn=None):
         threads.append(thread_obj)
 
     # top threads are the one with the most answers
-    top_threads = sorted(threads, key=lambda t: t.emails_count, reverse=True)
+    begin_date, end_date = mlist.get_recent_dates()
+    top_threads = list(mlist.get_threads_between(begin_date, end_date
+        ).order_by("-emails_count", "-date_active")[:20])
+    for thread_obj in top_threads:
+        thread_obj.category_widget = get_category_widget(
+                None, thread_obj.category)[0]
 
     # active threads are the ones that have the most recent posting
     active_threads = sorted(threads, key=lambda t: t.date_active, reverse=True)
@@ -178,7 +183,7 @@ def overview(request, mlist_fqdn=None):
     context = {
         'view_name': 'overview',
         'mlist' : mlist,
-        'top_threads': top_threads[:20],
+        'top_threads': top_threads,
         'most_active_threads': active_threads[:20],
         'top_author': authors,
         'pop_threads': pop_threads[:20],